@@ -0,0 +1,59 @@
+import os
+import sys
+import argparse
+import os.path as osp
+import torch
+
+sys.path.insert(0, osp.dirname(osp.dirname(osp.abspath(__file__))))
+from config import cfg
+import modeling.meta_arch as meta_arch
+from modeling import make_model
+from utils.inputs import random_inputs, random_clip
+from benchmarks.run import measure
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="IDEA torch.compile benchmark (compile time versus steady-state speedup)")
+    parser.add_argument(
+        "--config_file", default="", help="path to config file", type=str
+    )
+    parser.add_argument("--iters", default=10, type=int, help="timed forward passes for the steady state")
+    parser.add_argument("--layers", default=12, type=int, help="CLIP layers when the weights are random")
+    parser.add_argument("opts", help="Modify config options using the command-line", default=None,
+                        nargs=argparse.REMAINDER)
+
+    args = parser.parse_args()
+
+    if args.config_file != "":
+        cfg.merge_from_file(args.config_file)
+    cfg.merge_from_list(args.opts)
+    cfg.freeze()
+    os.environ['CUDA_VISIBLE_DEVICES'] = cfg.MODEL.DEVICE_ID
+    device = cfg.MODEL.DEVICE
+    if not os.path.exists(cfg.MODEL.PRETRAIN_PATH_T):
+        meta_arch.load_clip_to_cpu = random_clip(args.layers)
+
+    model = make_model(cfg, num_class=10, camera_num=1, view_num=1)
+    if cfg.TEST.WEIGHT:
+        model.load_param(cfg.TEST.WEIGHT)
+    model.to(device)
+    model.eval()
+    inputs = random_inputs(cfg.TEST.IMS_PER_BATCH, cfg.INPUT.SIZE_TEST, device)
+
+    with torch.no_grad():
+        # median of `iters` forward passes after two warm-up calls, the first compiled call is timed on its own
+        eager = measure(lambda: model(**inputs), args.iters, device, warmup=2)['median_ms'] / 1e3
+        expected = model(**inputs)
+        if not model.BACKBONE.base.compile_towers(cfg.MODEL.COMPILE_MODE):
+            raise SystemExit('torch.compile is not available')
+        first = measure(lambda: model(**inputs), 1, device, warmup=0)['median_ms'] / 1e3
+        compiled = measure(lambda: model(**inputs), args.iters, device, warmup=2)['median_ms'] / 1e3
+        actual = model(**inputs)
+    diff = max((expected[key].float() - actual[key].float()).abs().max().item() for key in expected)
+
+    print('batch {} on {}, mode {}'.format(cfg.TEST.IMS_PER_BATCH, device, cfg.MODEL.COMPILE_MODE))
+    print('{:>24} {:>10.1f} ms'.format('eager', eager * 1e3))
+    print('{:>24} {:>10.1f} s'.format('first call (compile)', first))
+    print('{:>24} {:>10.1f} ms {:>6.2f}x'.format('compiled', compiled * 1e3, eager / compiled))
+    print('{:>24} {:>10.2e}'.format('max abs diff', diff))
+    print('{:>24} {:>10.0f} calls'.format('break-even after', max(0., first - compiled) / max(eager - compiled, 1e-9)))
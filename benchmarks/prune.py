@@ -0,0 +1,57 @@
+import os
+import sys
+import argparse
+import os.path as osp
+import torch
+
+sys.path.insert(0, osp.dirname(osp.dirname(osp.abspath(__file__))))
+from config import cfg
+import modeling.meta_arch as meta_arch
+from modeling import make_model
+from utils.inputs import random_inputs, random_clip
+from benchmarks.run import measure
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="IDEA token pruning benchmark (images/sec versus keep ratio)")
+    parser.add_argument(
+        "--config_file", default="", help="path to config file", type=str
+    )
+    parser.add_argument("--keep", default=[1.0, 0.9, 0.7, 0.5, 0.3], nargs='+', type=float,
+                        help="keep ratios to benchmark, 1.0 is the unpruned model")
+    parser.add_argument("--iters", default=10, type=int, help="timed forward passes per keep ratio")
+    parser.add_argument("--layers", default=12, type=int, help="CLIP layers when the weights are random")
+    parser.add_argument("opts", help="Modify config options using the command-line", default=None,
+                        nargs=argparse.REMAINDER)
+
+    args = parser.parse_args()
+
+    if args.config_file != "":
+        cfg.merge_from_file(args.config_file)
+    cfg.merge_from_list(args.opts)
+    if not cfg.MODEL.PRUNE_LAYERS:
+        cfg.MODEL.PRUNE_LAYERS = [3, 6, 9]
+    cfg.freeze()
+    os.environ['CUDA_VISIBLE_DEVICES'] = cfg.MODEL.DEVICE_ID
+    device = cfg.MODEL.DEVICE
+    if not os.path.exists(cfg.MODEL.PRETRAIN_PATH_T):
+        meta_arch.load_clip_to_cpu = random_clip(args.layers)
+
+    model = make_model(cfg, num_class=10, camera_num=1, view_num=1)
+    if cfg.TEST.WEIGHT:
+        model.load_param(cfg.TEST.WEIGHT)
+    model.to(device)
+    model.eval()
+    visual = model.BACKBONE.base.visual
+    inputs = random_inputs(cfg.TEST.IMS_PER_BATCH, cfg.INPUT.SIZE_TEST, device)
+
+    print('pruning before blocks {}, batch {}'.format(sorted(visual.prune_layers), cfg.TEST.IMS_PER_BATCH))
+    print('{:>6} {:>12} {:>10}'.format('keep', 'images/sec', 'speedup'))
+    baseline = None
+    for keep in args.keep:
+        visual.prune_keep = keep
+        with torch.no_grad():
+            median_ms = measure(lambda: model(**inputs), args.iters, device, warmup=2)['median_ms']
+        throughput = cfg.TEST.IMS_PER_BATCH * 1e3 / median_ms
+        baseline = baseline or throughput
+        print('{:>6.2f} {:>12.1f} {:>9.2f}x'.format(keep, throughput, throughput / baseline))
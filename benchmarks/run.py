@@ -0,0 +1,239 @@
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import tempfile
+import contextlib
+import os.path as osp
+import numpy as np
+import torch
+
+sys.path.insert(0, osp.dirname(osp.dirname(osp.abspath(__file__))))
+from config import cfg
+import modeling.meta_arch as meta_arch
+from modeling import make_model
+from modeling.fusion_part.CDA_Module import CDA, FusedCDA
+import data.datasets.make_dataloader as loaders
+from data.datasets.make_dataloader import make_dataloader, train_collate_fn
+from layers.make_loss import make_loss
+from solver.make_optimizer import make_optimizer
+from utils.metrics import eval_func
+from utils.reranking import re_ranking
+from utils.inputs import random_clip
+from benchmarks.synthetic import make_synthetic_dataset, LAYOUTS
+
+
+def measure(fn, iters, device, warmup=1):
+    """Median / mean / min wall time in ms of `iters` calls of fn after `warmup` calls."""
+    for _ in range(warmup):
+        fn()
+    times = []
+    for _ in range(iters):
+        if device == 'cuda':
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        fn()
+        if device == 'cuda':
+            torch.cuda.synchronize()
+        times.append((time.perf_counter() - start) * 1e3)
+    return {'median_ms': float(np.median(times)), 'mean_ms': float(np.mean(times)), 'min_ms': float(np.min(times)),
+            'iters': iters}
+
+
+def capture(module, run):
+    # positional and keyword inputs of the first call of `module` during run()
+    inputs = {}
+
+    def hook(_, args, kwargs):
+        inputs.setdefault('call', (args, kwargs))
+    handle = module.register_forward_pre_hook(hook, with_kwargs=True)
+    try:
+        run()
+    finally:
+        handle.remove()
+    return inputs.get('call')
+
+
+def detached(value):
+    # output tree of the model as grad-requiring leaves, so the loss can be timed on its own
+    if torch.is_tensor(value):
+        return value.detach().float().requires_grad_(value.is_floating_point())
+    if isinstance(value, (list, tuple)):
+        return type(value)(detached(v) for v in value)
+    if isinstance(value, dict):
+        return {k: detached(v) for k, v in value.items()}
+    return value
+
+
+def standalone_cda(cfg, batch, device):
+    # CDA block of a MODEL.DA build (same grid, window and stride as IDEA) and random patch grids / boss tokens
+    q_size = cfg.INPUT.SIZE_TRAIN[0] // 16, cfg.INPUT.SIZE_TRAIN[1] // 16
+    cda = (FusedCDA if cfg.MODEL.DA_FUSED else CDA)(q_size=q_size, window_size=q_size, ksize=4, stride=2,
+                                                     stride_block=q_size, offset_range_factor=cfg.MODEL.OFF_FAC,
+                                                     share=cfg.MODEL.DA_SHARE)
+    grids = [torch.randn(batch, q_size[0] * q_size[1], cda.feat_dim, device=device) for _ in range(3)]
+    boss = torch.randn(batch, 6, cda.feat_dim, device=device)
+    return cda.to(device).eval(), grids + [boss], {}
+
+
+def check_batches(cfg, args):
+    # the identity sampler only forms a batch from IMS_PER_BATCH / NUM_INSTANCE distinct training identities
+    if 'triplet' in cfg.DATALOADER.SAMPLER and args.ids < cfg.SOLVER.IMS_PER_BATCH // cfg.DATALOADER.NUM_INSTANCE:
+        raise ValueError('--ids {} x --imgs {} gives no training batch: SOLVER.IMS_PER_BATCH {} with '
+                         'DATALOADER.NUM_INSTANCE {} needs at least {} identities'.format(
+                             args.ids, args.imgs, cfg.SOLVER.IMS_PER_BATCH, cfg.DATALOADER.NUM_INSTANCE,
+                             cfg.SOLVER.IMS_PER_BATCH // cfg.DATALOADER.NUM_INSTANCE))
+
+
+def to_device(img, text, device):
+    return {k: v.to(device) for k, v in img.items()}, {k: v.to(device) for k, v in text.items()}
+
+
+def run(cfg, args):
+    device = cfg.MODEL.DEVICE
+    results, notes = {}, []
+    quiet = contextlib.redirect_stdout(open(os.devnull, 'w'))
+
+    # data: dataset construction, __getitem__, collation and the identity sampler
+    factory = getattr(loaders, '__factory')[cfg.DATASETS.NAMES]
+    with quiet:
+        results['dataset_construction'] = measure(lambda: factory(root=cfg.DATASETS.ROOT_DIR, cfg=cfg), args.iters,
+                                                  device)
+        train_loader, _, val_loader, num_query, num_classes, camera_num, view_num = make_dataloader(cfg)
+    train_set = train_loader.dataset
+    size = min(len(train_set), cfg.SOLVER.IMS_PER_BATCH)
+    results['getitem'] = measure(lambda: [train_set[i] for i in range(size)], args.iters, device)
+    results['getitem']['items'] = size
+    items = [train_set[i] for i in range(size)]
+    results['collate'] = measure(lambda: train_collate_fn(items), args.iters, device)
+    results['collate']['items'] = size
+    results['sampler_epoch'] = measure(lambda: list(iter(train_loader.sampler)), args.iters, device)
+    results['sampler_epoch']['items'] = len(train_set)
+
+    # model: eval and train forward, the CDA module on its captured inputs, the loss graph, the optimizer
+    torch.manual_seed(args.seed)
+    with quiet:
+        model = make_model(cfg, num_class=num_classes, camera_num=camera_num, view_num=view_num)
+        loss_fn, center_criterion = make_loss(cfg, num_classes=num_classes)
+    model.to(device)
+    model.eval()
+    img, _, camids, _, target_view, img_path, text = next(iter(val_loader))
+    img, text = to_device(img, text, device)
+    camids, target_view = camids.to(device), target_view.to(device)
+
+    def forward_eval():
+        with torch.no_grad():
+            return model(image=img, text=text, cam_label=camids, view_label=target_view, img_path=img_path)
+    results['forward_eval'] = measure(forward_eval, args.iters, device)
+    results['forward_eval']['items'] = camids.size(0)
+    cda = getattr(model, 'CDA', None)
+    if cda is not None:
+        cda_args, cda_kwargs = capture(cda, forward_eval)
+    else:
+        cda, cda_args, cda_kwargs = standalone_cda(cfg, camids.size(0), device)
+        notes.append('MODEL.DA is off, CDA benchmarked standalone on random inputs')
+
+    def run_cda():
+        with torch.no_grad():
+            return cda(*cda_args, **cda_kwargs)
+    results['cda'] = measure(run_cda, args.iters, device)
+    results['cda']['module'] = type(cda).__name__
+
+    model.train()
+    img, target, target_cam, target_view, img_path, text = next(iter(train_loader))
+    img, text = to_device(img, text, device)
+    target, target_cam, target_view = target.to(device), target_cam.to(device), target_view.to(device)
+
+    def forward_train():
+        return model(image=img, text=text, label=target, cam_label=target_cam, view_label=target_view, epoch=1,
+                     img_path=img_path)
+    results['forward_train'] = measure(forward_train, args.iters, device)
+    results['forward_train']['items'] = target.size(0)
+    output = forward_train()
+
+    def loss():
+        return loss_fn.step(detached(output), target, target_cam)
+    results['loss'] = measure(loss, args.iters, device)
+    results['loss_backward'] = measure(lambda: loss().backward(), args.iters, device)
+
+    # optimizer step over every trainable parameter with random gradients
+    with quiet:
+        optimizer, _ = make_optimizer(cfg, model, center_criterion)
+    for p in model.parameters():
+        p.grad = torch.randn_like(p) * 1e-3 if p.requires_grad else None
+    results['optimizer_step'] = measure(optimizer.step, args.iters, device)
+    results['optimizer_step']['items'] = sum(len(group['params']) for group in optimizer.param_groups)
+
+    # evaluation: CMC / mAP of eval_func and k-reciprocal re-ranking
+    rng = np.random.default_rng(args.seed)
+    q_pids, g_pids = rng.integers(0, args.eval_ids, args.query), rng.integers(0, args.eval_ids, args.gallery)
+    q_camids, g_camids = rng.integers(0, 4, args.query), rng.integers(0, 4, args.gallery)
+    distmat = rng.random((args.query, args.gallery), dtype=np.float32)
+    results['eval_func'] = measure(lambda: eval_func(distmat, q_pids, g_pids, q_camids, g_camids), args.iters, 'cpu')
+    results['eval_func']['items'] = [args.query, args.gallery]
+    generator = torch.Generator().manual_seed(args.seed)
+    query = torch.randn(args.query, args.feat_dim, generator=generator)
+    gallery = torch.randn(args.gallery, args.feat_dim, generator=generator)
+    results['re_ranking'] = measure(lambda: re_ranking(query, gallery, k1=50, k2=15, lambda_value=0.3), args.iters,
+                                    'cpu')
+    results['re_ranking']['items'] = [args.query, args.gallery]
+    return results, notes
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="IDEA CPU-runnable benchmark suite on a synthetic dataset")
+    parser.add_argument(
+        "--config_file", default="", help="path to config file", type=str
+    )
+    parser.add_argument("--dataset", default="RGBNT201", choices=sorted(LAYOUTS))
+    parser.add_argument("--root", default="", type=str, help="dataset root, a temporary directory when empty")
+    parser.add_argument("--ids", default=16, type=int, help="synthetic train identities")
+    parser.add_argument("--test_ids", default=8, type=int, help="synthetic test identities")
+    parser.add_argument("--imgs", default=8, type=int, help="synthetic images per identity")
+    parser.add_argument("--cams", default=4, type=int, help="synthetic cameras")
+    parser.add_argument("--layers", default=12, type=int, help="CLIP layers when the weights are random")
+    parser.add_argument("--query", default=500, type=int, help="eval_func / re_ranking queries")
+    parser.add_argument("--gallery", default=2000, type=int, help="eval_func / re_ranking gallery size")
+    parser.add_argument("--eval_ids", default=100, type=int, help="identities of the eval_func ranking")
+    parser.add_argument("--feat_dim", default=512, type=int, help="re_ranking feature size")
+    parser.add_argument("--iters", default=5, type=int, help="timed calls per benchmark")
+    parser.add_argument("--seed", default=0, type=int)
+    parser.add_argument("--output", default="benchmark.json", type=str, help="JSON report")
+    parser.add_argument("opts", help="Modify config options using the command-line", default=None,
+                        nargs=argparse.REMAINDER)
+
+    args = parser.parse_args()
+
+    root = args.root or tempfile.mkdtemp(prefix='idea_bench_')
+    make_synthetic_dataset(args.dataset, root, args.ids, args.test_ids, args.imgs, args.cams, seed=args.seed)
+    if args.config_file != "":
+        cfg.merge_from_file(args.config_file)
+    cfg.merge_from_list(['DATASETS.NAMES', args.dataset, 'DATASETS.ROOT_DIR', root, 'DATALOADER.NUM_WORKERS', 0] +
+                        args.opts)
+    notes = []
+    if cfg.MODEL.DEVICE == 'cuda' and not torch.cuda.is_available():
+        cfg.MODEL.DEVICE = 'cpu'
+    weights = os.path.exists(cfg.MODEL.PRETRAIN_PATH_T)
+    if not weights:
+        meta_arch.load_clip_to_cpu = random_clip(args.layers)
+        notes.append('random {}-layer CLIP, {} not found'.format(args.layers, cfg.MODEL.PRETRAIN_PATH_T))
+    cfg.freeze()
+    check_batches(cfg, args)
+
+    results, run_notes = run(cfg, args)
+    report = {'meta': {'torch': torch.__version__, 'python': platform.python_version(), 'device': cfg.MODEL.DEVICE,
+                       'threads': torch.get_num_threads(), 'dataset': args.dataset, 'ids': args.ids,
+                       'test_ids': args.test_ids, 'imgs_per_id': args.imgs, 'batch': cfg.SOLVER.IMS_PER_BATCH,
+                       'test_batch': cfg.TEST.IMS_PER_BATCH, 'clip_weights': weights, 'seed': args.seed,
+                       'notes': notes + run_notes},
+              'results': results}
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+
+    print('{} on {}, report in {}'.format(args.dataset, cfg.MODEL.DEVICE, args.output))
+    for name, result in results.items():
+        print('{:>22} {:>10.2f} ms median {:>10.2f} ms mean'.format(name, result['median_ms'], result['mean_ms']))
+    for note in notes + run_notes:
+        print('note: ' + note)
@@ -0,0 +1,169 @@
+import os
+import json
+import random
+import argparse
+import os.path as osp
+import numpy as np
+from PIL import Image
+
+# caption vocabulary, QwenVL_Anno-like sentences
+SUBJECTS = {'person': ['The man', 'The woman', 'The pedestrian', 'The person'],
+            'vehicle': ['The vehicle', 'The car', 'The truck', 'The van']}
+COLORS = ['white', 'black', 'red', 'blue', 'gray', 'green', 'yellow', 'brown', 'silver', 'dark']
+DETAILS = {'person': ['is wearing a {} jacket and {} trousers.', 'is carrying a {} backpack and wears {} shoes.',
+                      'has {} hair and a {} shirt.', 'is walking with a {} bag on the {} side.'],
+           'vehicle': ['is {} with {} windows.', 'has a {} roof and {} wheels.',
+                       'shows a {} body and {} bumpers.', 'is a {} sedan with a {} license plate.']}
+MODALITY_NOTES = {'RGB': 'The colors are clearly visible.', 'NI': 'The near infrared view shows strong contrast.',
+                  'TI': 'The thermal view shows warm regions around the engine or body.'}
+
+
+def caption(rng, kind, modality, length=3):
+    subject = rng.choice(SUBJECTS[kind])
+    sentences = [subject + ' ' + rng.choice(DETAILS[kind]).format(rng.choice(COLORS), rng.choice(COLORS))
+                 for _ in range(length)]
+    return ' '.join(sentences + [MODALITY_NOTES[modality]])
+
+
+def write_image(path, rng, size, base):
+    # identity colour plus noise, so that JPEG decoding costs what a real crop costs
+    width, height = size
+    noise = np.asarray(rng.integers(0, 64, (height, width, 3)), dtype=np.int16)
+    pixels = np.clip(base + noise - 32, 0, 255).astype(np.uint8)
+    os.makedirs(osp.dirname(path), exist_ok=True)
+    Image.fromarray(pixels).save(path, quality=90)
+
+
+def split_ids(num_ids, test_ids, first=1):
+    # disjoint train / test identities
+    train = list(range(first, first + num_ids))
+    test = list(range(first + num_ids, first + num_ids + test_ids))
+    return train, test
+
+
+def dump_annotations(text_dir, prefix, annotations):
+    os.makedirs(text_dir, exist_ok=True)
+    for modality in ('RGB', 'NI', 'TI'):
+        with open(osp.join(text_dir, '{}_{}.json'.format(prefix, modality)), 'w') as f:
+            json.dump([{'item': name, 'description': text[modality]} for name, text in annotations], f)
+
+
+def write_rgbnt201(root, num_ids, test_ids, imgs_per_id, num_cams, seed=0, **kwargs):
+    """RGBNT201/{train_171,test}/{RGB,NI,TI}/000001_cam1_0_00.jpg (256x128), RGBNT201/text/{train,test}_{RGB,NI,TI}.json"""
+    rng, text_rng = np.random.default_rng(seed), random.Random(seed)
+    dataset_dir = osp.join(root, 'RGBNT201')
+    train, test = split_ids(num_ids, test_ids)
+    for split, pids in (('train_171', train), ('test', test)):
+        annotations = []
+        for pid in pids:
+            base = rng.integers(0, 256, 3)
+            for n in range(imgs_per_id):
+                name = '{:06d}_cam{}_0_{:02d}.jpg'.format(pid, n % num_cams + 1, n)
+                for modality in ('RGB', 'NI', 'TI'):
+                    write_image(osp.join(dataset_dir, split, modality, name), rng, (128, 256), base)
+                annotations.append((name, {m: caption(text_rng, 'person', m) for m in ('RGB', 'NI', 'TI')}))
+        dump_annotations(osp.join(dataset_dir, 'text'), 'train' if 'train' in split else 'test', annotations)
+    return dataset_dir
+
+
+def write_rgbnt100(root, num_ids, test_ids, imgs_per_id, num_cams, query_per_id=1, seed=0, **kwargs):
+    """RGBNT100/rgbir/{bounding_box_train,query,bounding_box_test}/0001_c0001_000.jpg, RGB|NI|TI stitched (768x128)"""
+    rng, text_rng = np.random.default_rng(seed), random.Random(seed)
+    dataset_dir = osp.join(root, 'RGBNT100', 'rgbir')
+    train, test = split_ids(num_ids, test_ids)
+    annotations = {'train': [], 'test': []}
+    for pid in train + test:
+        base = rng.integers(0, 256, 3)
+        for n in range(imgs_per_id):
+            if pid in train:
+                split = 'bounding_box_train'
+            else:
+                split = 'query' if n < query_per_id else 'bounding_box_test'
+            name = '{:04d}_c{:04d}_{:03d}.jpg'.format(pid, n % min(num_cams, 8) + 1, n)
+            write_image(osp.join(dataset_dir, split, name), rng, (768, 128), base)
+            annotations['train' if pid in train else 'test'].append(
+                (name, {m: caption(text_rng, 'vehicle', m) for m in ('RGB', 'NI', 'TI')}))
+    for prefix, items in annotations.items():
+        dump_annotations(osp.join(dataset_dir, 'text'), prefix, items)
+    return dataset_dir
+
+
+def write_msvr310(root, num_ids, test_ids, imgs_per_id, num_cams, query_per_id=1, seed=0, **kwargs):
+    """MSVR310/{bounding_box_train,query3,bounding_box_test}/0001/{vis,ni,th}/0001_s001_v0_000.jpg, MSVR310/text"""
+    rng, text_rng = np.random.default_rng(seed), random.Random(seed)
+    dataset_dir = osp.join(root, 'MSVR310')
+    train, test = split_ids(num_ids, test_ids)
+    annotations = {'train': [], 'test': []}
+    for pid in train + test:
+        base = rng.integers(0, 256, 3)
+        for n in range(imgs_per_id):
+            if pid in train:
+                split = 'bounding_box_train'
+            else:
+                split = 'query3' if n < query_per_id else 'bounding_box_test'
+            name = '{:04d}_s{:03d}_v{}_{:03d}.jpg'.format(pid, n // num_cams + 1, n % min(num_cams, 8), n)
+            for folder in ('vis', 'ni', 'th'):
+                write_image(osp.join(dataset_dir, split, '{:04d}'.format(pid), folder, name), rng, (128, 128), base)
+            annotations['train' if pid in train else 'test'].append(
+                (name, {m: caption(text_rng, 'vehicle', m) for m in ('RGB', 'NI', 'TI')}))
+    for prefix, items in annotations.items():
+        dump_annotations(osp.join(dataset_dir, 'text'), prefix, items)
+    return dataset_dir
+
+
+def write_mars(root, num_ids, test_ids, imgs_per_id, num_cams, query_per_id=1, seed=0, **kwargs):
+    """marslite/{train,querymm,test}/{RGB,IR,Thermal}/0001_c1_t0000_f000_m{1,2,3}.jpg, marslite/text_update"""
+    rng, text_rng = np.random.default_rng(seed), random.Random(seed)
+    dataset_dir = osp.join(root, 'marslite')
+    train, test = split_ids(num_ids, test_ids)
+    annotations = {'train': [], 'test': []}
+    for pid in train + test:
+        base = rng.integers(0, 256, 3)
+        for n in range(imgs_per_id):
+            if pid in train:
+                split = 'train'
+            else:
+                split = 'querymm' if n < query_per_id else 'test'
+            stem = '{:04d}_c{}_t{:04d}_f{:03d}'.format(pid, n % min(num_cams, 9) + 1, n, n)
+            for folder, suffix in (('RGB', '_m1'), ('IR', '_m2'), ('Thermal', '_m3')):
+                write_image(osp.join(dataset_dir, split, folder, stem + suffix + '.jpg'), rng, (128, 256), base)
+            # only RGB images are annotated, every modality shares the caption
+            annotations['train' if pid in train else 'test'].append(
+                {'img_path': '{}/RGB/{}_m1.jpg'.format(split, stem), 'captions': [caption(text_rng, 'person', 'RGB')]})
+    text_dir = osp.join(dataset_dir, 'text_update')
+    os.makedirs(text_dir, exist_ok=True)
+    for prefix, items in annotations.items():
+        with open(osp.join(text_dir, '{}_annotations.json'.format(prefix)), 'w') as f:
+            json.dump(items, f)
+    return dataset_dir
+
+
+# DATASETS.NAMES -> writer of its on-disk layout
+LAYOUTS = {'RGBNT201': write_rgbnt201, 'RGBNT100': write_rgbnt100, 'MSVR310': write_msvr310, 'MARS': write_mars}
+
+
+def make_synthetic_dataset(name, root, num_ids=20, test_ids=10, imgs_per_id=8, num_cams=4, query_per_id=1, seed=0):
+    """
+    Write a synthetic dataset in the layout read by the DATASETS.NAMES=`name` class under `root` (DATASETS.ROOT_DIR).
+    num_ids train identities and test_ids test identities with imgs_per_id RGB/NI/TI triplets each, spread over
+    num_cams cameras; query_per_id test images per identity go to the query split of layouts that have one.
+    Returns the dataset directory.
+    """
+    if name not in LAYOUTS:
+        raise KeyError('No synthetic layout for {}, expected one of {}'.format(name, sorted(LAYOUTS)))
+    return LAYOUTS[name](root, num_ids=num_ids, test_ids=test_ids, imgs_per_id=imgs_per_id, num_cams=num_cams,
+                         query_per_id=query_per_id, seed=seed)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Write a synthetic multi-modal ReID dataset")
+    parser.add_argument("--dataset", default="RGBNT201", choices=sorted(LAYOUTS))
+    parser.add_argument("--root", required=True, type=str, help="DATASETS.ROOT_DIR to write into")
+    parser.add_argument("--ids", default=20, type=int, help="train identities")
+    parser.add_argument("--test_ids", default=10, type=int, help="test identities")
+    parser.add_argument("--imgs", default=8, type=int, help="images per identity")
+    parser.add_argument("--cams", default=4, type=int, help="cameras")
+    parser.add_argument("--seed", default=0, type=int)
+    args = parser.parse_args()
+    print(make_synthetic_dataset(args.dataset, args.root, args.ids, args.test_ids, args.imgs, args.cams,
+                                 seed=args.seed))
@@ -19,6 +19,7 @@ _C.MODEL.IF_LABELSMOOTH = 'on'  # Whether to use label smoothing (options: 'on'
 _C.MODEL.SDM_LOSS_WEIGHT = 0.5 #SDM loss weight
 _C.MODEL.CMPC_LOSS_WEIGHT = 0 #cmpc loss weight
 _C.MODEL.ITC_LOSS_WEIGHT = 0.5 #ITC loss
+_C.MODEL.MEMORY_SIZE = 0  # Cross-batch memory of image/text features used as extra SDM/ITC keys (0 disables)
 # Borrowed from MambaPro
 _C.MODEL.PROMPT = False  # Whether to enable prompt tuning
 _C.MODEL.ADAPTER = False  # Whether to enable adapter tuning
@@ -44,6 +45,7 @@ _C.MODEL.TEXT_PROMPT = 2  # Number of learnable text prompts in InverseNet
 _C.MODEL.INVERSE = True  # Whether to use the inverse network in IMFE
 _C.MODEL.DA = True  # Whether to use deformable aggregation
 _C.MODEL.DA_SHARE = False  # Whether to share offsets across modalities
+_C.MODEL.DA_FUSED = True  # Whether to use the vectorized CDA (same weights as the per-block reference)
 _C.MODEL.OFF_FAC = 5.0  # Offset factor to control offset magnitude
 
 
@@ -52,11 +54,22 @@ _C.MODEL.MULTI_SCALE = True  # 是否启用多尺度特征
 _C.MODEL.INTERMEDIATE_LAYER_IDX = -4  # 中间特征提取层（倒数第4层）
 _C.MODEL.SCALE_CONSISTENCY_WEIGHT = 0.4  # 尺度一致性损失权重
 
+# Patch-token pruning in the CLIP ViT (FORWARD 'old')
+_C.MODEL.PRUNE_LAYERS = []  # Blocks before which the patch tokens are pruned, e.g. [3, 6, 9] (empty disables pruning)
+_C.MODEL.PRUNE_KEEP = 0.7  # Fraction of the remaining patch tokens kept at each pruning block
+# torch.compile of the CLIP towers
+_C.MODEL.COMPILE = False  # Whether to run the visual and text towers through torch.compile (eager fallback on failure)
+_C.MODEL.COMPILE_MODE = 'default'  # torch.compile mode (options: 'default', 'reduce-overhead', 'max-autotune')
+# Activation (gradient) checkpointing
+_C.MODEL.GRAD_CKPT = 0  # Checkpoint every k-th block of the visual and text towers while training (0 disables, 1 every block)
+
 
 # ===================== INPUT CONFIGURATION =====================
 _C.INPUT = CN()
 _C.INPUT.SIZE_TRAIN = [256, 128]  # Image size during training
 _C.INPUT.SIZE_TEST = [256, 128]  # Image size during testing
+_C.INPUT.SIZE_NI = []  # Input size of the NIR tower (height, width), empty means the same as SIZE_TRAIN
+_C.INPUT.SIZE_TI = []  # Input size of the TIR tower (height, width), empty means the same as SIZE_TRAIN
 _C.INPUT.PROB = 0.5  # Probability for random horizontal flip
 _C.INPUT.RE_PROB = 0.5  # Probability for random erasing
 _C.INPUT.PIXEL_MEAN = [0.5, 0.5, 0.5]  # Mean values for image normalization
@@ -77,6 +90,7 @@ _C.DATALOADER.NUM_INSTANCE = 8  # Number of instances per batch
 # ===================== SOLVER CONFIGURATION =====================
 _C.SOLVER = CN()
 _C.SOLVER.OPTIMIZER_NAME = "Adam"  # Name of optimizer
+_C.SOLVER.FUSED_OPTIMIZER = True  # Use the fused (else foreach) multi-tensor kernels of the optimizer when available
 _C.SOLVER.MAX_EPOCHS = 50  # Maximum number of training epochs
 _C.SOLVER.BASE_LR = 0.00035  # Base learning rate
 _C.SOLVER.LARGE_FC_LR = False  # Whether to use a larger learning rate for fully connected layers
@@ -103,8 +117,18 @@ _C.SOLVER.COSINE_SCALE = 30  # Scale for cosine loss
 _C.SOLVER.SEED = 1111  # Random seed for reproducibility
 _C.MODEL.NO_MARGIN = True  # Whether to disable margin
 _C.SOLVER.CHECKPOINT_PERIOD = 50  # Period for saving checkpoints
+_C.SOLVER.CHECKPOINT_KEEP = 3  # Number of periodic checkpoints kept on disk (0 keeps all), the best one is always kept
+_C.SOLVER.CHECKPOINT_ITERS = 0  # Also checkpoint every N iterations inside an epoch (not with DIST_TRAIN), 0 disables
+_C.SOLVER.CHECKPOINT_DELTA = False  # Checkpoints leave out the frozen pretrained CLIP weights and hold a hash of them instead (MODEL.FROZEN runs)
 _C.SOLVER.LOG_PERIOD = 10  # Period for logging training progress
+_C.SOLVER.STEP_TIMER = False  # Time every training step with CUDA events, reported at each LOG_PERIOD
+_C.SOLVER.TELEMETRY = False  # Per-stage step telemetry (data/h2d/forward/loss/backward/optimizer, towers, eval patterns) to OUTPUT_DIR/telemetry.jsonl and TensorBoard
+_C.SOLVER.TELEMETRY_PERIOD = 50  # Instrument one training step out of every N
 _C.SOLVER.EVAL_PERIOD = 1  # Period for evaluation
+_C.SOLVER.EVAL_FULL_PERIOD = 0  # Full evaluation every N epochs and at the last one, proxy evaluation at the other EVAL_PERIOD epochs; 0 makes every evaluation full
+_C.SOLVER.EVAL_PROXY_IDS = 50  # Identities of the fixed proxy evaluation subset, stratified by gallery size
+_C.SOLVER.EVAL_ASYNC = ''  # Evaluate a CPU weight snapshot in the background while training continues (options: '', 'thread', 'process')
+_C.SOLVER.EVAL_DEVICE = ''  # Device of the background evaluation, empty for the training device
 _C.SOLVER.IMS_PER_BATCH = 64  # Number of images per batch
 
 # ===================== TEST CONFIGURATION =====================
@@ -114,7 +138,15 @@ _C.TEST.RE_RANKING = 'no'  # Whether to use re-ranking (options: 'yes', 'no')
 _C.TEST.WEIGHT = ""  # Path to the trained model weights
 _C.TEST.NECK_FEAT = 'before'  # Which BNNeck feature to use for testing (options: 'before' or 'after')
 _C.TEST.FEAT_NORM = 'yes'  # Whether to normalize features before testing
+_C.TEST.PRECISION = 'fp32'  # Evaluation forward pass (autocast) and stored feature precision (options: 'fp32', 'fp16', 'bf16'), distances stay fp32
 _C.TEST.MISS = 'None'  # Modality missing pattern (options: 'None', 'r', 'n', 't', 'rn', 'rt', 'nt')
+_C.TEST.MISS_SWEEP = []  # Missing patterns evaluated in one run by test.py, e.g. ['None', 'r', 'n', 't', 'rn', 'rt', 'nt']
+_C.TEST.CASCADE = False  # Whether to run cascade retrieval (shortlist with the intermediate features, then re-encode)
+_C.TEST.CASCADE_TOPN = [10, 50, 100]  # Shortlist sizes reported by the cascade retrieval
+_C.TEST.CASCADE_FEAT = 'LOCAL_v'  # Fine feature used to rank the shortlist
+_C.TEST.QUANT = ''  # Post-training int8 evaluation on CPU against fp32 (options: '', 'dynamic', 'static')
+_C.TEST.QUANT_CALIB = 256  # Number of val_loader samples used to calibrate the static int8 activations
+_C.TEST.QUANT_BACKEND = 'x86'  # Quantized engine (options: 'x86', 'fbgemm', 'qnnpack', 'onednn')
 
 # ===================== MISC OPTIONS =====================
 _C.OUTPUT_DIR = "./IDEA"  # Output directory for checkpoints and logs
\ No newline at end of file
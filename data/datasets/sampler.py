@@ -25,6 +25,9 @@ class RandomIdentitySampler(Sampler):
         for index, (_, pid, _, _,_,_,_) in enumerate(self.data_source):
             self.index_dic[pid].append(index)
         self.pids = list(self.index_dic.keys())
+        # order of the current epoch, and a saved position to continue from (see state_dict)
+        self.indices = None
+        self.resume = None
 
         # estimate number of examples in an epoch
         self.length = 0
@@ -36,6 +39,11 @@ class RandomIdentitySampler(Sampler):
             self.length += num - num % self.num_instances
 
     def __iter__(self):
+        if self.resume is not None:
+            # rest of the epoch that was interrupted, without drawing from the RNGs
+            self.indices, start = self.resume['indices'], self.resume['consumed']
+            self.resume = None
+            return iter(self.indices[start:])
         batch_idxs_dict = defaultdict(list)
 
         for pid in self.pids:
@@ -61,7 +69,18 @@ class RandomIdentitySampler(Sampler):
                 if len(batch_idxs_dict[pid]) == 0:
                     avai_pids.remove(pid)
 
+        self.indices = [int(idx) for idx in final_idxs]
         return iter(final_idxs)
 
     def __len__(self):
         return self.length
+
+    def state_dict(self, consumed):
+        # position in the current epoch after `consumed` samples, None at the end of the epoch
+        if self.indices is None or consumed >= len(self.indices):
+            return None
+        return {'indices': list(self.indices), 'consumed': consumed}
+
+    def load_state_dict(self, state):
+        # the next __iter__ continues the saved epoch
+        self.resume = state
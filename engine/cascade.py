@@ -0,0 +1,178 @@
+import time
+import numpy as np
+import torch
+from torch.utils.data import DataLoader, Subset
+from engine.processor import extract_features, eval_autocast
+from utils.metrics import euclidean_distance, eval_func, eval_func_msrv
+
+
+def _clock(device):
+    if device == 'cuda':
+        torch.cuda.synchronize()
+    return time.time()
+
+
+class CascadeStore():
+    """
+    Two feature tiers for cascade retrieval.
+    coarse: fused intermediate-layer features of every sample, used for the shortlist.
+    fine: the TEST.CASCADE_FEAT feature of the eval forward, only computed (from the images of val_loader) for the
+    queries and the shortlisted gallery samples and memoised per sample. Memory is one feature vector per sample of
+    each tier, no tower states are kept.
+    """
+
+    def __init__(self, cfg, model, val_loader, device, feat='LOCAL_v', feat_norm=True):
+        self.cfg = cfg
+        self.model = model
+        self.val_loader = val_loader
+        self.device = device
+        self.feat = feat
+        self.feat_norm = feat_norm
+        self.reset()
+
+    def reset(self):
+        self.coarse = []
+        self.pids = []
+        self.camids = []
+        self.sceneids = []
+        self.fine_cache = {}
+
+    def add(self, coarse, pid, camid, sceneid=None):
+        self.coarse.append(coarse.float().cpu())
+        self.pids.extend(np.asarray(pid))
+        self.camids.extend(np.asarray(camid))
+        if sceneid is not None:
+            self.sceneids.extend(np.asarray(sceneid))
+
+    def finalize(self):
+        # merge the per-batch chunks once encoding is done
+        self.coarse = torch.cat(self.coarse, dim=0)
+        if self.feat_norm:
+            self.coarse = torch.nn.functional.normalize(self.coarse, dim=1, p=2)
+
+    def __len__(self):
+        return self.coarse.shape[0]
+
+    def memory_bytes(self):
+        # bytes held by both tiers
+        size = self.coarse.numel() * self.coarse.element_size()
+        return size + sum(row.numel() * row.element_size() for row in self.fine_cache.values())
+
+    def drop_fine(self, indices):
+        for index in indices:
+            self.fine_cache.pop(int(index), None)
+
+    def fine(self, indices):
+        """Fine features for the given sample indices, the eval forward only runs for the ones not cached yet."""
+        indices = [int(index) for index in indices]
+        missing = [index for index in indices if index not in self.fine_cache]
+        if missing:
+            loader = DataLoader(Subset(self.val_loader.dataset, missing), batch_size=self.val_loader.batch_size,
+                                shuffle=False, num_workers=self.val_loader.num_workers,
+                                collate_fn=self.val_loader.collate_fn)
+            evaluator, _ = extract_features(self.cfg, self.model, loader, 0, self.device)
+            feat = evaluator.feats[self.feat].float()
+            if self.feat_norm:
+                feat = torch.nn.functional.normalize(feat, dim=1, p=2)
+            self.fine_cache.update(zip(missing, feat))
+        if not indices:
+            return torch.zeros(0, self.coarse.shape[1])
+        return torch.stack([self.fine_cache[index] for index in indices], dim=0)
+
+    def shortlist(self, num_query, topn):
+        """Coarse query-gallery distances and the indices (into the gallery) of the top-N candidates per query."""
+        coarse_dist = torch.from_numpy(euclidean_distance(self.coarse[:num_query], self.coarse[num_query:]))
+        topn = min(topn, coarse_dist.shape[1])
+        candidates = torch.topk(coarse_dist, topn, dim=1, largest=False).indices
+        return coarse_dist, candidates
+
+    def rerank(self, num_query, coarse_dist, candidates):
+        """
+        Distance matrix of the cascade: shortlisted entries carry fine distances, every other gallery entry keeps
+        its coarse distance shifted behind the shortlist, so the ranking outside the top-N is the coarse one.
+        """
+        qf = self.fine(range(num_query))
+        gallery = torch.unique(candidates)
+        gf = self.fine(gallery + num_query)
+        fine_dist = torch.from_numpy(euclidean_distance(qf, gf))
+        position = torch.full((coarse_dist.shape[1],), -1, dtype=torch.long)
+        position[gallery] = torch.arange(gallery.numel())
+        distmat = coarse_dist - coarse_dist.min() + fine_dist.max() + 1
+        distmat.scatter_(1, candidates, torch.gather(fine_dist, 1, position[candidates]))
+        return distmat.numpy()
+
+    def evaluate(self, num_query, distmat):
+        q_pids, g_pids = np.asarray(self.pids[:num_query]), np.asarray(self.pids[num_query:])
+        q_camids, g_camids = np.asarray(self.camids[:num_query]), np.asarray(self.camids[num_query:])
+        if self.sceneids:
+            q_sceneids, g_sceneids = np.asarray(self.sceneids[:num_query]), np.asarray(self.sceneids[num_query:])
+            return eval_func_msrv(distmat, q_pids, g_pids, q_camids, g_camids, q_sceneids, g_sceneids)
+        return eval_func(distmat, q_pids, g_pids, q_camids, g_camids)
+
+
+def do_cascade_inference(cfg,
+                         model,
+                         val_loader,
+                         num_query, logger):
+    """
+    Cascade retrieval: all samples are encoded up to INTERMEDIATE_LAYER_IDX, the gallery is shortlisted with
+    the fused intermediate features and the full eval forward only runs for the queries and the top-N candidates.
+    Reports latency versus mAP for every N in TEST.CASCADE_TOPN, next to the exhaustive search: the features of
+    do_inference (extract_features on the whole val_loader) ranked with TEST.CASCADE_FEAT.
+    """
+    if not cfg.MODEL.MULTI_SCALE or cfg.MODEL.FORWARD == 'new' or \
+            model.BACKBONE.base.visual.intermediate_split() is None:
+        raise ValueError('Cascade retrieval needs MODEL.MULTI_SCALE, MODEL.FORWARD old and an '
+                         'INTERMEDIATE_LAYER_IDX inside the visual transformer for its coarse tier')
+    device = cfg.MODEL.DEVICE
+    logger.info("Enter cascade inferencing")
+    model.to(device)
+    model.eval()
+    store = CascadeStore(cfg, model, val_loader, device, feat=cfg.TEST.CASCADE_FEAT,
+                         feat_norm=cfg.TEST.FEAT_NORM == 'yes')
+
+    start = _clock(device)
+    for n_iter, (img, pid, camid, camids, target_view, imgpath, text) in enumerate(val_loader):
+        with torch.no_grad():
+            img = {'RGB': img['RGB'].to(device),
+                   'NI': img['NI'].to(device),
+                   'TI': img['TI'].to(device)}
+            camids = camids.to(device)
+            with eval_autocast(cfg, device):
+                coarse = model.encode_coarse(img, cam_label=camids)
+            sceneids = target_view if cfg.DATASETS.NAMES == "MSVR310" else None
+            store.add(coarse, pid, camid, sceneids)
+    store.finalize()
+    coarse_time = _clock(device) - start
+    num_gallery = len(store) - num_query
+    logger.info('Coarse tier: {} samples up to layer {} in {:.2f}s'.format(
+        len(store), cfg.MODEL.INTERMEDIATE_LAYER_IDX, coarse_time))
+
+    start = _clock(device)
+    store.fine(range(num_query))
+    query_time = _clock(device) - start
+
+    results = []
+    for topn in cfg.TEST.CASCADE_TOPN:
+        store.drop_fine(range(num_query, len(store)))
+        start = _clock(device)
+        coarse_dist, candidates = store.shortlist(num_query, topn)
+        distmat = store.rerank(num_query, coarse_dist, candidates)
+        search_time = _clock(device) - start
+        cmc, mAP = store.evaluate(num_query, distmat)
+        results.append((min(topn, num_gallery), torch.unique(candidates).numel(),
+                        coarse_time + query_time + search_time, mAP, cmc))
+    logger.info('Both tiers hold {:.1f} MB'.format(store.memory_bytes() / 1024 ** 2))
+
+    # exhaustive baseline: the real eval forward on every sample, as do_inference
+    start = _clock(device)
+    evaluator, _ = extract_features(cfg, model, val_loader, num_query, device)
+    cmc, mAP = evaluator.compute(query=[cfg.TEST.CASCADE_FEAT], gallery=[cfg.TEST.CASCADE_FEAT])[:2]
+    results.append((num_gallery, num_gallery, _clock(device) - start, mAP, cmc))
+
+    logger.info('Cascade retrieval on {} ({} query / {} gallery), last row is the exhaustive search'.format(
+        cfg.TEST.CASCADE_FEAT, num_query, num_gallery))
+    logger.info('{:>8} {:>10} {:>10} {:>8} {:>8}'.format('top-N', 're-encoded', 'latency', 'mAP', 'Rank-1'))
+    for topn, encoded, latency, mAP, cmc in results:
+        logger.info('{:>8} {:>10} {:>9.2f}s {:>8.1%} {:>8.1%}'.format(topn, encoded, latency, mAP, cmc[0]))
+    return results
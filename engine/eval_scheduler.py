@@ -0,0 +1,212 @@
+import copy
+import time
+import queue
+import random
+import logging
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+from torch.utils.data import DataLoader
+from data.datasets.bases import ImageDataset
+from engine.processor import training_neat_eval, make_evaluator
+from utils.checkpoint import to_cpu
+
+EVAL_MODES = ('', 'thread', 'process')
+
+
+def proxy_subset(items, num_query, num_ids, seed=0):
+    """
+    Query and gallery items (query first, as in val_loader) of `num_ids` identities that have both: identities are
+    ranked by gallery size and one is drawn from each of `num_ids` equal strata, so rare and frequent identities are
+    both represented. The draw only depends on `seed`. Returns the items and the number of query items.
+    """
+    query, gallery = items[:num_query], items[num_query:]
+    counts = Counter(item[1] for item in gallery)
+    pids = sorted({item[1] for item in query} & set(counts))
+    if num_ids <= 0 or num_ids >= len(pids):
+        return list(items), num_query
+    rng = random.Random(seed)
+    ranked = sorted(pids, key=lambda pid: (counts[pid], pid))
+    chosen = {ranked[rng.choice(stratum.tolist())] for stratum in np.array_split(np.arange(len(ranked)), num_ids)}
+    query = [item for item in query if item[1] in chosen]
+    gallery = [item for item in gallery if item[1] in chosen]
+    return query + gallery, len(query)
+
+
+def eval_loader(dataset, val_loader):
+    # loader of `dataset` with the batching of val_loader
+    return DataLoader(dataset, batch_size=val_loader.batch_size, shuffle=False, num_workers=val_loader.num_workers,
+                      collate_fn=val_loader.collate_fn)
+
+
+def evaluate(cfg, model, loader, evaluator, device, epoch, logger, telemetry=None):
+    start = time.time()
+    mAP, cmc = training_neat_eval(cfg, model, loader, device, evaluator, epoch, logger, telemetry=telemetry)
+    return mAP, cmc, time.time() - start
+
+
+def eval_process(cfg, model, datasets, batch_size, num_workers, collate_fn, device, tasks, results):
+    # EVAL_ASYNC='process' worker: (epoch, kind, weights, strict) from tasks, (epoch, kind, mAP, cmc, seconds) back
+    logger = logging.getLogger("IDEA.eval")
+    model.to(device)
+    loaders, evaluators = {}, {}
+    for kind, (dataset, num_query) in datasets.items():
+        loaders[kind] = DataLoader(dataset, batch_size=batch_size, shuffle=False, num_workers=num_workers,
+                                   collate_fn=collate_fn)
+        evaluators[kind] = make_evaluator(cfg, num_query, loaders[kind])
+    for epoch, kind, weights, strict in iter(tasks.get, None):
+        model.load_state_dict(weights, strict=strict)
+        results.put((epoch, kind) + evaluate(cfg, model, loaders[kind], evaluators[kind], device, epoch, logger))
+
+
+class EvalScheduler(object):
+    """
+    Evaluation during training. An evaluation is due every SOLVER.EVAL_PERIOD epochs: a full one every
+    SOLVER.EVAL_FULL_PERIOD epochs and at the last epoch, a proxy one otherwise, on the query and gallery images of
+    SOLVER.EVAL_PROXY_IDS identities (see proxy_subset, fixed for the run). EVAL_FULL_PERIOD 0 keeps every
+    evaluation full.
+
+    SOLVER.EVAL_ASYNC '' evaluates the live model on the training thread. 'thread' and 'process' evaluate a CPU
+    snapshot of the weights on a replica of the model, on a background thread or in a spawned process, on
+    SOLVER.EVAL_DEVICE; training goes on meanwhile. Results come out of `poll` / `wait` tagged with the epoch of the
+    weights, in submission order. A background full evaluation keeps the training state it was submitted with, so
+    that the best checkpoint holds the weights of the epoch that scored.
+    """
+
+    def __init__(self, cfg, model, val_loader, num_query, device, logger=None):
+        self.cfg = cfg
+        self.period = cfg.SOLVER.EVAL_PERIOD
+        self.full_period = cfg.SOLVER.EVAL_FULL_PERIOD
+        self.max_epochs = cfg.SOLVER.MAX_EPOCHS
+        self.mode = cfg.SOLVER.EVAL_ASYNC
+        if self.mode not in EVAL_MODES:
+            raise ValueError('Unknown SOLVER.EVAL_ASYNC {}, expected one of {}'.format(self.mode, EVAL_MODES))
+        self.train_device = device
+        self.device = cfg.SOLVER.EVAL_DEVICE or device
+        # under DDP rank 0 evaluates, the other ranks never have an evaluation due
+        self.enabled = not (torch.distributed.is_available() and torch.distributed.is_initialized() and
+                            torch.distributed.get_rank() != 0)
+        self.logger = logger or logging.getLogger("IDEA.eval")
+        self.datasets = {'full': (val_loader.dataset, num_query)}
+        if self.full_period > 0:
+            items, proxy_query = proxy_subset(val_loader.dataset.dataset, num_query, cfg.SOLVER.EVAL_PROXY_IDS,
+                                              seed=cfg.SOLVER.SEED)
+            self.datasets['proxy'] = (ImageDataset(items, val_loader.dataset.transform), proxy_query)
+            self.logger.info('Proxy evaluation on {} query / {} gallery images of {} identities'.format(
+                proxy_query, len(items) - proxy_query, len({item[1] for item in items[:proxy_query]})))
+        self.loaders = {kind: val_loader if kind == 'full' else eval_loader(dataset, val_loader)
+                        for kind, (dataset, _) in self.datasets.items()}
+        self.evaluators = {}
+        self.results = []
+        self.states = {}
+        self.pending = []
+        self.process = None
+        if self.enabled and self.mode:
+            # the replica is copied before the telemetry hooks the CLIP towers of the live model
+            replica = copy.deepcopy(getattr(model, 'module', model)).to('cpu').eval()
+        if self.enabled and self.mode == 'thread':
+            self.replica = replica.to(self.device)
+            self.executor = ThreadPoolExecutor(max_workers=1)
+            self.stream = torch.cuda.Stream(self.device) if torch.device(self.device).type == 'cuda' else None
+        elif self.enabled and self.mode == 'process':
+            context = mp.get_context('spawn')
+            self.tasks, self.done = context.Queue(), context.Queue()
+            self.process = context.Process(target=eval_process, args=(
+                cfg, replica, self.datasets, val_loader.batch_size, val_loader.num_workers, val_loader.collate_fn,
+                self.device, self.tasks, self.done))
+            self.process.start()
+
+    @property
+    def background(self):
+        return bool(self.mode)
+
+    def kind(self, epoch):
+        """'full', 'proxy' or None (no evaluation) for the end of `epoch`."""
+        if not self.enabled or epoch % self.period:
+            return None
+        if self.full_period <= 0 or epoch % self.full_period == 0 or epoch == self.max_epochs:
+            return 'full'
+        return 'proxy'
+
+    def evaluator(self, kind):
+        if kind not in self.evaluators:
+            self.evaluators[kind] = make_evaluator(self.cfg, self.datasets[kind][1], self.loaders[kind])
+        return self.evaluators[kind]
+
+    def submit(self, model, epoch, kind, state=None, telemetry=None):
+        """
+        Evaluate `model` as of the end of `epoch`. In the background modes `state` (CheckpointManager.state,
+        None = the model weights only) is snapshot to CPU first, its `model` entry is what gets evaluated.
+        """
+        if not self.mode:
+            mAP, cmc, seconds = evaluate(self.cfg, model, self.loaders[kind], self.evaluator(kind),
+                                         self.train_device, epoch, self.logger, telemetry=telemetry)
+            self.results.append({'epoch': epoch, 'kind': kind, 'mAP': mAP, 'cmc': cmc, 'seconds': seconds})
+            return
+        if state is None:
+            state = {'model': getattr(model, 'module', model).state_dict()}
+        snapshot = to_cpu(state)
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        if kind == 'full' and 'trainer' in snapshot:
+            self.states[epoch] = snapshot
+        # a trainable delta (SOLVER.CHECKPOINT_DELTA) applies to the frozen weights the replica already holds
+        strict = 'base_hash' not in snapshot
+        if self.mode == 'thread':
+            self.pending.append((epoch, kind, self.executor.submit(self.run, snapshot['model'], strict, epoch, kind)))
+        else:
+            self.pending.append((epoch, kind, None))
+            self.tasks.put((epoch, kind, snapshot['model'], strict))
+
+    def run(self, weights, strict, epoch, kind):
+        # on CUDA the replica runs on its own stream, next to the training kernels
+        with torch.cuda.stream(self.stream):
+            self.replica.load_state_dict(weights, strict=strict)
+            result = evaluate(self.cfg, self.replica, self.loaders[kind], self.evaluator(kind), self.device, epoch,
+                              self.logger)
+            if self.stream is not None:
+                self.stream.synchronize()
+        return result
+
+    def collect(self, block):
+        while self.pending:
+            epoch, kind, future = self.pending[0]
+            if future is not None:
+                if not block and not future.done():
+                    break
+                mAP, cmc, seconds = future.result()
+            else:
+                try:
+                    epoch, kind, mAP, cmc, seconds = self.done.get(timeout=1 if block else 0.001)
+                except queue.Empty:
+                    if not self.process.is_alive():
+                        raise RuntimeError('The evaluation process exited with code {}'.format(
+                            self.process.exitcode))
+                    if block:
+                        continue
+                    break
+            self.pending.pop(0)
+            self.results.append({'epoch': epoch, 'kind': kind, 'mAP': mAP, 'cmc': cmc, 'seconds': seconds,
+                                 'state': self.states.pop(epoch, None) if kind == 'full' else None})
+
+    def poll(self):
+        """Finished evaluations (dicts with epoch, kind, mAP, cmc, seconds and, for background full ones, state)."""
+        if self.mode:
+            self.collect(block=False)
+        results, self.results = self.results, []
+        return results
+
+    def wait(self):
+        """Block until every submitted evaluation is done, returns the ones not polled yet and stops the workers."""
+        if self.mode:
+            self.collect(block=True)
+        if self.mode == 'thread' and self.enabled:
+            self.executor.shutdown()
+        elif self.process is not None:
+            self.tasks.put(None)
+            self.process.join()
+            self.process = None
+        results, self.results = self.results, []
+        return results
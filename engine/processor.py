@@ -1,13 +1,98 @@
+import copy
 import logging
-import os
 import time
 import torch
 import torch.nn as nn
 from torch.utils.tensorboard import SummaryWriter
-from utils.meter import AverageMeter
+from utils.meter import DeviceAverageMeter, StepTimer
+from utils.telemetry import Telemetry
+from utils.checkpoint import CheckpointManager, loader_sampler
 from utils.metrics import R1_mAP_eval, R1_mAP
 from torch.cuda import amp
-import torch.distributed as dist
+
+# query = gallery feature patterns reported by do_inference, in log order
+LOCAL_PATTERNS = [['T_RGB'], ['T_NIR'], ['T_TIR'], ['T_RGB', 'T_NIR'], ['T_RGB', 'T_TIR'], ['T_NIR', 'T_TIR'],
+                  ['T_RGB', 'T_NIR', 'T_TIR'], ['V_RGB', 'V_NIR', 'V_TIR', 'T_RGB', 'T_NIR', 'T_TIR', 'LOCAL'],
+                  ['LOCAL'], ['LOCAL_v'], ['LOCAL_t']]
+COMBINE_PATTERNS = [['V_RGB', 'V_NIR', 'V_TIR', 'T_RGB', 'T_NIR', 'T_TIR'], ['V_RGB', 'V_NIR', 'V_TIR'],
+                    ['T_RGB', 'T_NIR', 'T_TIR']]
+NO_DA_PATTERNS = [['V_RGB', 'V_NIR', 'V_TIR', 'T_RGB', 'T_NIR', 'T_TIR'], ['V_RGB', 'V_NIR', 'V_TIR']]
+
+
+def inference_patterns(cfg):
+    return LOCAL_PATTERNS + COMBINE_PATTERNS if cfg.MODEL.DA else NO_DA_PATTERNS
+
+
+PRECISIONS = {'fp32': torch.float32, 'fp16': torch.float16, 'bf16': torch.bfloat16}
+
+
+def make_evaluator(cfg, num_query, val_loader=None):
+    # features are stored in TEST.PRECISION, preallocated for the whole set when the loader has a dataset
+    dataset = getattr(val_loader, 'dataset', None)
+    num_samples = len(dataset) if dataset is not None else None
+    feat_dtype = PRECISIONS[cfg.TEST.PRECISION]
+    if cfg.DATASETS.NAMES == "MSVR310":
+        evaluator = R1_mAP(num_query, max_rank=50, feat_norm=cfg.TEST.FEAT_NORM, num_samples=num_samples,
+                           feat_dtype=feat_dtype)
+    else:
+        evaluator = R1_mAP_eval(num_query, max_rank=50, feat_norm=cfg.TEST.FEAT_NORM, num_samples=num_samples,
+                                feat_dtype=feat_dtype)
+    evaluator.reset()
+    return evaluator
+
+
+def eval_autocast(cfg, device):
+    # forward pass of the evaluation in TEST.PRECISION, CPU autocast runs fp16 requests in bf16
+    device_type = torch.device(device).type
+    dtype = PRECISIONS[cfg.TEST.PRECISION]
+    if device_type == 'cpu' and dtype == torch.float16:
+        dtype = torch.bfloat16
+    return torch.autocast(device_type=device_type, dtype=dtype, enabled=dtype != torch.float32)
+
+
+def report_eval(result, best_index, checkpointer, logger, writer):
+    """
+    Log an EvalScheduler result against its epoch and update best_index with full evaluations. A background result
+    that is the new best is saved as the best checkpoint here; returns True when an inline one is, the live model
+    then goes into the epoch-end checkpoint.
+    """
+    epoch, mAP, cmc = result['epoch'], result['mAP'], result['cmc']
+    logger.info("Evaluation of epoch {} ({}) took {:.1f}s".format(epoch, result['kind'], result['seconds']))
+    if result['kind'] == 'proxy':
+        writer.add_scalar('RGBNT201/proxy_mAP', mAP, epoch)
+        writer.add_scalar('RGBNT201/proxy_Rank-1', cmc[0], epoch)
+        logger.info("Proxy mAP: {:.1%} Rank-1: {:.1%} (epoch {})".format(mAP, cmc[0], epoch))
+        return False
+    writer.add_scalar('RGBNT201/mAP', mAP, epoch)
+    writer.add_scalar('RGBNT201/Rank-1', cmc[0], epoch)
+    writer.add_scalar('RGBNT201/Rank-5', cmc[4], epoch)
+    writer.add_scalar('RGBNT201/Rank-10', cmc[9], epoch)
+    best = False
+    if mAP >= best_index['mAP']:
+        best_index['mAP'] = mAP
+        best_index['Rank-1'] = cmc[0]
+        best_index['Rank-5'] = cmc[4]
+        best_index['Rank-10'] = cmc[9]
+        best = True
+    logger.info("~" * 50)
+    logger.info("!!!!【 The metrics are based on the feature: LOCAL_t 】!!!!")
+    logger.info("~" * 50)
+    logger.info("Current mAP: {:.1%} (epoch {})".format(mAP, epoch))
+    logger.info("Current Rank-1: {:.1%}".format(cmc[0]))
+    logger.info("Current Rank-5: {:.1%}".format(cmc[4]))
+    logger.info("Current Rank-10: {:.1%}".format(cmc[9]))
+    logger.info("~" * 50)
+    logger.info("Best mAP: {:.1%}".format(best_index['mAP']))
+    logger.info("Best Rank-1: {:.1%}".format(best_index['Rank-1']))
+    logger.info("Best Rank-5: {:.1%}".format(best_index['Rank-5']))
+    logger.info("Best Rank-10: {:.1%}".format(best_index['Rank-10']))
+    logger.info("~" * 50)
+    if best and result.get('state') is not None:
+        # the training state submitted with the weights of that epoch
+        result['state']['trainer']['best_index'] = dict(best_index)
+        checkpointer.save(result['state'], epoch, periodic=False, best=True)
+        return False
+    return best
 
 
 def do_train(cfg,
@@ -19,10 +104,10 @@ def do_train(cfg,
              optimizer_center,
              scheduler,
              loss_fn,
-             num_query, local_rank):
+             num_query, local_rank, resume=''):
     log_period = cfg.SOLVER.LOG_PERIOD
     checkpoint_period = cfg.SOLVER.CHECKPOINT_PERIOD
-    eval_period = cfg.SOLVER.EVAL_PERIOD
+    checkpoint_iters = cfg.SOLVER.CHECKPOINT_ITERS
 
     device = "cuda"
     epochs = cfg.SOLVER.MAX_EPOCHS
@@ -38,25 +123,44 @@ def do_train(cfg,
             model = torch.nn.parallel.DistributedDataParallel(model, device_ids=[local_rank],
                                                               find_unused_parameters=True)
 
-    loss_meter = AverageMeter()
-    acc_meter = AverageMeter()
+    # before the telemetry, whose tower hooks must not reach the replica of a background evaluation
+    from engine.eval_scheduler import EvalScheduler
+    evaluation = EvalScheduler(cfg, model, val_loader, num_query, device, logger)
+
+    # device-side accumulators, read back once per LOG_PERIOD
+    loss_meter = DeviceAverageMeter()
+    acc_meter = DeviceAverageMeter()
+    step_timer = StepTimer(enabled=cfg.SOLVER.STEP_TIMER)
+    telemetry = Telemetry(cfg, writer, model)
 
-    if cfg.DATASETS.NAMES == "MSVR310":
-        evaluator = R1_mAP(num_query, max_rank=50, feat_norm=cfg.TEST.FEAT_NORM)
-    else:
-        evaluator = R1_mAP_eval(num_query, max_rank=50, feat_norm=cfg.TEST.FEAT_NORM)
     scaler = amp.GradScaler()
+    checkpointer = CheckpointManager(cfg)
+    # cross-batch feature memory of the loss (MODEL.MEMORY_SIZE), part of the training state
+    memory = getattr(loss_fn, 'memory', None)
+    # the DDP sampler has a different order on every rank, only epoch boundaries are resumable there
+    sampler = None if cfg.MODEL.DIST_TRAIN else loader_sampler(train_loader)
     # train
     best_index = {'mAP': 0, "Rank-1": 0, 'Rank-5': 0, 'Rank-10': 0}
-    for epoch in range(1, epochs + 1):
+    start_epoch, start_iter = 1, 0
+    if resume:
+        trainer = checkpointer.restore(checkpointer.load(resume), model, optimizer, optimizer_center, scheduler,
+                                       scaler, sampler, memory)
+        start_epoch, start_iter, best_index = trainer['epoch'], trainer['iteration'], trainer['best_index']
+        logger.info('Resumed at epoch {} iteration {}'.format(start_epoch, start_iter))
+    for epoch in range(start_epoch, epochs + 1):
         start_time = time.time()
         loss_meter.reset()
         acc_meter.reset()
         scheduler.step(epoch)
         model.train()
-        for n_iter, (img, vid, target_cam, target_view, img_path, text) in enumerate(train_loader):
+        first_iter = start_iter if epoch == start_epoch else 0
+        data_start = time.perf_counter()
+        for n_iter, (img, vid, target_cam, target_view, img_path, text) in enumerate(train_loader, first_iter):
+            telemetry.begin_step(epoch, n_iter, time.perf_counter() - data_start)
+            step_timer.start()
             optimizer.zero_grad()
             optimizer_center.zero_grad()
+            telemetry.start('h2d')
             img = {'RGB': img['RGB'].to(device),
                    'NI': img['NI'].to(device),
                    'TI': img['TI'].to(device)}
@@ -66,53 +170,21 @@ def do_train(cfg,
             target = vid.to(device)
             target_cam = target_cam.to(device)
             target_view = target_view.to(device)
+            telemetry.stop('h2d')
             with amp.autocast(enabled=True):
+                telemetry.start('forward')
                 output = model(image=img, text=text, label=target, cam_label=target_cam, view_label=target_view,
                                writer=writer, epoch=epoch, img_path=img_path)
-                
-                # 检查是否有中间特征（多尺度特征）
-                intermediate_features = None
-                if len(output) > 4:  # 如果输出长度大于4，说明可能有中间特征
-                    # 检查最后一个元素是否是中间特征
-                    if torch.is_tensor(output[-1]) and output[-1].dim() == 2:  # 假设中间特征是2D tensor
-                        intermediate_features = output[-1]
-                        output = output[:-1]  # 移除中间特征，保持原有的处理逻辑
-                
-                # 从output中提取图像和文本特征用于SDM
-                # 根据IDEA模型的输出结构，通常图像特征在output中
-                image_features = output[1]  # fusion_v
-                text_features = output[3]   # ori_t
-                loss = 0
-                if len(output) % 2 == 1:
-                    index = len(output) - 1
-                    for i in range(0, index, 2):
-                        loss_tmp = loss_fn(score=output[i], feat=output[i + 1], target=target, target_cam=target_cam,
-                                                                    image_features=image_features,
-                                                                     text_features=text_features,
-                                                                     image_id=None,
-                                                                     intermediate_features=intermediate_features) # 传递中间特征
-                        loss = loss + loss_tmp
-                    if not isinstance(output[-1], dict):
-                        loss = loss + output[-1]
-                    else:
-                        num_region = output[-1]['num']
-                        for i in range(num_region):
-                            loss = loss + (1 / num_region) * loss_fn(score=output[-1][f'score_{i}'],
-                                                                     feat=output[-1][f'feat_{i}'],
-                                                                     target=target, target_cam=target_cam,
-                                                                     image_features=image_features,
-                                                                     text_features=text_features,
-                                                                     image_id=None,
-                                                                     intermediate_features=intermediate_features)# 传递中间特征
-                else:
-                    for i in range(0, len(output), 2):
-                        loss_tmp = loss_fn(score=output[i], feat=output[i + 1], target=target, target_cam=target_cam,
-                                                                     image_features=image_features,
-                                                                     text_features=text_features,
-                                                                     image_id=None,
-                                                                     intermediate_features=intermediate_features)# 传递中间特征
-                        loss = loss + loss_tmp
+                telemetry.stop('forward')
+
+                # per-head ID/triplet terms and the batch-level image-text terms once per step
+                telemetry.start('loss')
+                loss = loss_fn.step(output, target, target_cam)
+                telemetry.stop('loss')
+            telemetry.start('backward')
             scaler.scale(loss).backward()
+            telemetry.stop('backward')
+            telemetry.start('optimizer')
             scaler.step(optimizer)
             scaler.update()
 
@@ -121,146 +193,219 @@ def do_train(cfg,
                     param.grad.data *= (1. / cfg.SOLVER.CENTER_LOSS_WEIGHT)
                 scaler.step(optimizer_center)
                 scaler.update()
+            telemetry.stop('optimizer')
             if isinstance(output, list):
                 acc = (output[0][0].max(1)[1] == target).float().mean()
             else:
                 acc = (output[0].max(1)[1] == target).float().mean()
 
-            loss_meter.update(loss.item(), img['RGB'].shape[0])
+            loss_meter.update(loss, img['RGB'].shape[0])
             acc_meter.update(acc, 1)
+            step_timer.stop()
+            telemetry.end_step(img['RGB'].shape[0])
+            if checkpoint_iters and sampler is not None and (n_iter + 1) % checkpoint_iters == 0 and \
+                    n_iter + 1 < len(train_loader):
+                # resumable from the next batch of this epoch
+                checkpointer.save(checkpointer.state(model, optimizer, optimizer_center, scheduler, scaler, sampler,
+                                                     consumed=(n_iter + 1) * train_loader.batch_size, memory=memory,
+                                                     epoch=epoch, iteration=n_iter + 1, best_index=best_index),
+                                  epoch, n_iter + 1)
 
-            torch.cuda.synchronize()
             if (n_iter + 1) % log_period == 0:
                 logger.info("Epoch[{}] Iteration[{}/{}] Loss: {:.3f}, Acc: {:.3f}, Base Lr: {:.2e}"
                             .format(epoch, (n_iter + 1), len(train_loader),
                                     loss_meter.avg, acc_meter.avg, scheduler._get_lr(epoch)[0]))
+                if step_timer.enabled:
+                    logger.info("Step time: {:.1f} ms".format(step_timer.mean().get('step', 0.)))
+                if memory is not None and len(memory):
+                    # how old the queued keys are and how far the encoder moved since they were stored
+                    mean_age, max_age = memory.staleness()
+                    drift = memory.drift(output[1], target)
+                    logger.info("Memory: {} keys, age {:.1f}/{} steps, drift {}"
+                                .format(len(memory), mean_age, max_age,
+                                        'n/a' if drift is None else '{:.3f}'.format(drift)))
+            data_start = time.perf_counter()
 
 
+        # the queued kernels of the last steps belong to this epoch
+        torch.cuda.synchronize()
         end_time = time.time()
-        time_per_batch = (end_time - start_time) / (n_iter + 1)
+        time_per_batch = (end_time - start_time) / (n_iter + 1 - first_iter)
         if cfg.MODEL.DIST_TRAIN:
             pass
         else:
             logger.info("Epoch {} done. Time per batch: {:.3f}[s] Speed: {:.1f}[samples/s]"
                         .format(epoch, time_per_batch, train_loader.batch_size / time_per_batch))
 
-        if epoch % checkpoint_period == 0:
-            if cfg.MODEL.DIST_TRAIN:
-                if dist.get_rank() == 0:
-                    torch.save(model.state_dict(),
-                               os.path.join(cfg.OUTPUT_DIR, cfg.MODEL.NAME + '_{}.pth'.format(epoch)))
-            else:
-                torch.save(model.state_dict(),
-                           os.path.join(cfg.OUTPUT_DIR, cfg.MODEL.NAME + '_{}.pth'.format(epoch)))
-
-        if epoch % eval_period == 0:
-            if cfg.MODEL.DIST_TRAIN:
-                if dist.get_rank() == 0:
-                    training_neat_eval(cfg, model, val_loader, device, evaluator, epoch, logger)
-            else:
-                mAP, cmc = training_neat_eval(cfg, model, val_loader, device, evaluator, epoch, logger, writer=None)
-                writer.add_scalar('RGBNT201/mAP', mAP, epoch)
-                writer.add_scalar('RGBNT201/Rank-1', cmc[0], epoch)
-                writer.add_scalar('RGBNT201/Rank-5', cmc[4], epoch)
-                writer.add_scalar('RGBNT201/Rank-10', cmc[9], epoch)
-                if mAP >= best_index['mAP']:
-                    best_index['mAP'] = mAP
-                    best_index['Rank-1'] = cmc[0]
-                    best_index['Rank-5'] = cmc[4]
-                    best_index['Rank-10'] = cmc[9]
-                    torch.save(model.state_dict(),
-                               os.path.join(cfg.OUTPUT_DIR, cfg.MODEL.NAME + 'best.pth'))
-                logger.info("~" * 50)
-                logger.info("!!!!【 The metrics are based on the feature: LOCAL_t 】!!!!")
-                logger.info("~" * 50)
-                logger.info("Current mAP: {:.1%}".format(mAP))
-                logger.info("Current Rank-1: {:.1%}".format(cmc[0]))
-                logger.info("Current Rank-5: {:.1%}".format(cmc[4]))
-                logger.info("Current Rank-10: {:.1%}".format(cmc[9]))
-                logger.info("~" * 50)
-                logger.info("Best mAP: {:.1%}".format(best_index['mAP']))
-                logger.info("Best Rank-1: {:.1%}".format(best_index['Rank-1']))
-                logger.info("Best Rank-5: {:.1%}".format(best_index['Rank-5']))
-                logger.info("Best Rank-10: {:.1%}".format(best_index['Rank-10']))
-                logger.info("~" * 50)
-
+        best = False
+        kind = evaluation.kind(epoch)
+        if kind is not None:
+            state = None
+            if evaluation.background and kind == 'full':
+                # becomes the best checkpoint if this epoch scores best once its evaluation is done
+                state = checkpointer.state(model, optimizer, optimizer_center, scheduler, scaler, sampler,
+                                           memory=memory, epoch=epoch + 1, iteration=0, best_index=best_index)
+            evaluation.submit(model, epoch, kind, state=state, telemetry=telemetry)
+        for result in evaluation.poll():
+            best = report_eval(result, best_index, checkpointer, logger, writer) or best
 
+        # after the evaluation, so that the saved RNG state is the one the next epoch starts from
+        if epoch % checkpoint_period == 0 or best:
+            checkpointer.save(checkpointer.state(model, optimizer, optimizer_center, scheduler, scaler, sampler,
+                                                 memory=memory, epoch=epoch + 1, iteration=0, best_index=best_index),
+                              epoch, periodic=epoch % checkpoint_period == 0, best=best)
+    for result in evaluation.wait():
+        report_eval(result, best_index, checkpointer, logger, writer)
+    checkpointer.wait()
 
-def do_inference(cfg,
-                 model,
-                 val_loader,
-                 num_query, logger):
-    device = "cuda"
-    logger.info("Enter inferencing")
 
-    if cfg.DATASETS.NAMES == "MSVR310":
-        evaluator = R1_mAP(num_query, max_rank=50, feat_norm=cfg.TEST.FEAT_NORM)
-        evaluator.reset()
-    else:
-        evaluator = R1_mAP_eval(num_query, max_rank=50, feat_norm=cfg.TEST.FEAT_NORM)
-        evaluator.reset()
-    if device:
-        if torch.cuda.device_count() > 1:
-            print('Using {} GPUs for inference'.format(torch.cuda.device_count()))
-            model = nn.DataParallel(model)
-        model.to(device)
-
-    model.eval()
+def extract_features(cfg, model, val_loader, num_query, device, limit=None, evaluator=None, **forward_kwargs):
+    """
+    Feature loop of every evaluation: val_loader (the first `limit` samples if set) through model in TEST.PRECISION
+    into `evaluator` (a new one when None), extra keyword arguments go to the forward. Returns the evaluator and the
+    forward throughput in samples/s.
+    """
+    if evaluator is None:
+        evaluator = make_evaluator(cfg, num_query, val_loader)
+    cuda = torch.device(device).type == 'cuda'
+    num_images, forward_time = 0, 0.
     for n_iter, (img, pid, camid, camids, target_view, imgpath, text) in enumerate(val_loader):
+        if limit is not None and num_images >= limit:
+            break
         with torch.no_grad():
-            img = {'RGB': img['RGB'].to(device),
-                   'NI': img['NI'].to(device),
-                   'TI': img['TI'].to(device)}
-            text = {'rgb_text': text['rgb_text'].to(device),
-                    'ni_text': text['ni_text'].to(device),
-                    'ti_text': text['ti_text'].to(device)}
+            img = {key: value.to(device) for key, value in img.items()}
+            text = {key: value.to(device) for key, value in text.items()}
             camids = camids.to(device)
             scenceids = target_view
             target_view = target_view.to(device)
-            feat = model(image=img, text=text, cam_label=camids, view_label=target_view, img_path=imgpath)
+            if cuda:
+                # the current stream only, a background evaluation does not wait for the training kernels
+                torch.cuda.current_stream(device).synchronize()
+            start = time.time()
+            with eval_autocast(cfg, device):
+                feat = model(image=img, text=text, cam_label=camids, view_label=target_view, img_path=imgpath,
+                             **forward_kwargs)
+            if cuda:
+                torch.cuda.current_stream(device).synchronize()
+            forward_time += time.time() - start
+            num_images += len(pid)
             if cfg.DATASETS.NAMES == "MSVR310":
                 evaluator.update((feat, pid, camid, scenceids, imgpath))
             else:
                 evaluator.update((feat, pid, camid, imgpath))
+    return evaluator, num_images / max(forward_time, 1e-9)
 
-    sign = cfg.MODEL.DA
-    if sign:
+
+def do_inference(cfg,
+                 model,
+                 val_loader,
+                 num_query, logger, miss=None):
+    """
+    Evaluation of every feature pattern of inference_patterns. `miss` (a TEST.MISS pattern) overrides the absent
+    modalities for this run, only the towers of the present ones run. Returns mAP and CMC of the reported pattern.
+    """
+    device = cfg.MODEL.DEVICE
+    logger.info("Enter inferencing" if miss is None else "Enter inferencing, missing pattern: {}".format(miss))
+    if miss is not None:
+        model.miss_type = miss
+    if device == 'cuda' and torch.cuda.device_count() > 1:
+        print('Using {} GPUs for inference'.format(torch.cuda.device_count()))
+        model = nn.DataParallel(model)
+    model.to(device)
+
+    model.eval()
+    start = time.time()
+    evaluator, speed = extract_features(cfg, model, val_loader, num_query, device)
+    logger.info('Feature extraction in {}: {:.1f}s ({:.1f} samples/s), stored features {:.1f} MB'.format(
+        cfg.TEST.PRECISION, time.time() - start, speed, evaluator.feats.nbytes() / 2 ** 20))
+    if miss is not None:
+        getattr(model, 'module', model).miss_type = cfg.TEST.MISS
+
+    # patterns whose features the model does not produce (e.g. T_NIR / T_TIR without DA) are skipped
+    def produced(pattern):
+        return all(key in evaluator.feats for key in pattern)
+    if cfg.MODEL.DA:
         logger.info('Current is the local feature testing!')
-        _, _ = compute_log(evaluator=evaluator, logger=logger, query=['T_RGB'], gallery=['T_RGB'])
-        _, _ = compute_log(evaluator=evaluator, logger=logger, query=['T_NIR'], gallery=['T_NIR'])
-        _, _ = compute_log(evaluator=evaluator, logger=logger, query=['T_TIR'], gallery=['T_TIR'])
-        _, _ = compute_log(evaluator=evaluator, logger=logger, query=['T_RGB', 'T_NIR'], gallery=['T_RGB', 'T_NIR'])
-        _, _ = compute_log(evaluator=evaluator, logger=logger, query=['T_RGB', 'T_TIR'], gallery=['T_RGB', 'T_TIR'])
-        _, _ = compute_log(evaluator=evaluator, logger=logger, query=['T_NIR', 'T_TIR'], gallery=['T_NIR', 'T_TIR'])
-        _, _ = compute_log(evaluator=evaluator, logger=logger, query=['T_RGB', 'T_NIR', 'T_TIR'],gallery=['T_RGB', 'T_NIR', 'T_TIR'])
-        _, _ = compute_log(evaluator=evaluator, logger=logger,
-                               query=['V_RGB', 'V_NIR', 'V_TIR', 'T_RGB', 'T_NIR', 'T_TIR', 'LOCAL'],
-                               gallery=['V_RGB', 'V_NIR', 'V_TIR', 'T_RGB', 'T_NIR', 'T_TIR', 'LOCAL'])
-        _, _ = compute_log(evaluator=evaluator, logger=logger, query=['LOCAL'],
-                           gallery=['LOCAL'])
-        _, _ = compute_log(evaluator=evaluator, logger=logger, query=['LOCAL_v'], gallery=['LOCAL_v'])
-        _, _ = compute_log(evaluator=evaluator, logger=logger, query=['LOCAL_t'], gallery=['LOCAL_t'])
+        for pattern in filter(produced, LOCAL_PATTERNS):
+            _, _ = compute_log(evaluator=evaluator, logger=logger, query=pattern, gallery=pattern)
         logger.info('Current is the combine feature testing!')
-        mAP, cmc = compute_log(evaluator=evaluator, logger=logger,
-                               query=['V_RGB', 'V_NIR', 'V_TIR', 'T_RGB', 'T_NIR', 'T_TIR'],
-                               gallery=['V_RGB', 'V_NIR', 'V_TIR', 'T_RGB', 'T_NIR', 'T_TIR'])
-        _, _ = compute_log(evaluator=evaluator, logger=logger, query=['V_RGB', 'V_NIR', 'V_TIR'],
-                           gallery=['V_RGB', 'V_NIR', 'V_TIR'])
-        _, _ = compute_log(evaluator=evaluator, logger=logger, query=['T_RGB', 'T_NIR', 'T_TIR'],
-                           gallery=['T_RGB', 'T_NIR', 'T_TIR'])
+        results = [compute_log(evaluator=evaluator, logger=logger, query=pattern, gallery=pattern)
+                   for pattern in filter(produced, COMBINE_PATTERNS)]
+        mAP, cmc = results[0]
     else:
-        _, _ = compute_log(evaluator=evaluator, logger=logger,
-                               query=['V_RGB', 'V_NIR', 'V_TIR', 'T_RGB', 'T_NIR', 'T_TIR'],
-                               gallery=['V_RGB', 'V_NIR', 'V_TIR', 'T_RGB', 'T_NIR', 'T_TIR'])
-        mAP, cmc = compute_log(evaluator=evaluator, logger=logger, query=['V_RGB', 'V_NIR', 'V_TIR'],
-                            gallery=['V_RGB', 'V_NIR', 'V_TIR'])
+        results = {tuple(pattern): compute_log(evaluator=evaluator, logger=logger, query=pattern, gallery=pattern)
+                   for pattern in filter(produced, NO_DA_PATTERNS)}
+        mAP, cmc = results[tuple(NO_DA_PATTERNS[1])]
 
     return mAP, cmc
 
 
-def compute_log(evaluator, logger, query, gallery, epoch=0):
+def do_missing_inference(cfg,
+                         model,
+                         val_loader,
+                         num_query, logger):
+    """
+    Missing-modality sweep: do_inference for every pattern of TEST.MISS_SWEEP (absent towers are skipped and
+    imputed inside the model), then a summary of the reported mAP/Rank-1 per pattern.
+    """
+    results = [(pattern,) + do_inference(cfg, model, val_loader, num_query, logger, miss=pattern)
+               for pattern in cfg.TEST.MISS_SWEEP]
+    logger.info('{:>8} {:>8} {:>8}'.format('missing', 'mAP', 'Rank-1'))
+    for pattern, mAP, cmc in results:
+        logger.info('{:>8} {:>8.1%} {:>8.1%}'.format(pattern, mAP, cmc[0]))
+    return [(pattern, mAP, cmc[0]) for pattern, mAP, cmc in results]
+
+
+def do_quant_inference(cfg,
+                       model,
+                       val_loader,
+                       num_query, logger):
+    """
+    Post-training int8 evaluation on CPU (TEST.QUANT 'dynamic' or 'static'): the fp32 model and its int8 copy,
+    both after optimize_for_inference, are evaluated on the whole val_loader; mAP/Rank-1 deltas are reported for
+    every pattern of do_inference whose features the model produces, next to the throughput of both.
+    """
+    from modeling.inference import optimize_for_inference
+    from modeling.quantization import quantize_dynamic_int8, prepare_static_int8, convert_static_int8, QUANT_MODES
+    if cfg.TEST.QUANT not in QUANT_MODES:
+        raise ValueError('Unknown TEST.QUANT {}, expected one of {}'.format(cfg.TEST.QUANT, QUANT_MODES))
+    device = 'cpu'
+    logger.info("Enter int8 ({}) inferencing".format(cfg.TEST.QUANT))
+    fp32_model = optimize_for_inference(copy.deepcopy(model).float().to(device))
+    int8_model = copy.deepcopy(fp32_model)
+    if cfg.TEST.QUANT == 'dynamic':
+        quantize_dynamic_int8(int8_model, backend=cfg.TEST.QUANT_BACKEND)
+    else:
+        prepare_static_int8(int8_model, backend=cfg.TEST.QUANT_BACKEND)
+        extract_features(cfg, int8_model, val_loader, num_query, device, limit=cfg.TEST.QUANT_CALIB)
+        convert_static_int8(int8_model)
+        logger.info('Calibrated the int8 activations on {} samples'.format(cfg.TEST.QUANT_CALIB))
+
+    fp32_eval, fp32_speed = extract_features(cfg, fp32_model, val_loader, num_query, device)
+    int8_eval, int8_speed = extract_features(cfg, int8_model, val_loader, num_query, device)
+
+    results = []
+    logger.info('{:<48} {:>8} {:>8} {:>8} {:>8}'.format('pattern', 'fp32 mAP', 'int8 mAP', 'dmAP', 'dRank-1'))
+    for pattern in inference_patterns(cfg):
+        if not all(key in fp32_eval.feats for key in pattern):
+            logger.info('{:<48} skipped, not produced by this model'.format('+'.join(pattern)))
+            continue
+        fp32_cmc, fp32_mAP = fp32_eval.compute(query=pattern, gallery=pattern)[:2]
+        int8_cmc, int8_mAP = int8_eval.compute(query=pattern, gallery=pattern)[:2]
+        results.append((pattern, fp32_mAP, int8_mAP, fp32_cmc[0], int8_cmc[0]))
+        logger.info('{:<48} {:>8.1%} {:>8.1%} {:>+8.2%} {:>+8.2%}'.format(
+            '+'.join(pattern), fp32_mAP, int8_mAP, int8_mAP - fp32_mAP, int8_cmc[0] - fp32_cmc[0]))
+    logger.info('Throughput on CPU: fp32 {:.1f} samples/s, int8 {:.1f} samples/s ({:.2f}x)'.format(
+        fp32_speed, int8_speed, int8_speed / fp32_speed))
+    return results
+
+
+def compute_log(evaluator, logger, query, gallery, epoch=0, telemetry=None):
     logger.info('Search Pattern --> Query: {} => Gallery: {}'.format(str(query), str(gallery)))
+    start = time.perf_counter()
     cmc, mAP, _, _, _, _, _ = evaluator.compute(query=query, gallery=gallery)
+    if telemetry is not None:
+        telemetry.log_eval(query, gallery, time.perf_counter() - start, epoch)
     logger.info("Validation Results - Epoch: {}".format(epoch))
     logger.info("mAP: {:.1%}".format(mAP))
     for r in [1, 5, 10]:
@@ -274,27 +419,11 @@ def training_neat_eval(cfg,
                        model,
                        val_loader,
                        device,
-                       evaluator, epoch, logger, return_pattern=1, writer=None):
+                       evaluator, epoch, logger, return_pattern=1, writer=None, telemetry=None):
     evaluator.reset()
     model.eval()
-    for n_iter, (img, pid, camid, camids, target_view, imgpath, text) in enumerate(val_loader):
-        with torch.no_grad():
-            img = {'RGB': img['RGB'].to(device),
-                   'NI': img['NI'].to(device),
-                   'TI': img['TI'].to(device)}
-            text = {'rgb_text': text['rgb_text'].to(device),
-                    'ni_text': text['ni_text'].to(device),
-                    'ti_text': text['ti_text'].to(device)}
-            camids = camids.to(device)
-            scenceids = target_view
-            target_view = target_view.to(device)
-            feat = model(image=img, text=text, cam_label=camids, view_label=target_view, return_pattern=return_pattern,
-                         img_path=imgpath, writer=writer, epoch=epoch)
-            if cfg.DATASETS.NAMES == "MSVR310":
-                evaluator.update((feat, pid, camid, scenceids, imgpath))
-            else:
-                evaluator.update((feat, pid, camid, imgpath))
-        
+    extract_features(cfg, model, val_loader, None, device, evaluator=evaluator, return_pattern=return_pattern,
+                     writer=writer, epoch=epoch)
     logger.info('Current is the combine feature testing!')
     # mAP, cmc = compute_log(evaluator=evaluator, logger=logger,
     #                        query=['V_RGB', 'V_NIR', 'V_TIR', 'T_RGB', 'T_NIR', 'T_TIR'],
@@ -310,16 +439,20 @@ def training_neat_eval(cfg,
     # _, _ = compute_log(evaluator=evaluator, logger=logger, query=['T_NIR'], gallery=['T_NIR'], epoch=epoch)
     # _, _ = compute_log(evaluator=evaluator, logger=logger, query=['T_TIR'], gallery=['T_TIR'], epoch=epoch)
     #text ----> Multmodal
-    mAP, cmc = compute_log(evaluator=evaluator, logger=logger, query=['T_RGB'], gallery=['LOCAL_v'], epoch=epoch)
+    mAP, cmc = compute_log(evaluator=evaluator, logger=logger, query=['T_RGB'], gallery=['LOCAL_v'], epoch=epoch,
+                           telemetry=telemetry)
     sign = cfg.MODEL.DA
     if sign:
         logger.info('Current is the local feature testing!')
         _, _ = compute_log(evaluator=evaluator, logger=logger,
                            query=['V_RGB', 'V_NIR', 'V_TIR', 'T_RGB', 'T_NIR', 'T_TIR', 'LOCAL'],
-                           gallery=['V_RGB', 'V_NIR', 'V_TIR', 'T_RGB', 'T_NIR', 'T_TIR', 'LOCAL'], epoch=epoch)
+                           gallery=['V_RGB', 'V_NIR', 'V_TIR', 'T_RGB', 'T_NIR', 'T_TIR', 'LOCAL'], epoch=epoch,
+                           telemetry=telemetry)
         _, _ = compute_log(evaluator=evaluator, logger=logger, query=['LOCAL'],
-                           gallery=['LOCAL'], epoch=epoch)
-        _, _ = compute_log(evaluator=evaluator, logger=logger, query=['LOCAL_v'], gallery=['LOCAL_v'], epoch=epoch)
-        mAP, cmc = compute_log(evaluator=evaluator, logger=logger, query=['LOCAL_t'], gallery=['LOCAL_t'], epoch=epoch)
+                           gallery=['LOCAL'], epoch=epoch, telemetry=telemetry)
+        _, _ = compute_log(evaluator=evaluator, logger=logger, query=['LOCAL_v'], gallery=['LOCAL_v'], epoch=epoch,
+                           telemetry=telemetry)
+        mAP, cmc = compute_log(evaluator=evaluator, logger=logger, query=['LOCAL_t'], gallery=['LOCAL_t'], epoch=epoch,
+                               telemetry=telemetry)
     return mAP, cmc
 
@@ -0,0 +1,101 @@
+import os
+import copy
+import argparse
+import torch
+from config import cfg
+from data import make_dataloader
+from modeling import make_model
+from modeling.inference import export_inference, load_inference, IDEAInference, wrapper_inputs, deploy, \
+    load_deployed, latency, feature_parity
+from utils.logger import setup_logger
+
+DEFAULT_NAMES = {'native': 'inference.pth', 'torchscript': 'inference.pt', 'export': 'inference.pt2'}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="IDEA inference export")
+    parser.add_argument(
+        "--config_file", default="", help="path to config file", type=str
+    )
+    parser.add_argument("--format", default="native", choices=["native", "torchscript", "export"],
+                        help="native: optimized state dict for load_inference, torchscript/export: tensor-only "
+                             "deployment artifact of IDEAInference")
+    parser.add_argument("--output", default="", type=str,
+                        help="export path, defaults to OUTPUT_DIR/inference.{pth,pt,pt2}")
+    parser.add_argument("--tolerance", default=1e-3, type=float,
+                        help="largest absolute feature difference accepted by the parity check")
+    parser.add_argument("--benchmark", default=0, type=int,
+                        help="timed calls for the eager versus exported latency comparison, 0 skips it")
+    parser.add_argument("opts", help="Modify config options using the command-line", default=None,
+                        nargs=argparse.REMAINDER)
+
+    args = parser.parse_args()
+
+    if args.config_file != "":
+        cfg.merge_from_file(args.config_file)
+    cfg.merge_from_list(args.opts)
+    cfg.freeze()
+    output_dir = cfg.OUTPUT_DIR
+    if output_dir and not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    output = args.output or os.path.join(output_dir, DEFAULT_NAMES[args.format])
+
+    logger = setup_logger("IDEA", output_dir, if_train=False)
+    logger.info(args)
+    os.environ['CUDA_VISIBLE_DEVICES'] = cfg.MODEL.DEVICE_ID
+    device = cfg.MODEL.DEVICE
+
+    train_loader, train_loader_normal, val_loader, num_query, num_classes, camera_num, view_num = make_dataloader(cfg)
+    model = make_model(cfg, num_class=num_classes, camera_num=camera_num, view_num=view_num)
+    if cfg.TEST.WEIGHT:
+        model.load_param(cfg.TEST.WEIGHT)
+    model.to(device)
+    model.eval()
+
+    optimized = copy.deepcopy(model).optimize_for_inference()
+    before = sum(p.numel() for p in model.parameters())
+    after = sum(p.numel() for p in optimized.parameters())
+    logger.info('Parameters: {:.2f}M -> {:.2f}M'.format(before / 1e6, after / 1e6))
+
+    img, pid, camid, camids, target_view, imgpath, text = next(iter(val_loader))
+    inputs = {'image': {key: value.to(device) for key, value in img.items()},
+              'text': {key: value.to(device) for key, value in text.items()},
+              'cam_label': camids.to(device)}
+    with torch.no_grad():
+        expected = model(**inputs)
+
+    if args.format == 'native':
+        export_inference(optimized, output, num_classes, camera_num, view_num)
+        reloaded = load_inference(output, map_location='cpu').to(device)
+        candidates = (('optimized', lambda: optimized(**inputs)), ('reloaded', lambda: reloaded(**inputs)))
+        names = list(expected.keys())
+    else:
+        eager = IDEAInference(optimized)
+        positional = wrapper_inputs(inputs['image'], inputs['text'],
+                                    inputs['cam_label'] if cfg.MODEL.SIE_CAMERA else None)
+        deploy(eager, positional, output, args.format)
+        deployed = load_deployed(output, map_location=device)
+        positional = tuple(item for item in positional if item is not None)
+        names = eager.names
+        candidates = (('eager', lambda: dict(zip(names, eager(*positional)))),
+                      (args.format, lambda: dict(zip(names, deployed(*positional)))))
+    logger.info('Exported the inference model to {}'.format(output))
+
+    failed = False
+    for name, candidate in candidates:
+        with torch.no_grad():
+            actual = candidate()
+        for key, diff in feature_parity(expected, actual, names).items():
+            logger.info('{:>12} {:>8}: max abs diff {:.2e}'.format(name, key, diff))
+            failed = failed or diff > args.tolerance
+    if failed:
+        raise SystemExit('Parity check failed, largest difference above {}'.format(args.tolerance))
+    logger.info('Parity check passed')
+
+    if args.benchmark and args.format != 'native':
+        logger.info('Latency on {} with batch {} ({} calls, median):'.format(device, positional[0].shape[0],
+                                                                             args.benchmark))
+        eager_time = latency(eager, positional, args.benchmark)
+        deployed_time = latency(deployed, positional, args.benchmark)
+        logger.info('{:>12} {:>9.1f} ms'.format('eager', eager_time * 1e3))
+        logger.info('{:>12} {:>9.1f} ms {:>6.2f}x'.format(args.format, deployed_time * 1e3,
+                                                          eager_time / deployed_time))
@@ -5,6 +5,52 @@ from torch import nn
 import torch.nn.functional as F
 
 
+def batch_labels(targets, ordered=True, ids_per_batch=16, imgs_per_id=4):
+    """
+    Args:
+        targets: ground truth labels with shape (batch_size)
+        ordered: bool type. If the train data per batch are formed as p*k, where p is the num of ids per batch and k is the num of images per id.
+        ids_per_batch: num of different ids per batch
+        imgs_per_id: num of images per id
+    Return:
+        unique_labels: labels of the batch with shape (class_num), members: class membership mask with shape (class_num, batch_size)
+    """
+    if ordered and targets.size(0) == ids_per_batch * imgs_per_id:
+        unique_labels = targets[0:targets.size(0):imgs_per_id]
+    else:
+        unique_labels = targets.unique()
+    members = unique_labels.unsqueeze(1) == targets.unsqueeze(0)
+    return unique_labels, members
+
+
+def class_centers(features, members):
+    """
+    Args:
+        features: feature matrix with shape (batch_size, *)
+        members: class membership mask with shape (class_num, batch_size)
+    Return:
+        center_features: per-class mean with shape (class_num, *), one segment sum for all classes
+    """
+    weight = members.to(features.dtype)
+    weight = weight / weight.sum(dim=1, keepdim=True)
+    return (weight @ features.flatten(1)).view(members.size(0), *features.shape[1:])
+
+
+def hardest_distances(intra_class_distance, inter_class_distance, members):
+    """
+    Args:
+        intra_class_distance: center to sample distances with shape (class_num, batch_size)
+        inter_class_distance: center to center distances with shape (class_num, class_num)
+        members: class membership mask with shape (class_num, batch_size)
+    Return:
+        intra_max_distance, inter_min_distance: with shape (class_num)
+    """
+    intra_max_distance = intra_class_distance.masked_fill(~members, float('-inf')).amax(dim=1)
+    eye = torch.eye(inter_class_distance.size(0), dtype=torch.bool, device=inter_class_distance.device)
+    inter_min_distance = inter_class_distance.masked_fill(eye, float('inf')).amin(dim=1)
+    return intra_max_distance, inter_min_distance
+
+
 class ClusterLoss(nn.Module):
     def __init__(self, margin=10, use_gpu=True, ordered=True, ids_per_batch=16, imgs_per_id=4):
         super(ClusterLoss, self).__init__()
@@ -26,7 +72,7 @@ class ClusterLoss(nn.Module):
         xx = torch.pow(x, 2).sum(1, keepdim=True).expand(m, n)
         yy = torch.pow(y, 2).sum(1, keepdim=True).expand(n, m).t()
         dist = xx + yy
-        dist.addmm_(1, -2, x, y.t())
+        dist = dist.addmm(x, y.t(), beta=1, alpha=-2)
         dist = dist.clamp(min=1e-12).sqrt()  # for numerical stability
         return dist
 
@@ -41,47 +87,12 @@ class ClusterLoss(nn.Module):
         Return:
              cluster_loss
         """
-        if self.use_gpu:
-            if ordered:
-                if targets.size(0) == ids_per_batch * imgs_per_id:
-                    unique_labels = targets[0:targets.size(0):imgs_per_id]
-                else:
-                    unique_labels = targets.cpu().unique().cuda()
-            else:
-                unique_labels = targets.cpu().unique().cuda()
-        else:
-            if ordered:
-                if targets.size(0) == ids_per_batch * imgs_per_id:
-                    unique_labels = targets[0:targets.size(0):imgs_per_id]
-                else:
-                    unique_labels = targets.unique()
-            else:
-                unique_labels = targets.unique()
-
-        inter_min_distance = torch.zeros(unique_labels.size(0))
-        intra_max_distance = torch.zeros(unique_labels.size(0))
-        center_features = torch.zeros(unique_labels.size(0), features.size(1))
-
-        if self.use_gpu:
-            inter_min_distance = inter_min_distance.cuda()
-            intra_max_distance = intra_max_distance.cuda()
-            center_features = center_features.cuda()
-
-        index = torch.range(0, unique_labels.size(0) - 1)
-        for i in range(unique_labels.size(0)):
-            label = unique_labels[i]
-            same_class_features = features[targets == label]
-            center_features[i] = same_class_features.mean(dim=0)
-            intra_class_distance = self._euclidean_dist(center_features[index == i], same_class_features)
-            # print('intra_class_distance', intra_class_distance)
-            intra_max_distance[i] = intra_class_distance.max()
-        # print('intra_max_distance:', intra_max_distance)
-
-        for i in range(unique_labels.size(0)):
-            inter_class_distance = self._euclidean_dist(center_features[index == i], center_features[index != i])
-            # print('inter_class_distance', inter_class_distance)
-            inter_min_distance[i] = inter_class_distance.min()
-        #  print('inter_min_distance:', inter_min_distance)
+        unique_labels, members = batch_labels(targets, ordered, ids_per_batch, imgs_per_id)
+        center_features = class_centers(features, members)
+        # all classes at once: centers to samples and centers to centers
+        intra_max_distance, inter_min_distance = hardest_distances(
+            self._euclidean_dist(center_features, features), self._euclidean_dist(center_features, center_features),
+            members)
         cluster_loss = torch.mean(torch.relu(intra_max_distance - inter_min_distance + self.margin))
         return cluster_loss, intra_max_distance, inter_min_distance
 
@@ -123,12 +134,12 @@ class ClusterLoss_local(nn.Module):
         xx = torch.pow(x, 2).sum(1, keepdim=True).expand(m, n)
         yy = torch.pow(y, 2).sum(1, keepdim=True).expand(n, m).t()
         dist = xx + yy
-        dist.addmm_(1, -2, x, y.t())
+        dist = dist.addmm(x, y.t(), beta=1, alpha=-2)
         dist = dist.clamp(min=1e-12).sqrt()  # for numerical stability
         return dist
 
     def _shortest_dist(self, dist_mat):
-        """Parallel version.
+        """Parallel version, one step per anti-diagonal of the [m, n] grid.
         Args:
           dist_mat: pytorch Variable, available shape:
             1) [m, n]
@@ -141,20 +152,16 @@ class ClusterLoss_local(nn.Module):
             3) pytorch Variable, with shape [*]
         """
         m, n = dist_mat.size()[:2]
-        # Just offering some reference for accessing intermediate distance.
-        dist = [[0 for _ in range(n)] for _ in range(m)]
-        for i in range(m):
-            for j in range(n):
-                if (i == 0) and (j == 0):
-                    dist[i][j] = dist_mat[i, j]
-                elif (i == 0) and (j > 0):
-                    dist[i][j] = dist[i][j - 1] + dist_mat[i, j]
-                elif (i > 0) and (j == 0):
-                    dist[i][j] = dist[i - 1][j] + dist_mat[i, j]
-                else:
-                    dist[i][j] = torch.min(dist[i - 1][j], dist[i][j - 1]) + dist_mat[i, j]
-        dist = dist[-1][-1]
-        return dist
+        # diagonal[i + 1] holds dist[i][k - i] of the current anti-diagonal k, inf outside the grid
+        diagonal = dist_mat.new_full((m + 1,) + dist_mat.shape[2:], float('inf'))
+        for k in range(m + n - 1):
+            i = torch.arange(max(0, k - n + 1), min(k, m - 1) + 1, device=dist_mat.device)
+            cost = dist_mat[i, k - i]
+            if k > 0:
+                # dist[i - 1][j] and dist[i][j - 1] both lie on the previous anti-diagonal
+                cost = torch.min(diagonal[i], diagonal[i + 1]) + cost
+            diagonal = torch.full_like(diagonal, float('inf')).index_copy(0, i + 1, cost)
+        return diagonal[m]
 
     def _local_dist(self, x, y):
         """
@@ -170,7 +177,8 @@ class ClusterLoss_local(nn.Module):
         y = y.contiguous().view(N * n, d)
         # shape [M * m, N * n]
         dist_mat = self._euclidean_dist(x, y)
-        dist_mat = (torch.exp(dist_mat) - 1.) / (torch.exp(dist_mat) + 1.)
+        # (exp(d) - 1) / (exp(d) + 1) without the overflow of exp
+        dist_mat = torch.tanh(dist_mat / 2.)
         # shape [M * m, N * n] -> [M, m, N, n] -> [m, n, M, N]
         dist_mat = dist_mat.contiguous().view(M, m, N, n).permute(1, 3, 0, 2)
         # shape [M, N]
@@ -188,48 +196,10 @@ class ClusterLoss_local(nn.Module):
         Return:
              cluster_loss
         """
-        if self.use_gpu:
-            if ordered:
-                if targets.size(0) == ids_per_batch * imgs_per_id:
-                    unique_labels = targets[0:targets.size(0):imgs_per_id]
-                else:
-                    unique_labels = targets.cpu().unique().cuda()
-            else:
-                unique_labels = targets.cpu().unique().cuda()
-        else:
-            if ordered:
-                if targets.size(0) == ids_per_batch * imgs_per_id:
-                    unique_labels = targets[0:targets.size(0):imgs_per_id]
-                else:
-                    unique_labels = targets.unique()
-            else:
-                unique_labels = targets.unique()
-
-        inter_min_distance = torch.zeros(unique_labels.size(0))
-        intra_max_distance = torch.zeros(unique_labels.size(0))
-        center_features = torch.zeros(unique_labels.size(0), features.size(1), features.size(2))
-
-        if self.use_gpu:
-            inter_min_distance = inter_min_distance.cuda()
-            intra_max_distance = intra_max_distance.cuda()
-            center_features = center_features.cuda()
-
-        index = torch.range(0, unique_labels.size(0) - 1)
-        for i in range(unique_labels.size(0)):
-            label = unique_labels[i]
-            same_class_features = features[targets == label]
-            center_features[i] = same_class_features.mean(dim=0)
-            intra_class_distance = self._local_dist(center_features[index == i], same_class_features)
-            # print('intra_class_distance', intra_class_distance)
-            intra_max_distance[i] = intra_class_distance.max()
-        # print('intra_max_distance:', intra_max_distance)
-
-        for i in range(unique_labels.size(0)):
-            inter_class_distance = self._local_dist(center_features[index == i], center_features[index != i])
-            # print('inter_class_distance', inter_class_distance)
-            inter_min_distance[i] = inter_class_distance.min()
-        # print('inter_min_distance:', inter_min_distance)
-
+        unique_labels, members = batch_labels(targets, ordered, ids_per_batch, imgs_per_id)
+        center_features = class_centers(features, members)
+        intra_max_distance, inter_min_distance = hardest_distances(
+            self._local_dist(center_features, features), self._local_dist(center_features, center_features), members)
         cluster_loss = torch.mean(torch.relu(intra_max_distance - inter_min_distance + self.margin))
         return cluster_loss, intra_max_distance, inter_min_distance
 
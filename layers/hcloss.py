@@ -1,7 +1,23 @@
-import numpy as np
-from torch import nn, tensor
+from torch import nn
 import torch
-from torch.autograd import Variable
+
+def chunk_centers(feat, label_num):
+	# means of the label_num chunks of an ordered p*k batch (feat.chunk(label_num, 0)), one segment sum
+	size = -(-feat.size(0) // label_num)
+	segment = torch.arange(feat.size(0), device=feat.device) // size
+	count = torch.bincount(segment).unsqueeze(1).to(feat.dtype)
+	centers = feat.new_zeros(count.size(0), feat.size(1)).index_add_(0, segment, feat)
+	return centers / count
+
+
+def center_dist(center1, center2, dist_type='l2'):
+	# row-wise distance of two center matrices, the per-chunk values of MSELoss(sum) / L1Loss / CosineSimilarity
+	if dist_type == 'l2':
+		return torch.sum((center1 - center2) ** 2, dim=1)
+	if dist_type == 'l1':
+		return torch.mean(torch.abs(center1 - center2), dim=1)
+	return 1 - torch.nn.functional.cosine_similarity(center1, center2, dim=1)
+
 
 class hetero_loss(nn.Module):
 	def __init__(self, margin=0.1, dist_type = 'l2'):
@@ -16,25 +32,8 @@ class hetero_loss(nn.Module):
 			self.dist = nn.L1Loss()
 	
 	def forward(self, feat1, feat2, label1):
-		feat_size = feat1.size()[1]
-		feat_num = feat1.size()[0]
 		label_num =  len(label1.unique())
-		feat1 = feat1.chunk(label_num, 0)
-		feat2 = feat2.chunk(label_num, 0)
-		#loss = Variable(.cuda())
-		for i in range(label_num):
-			center1 = torch.mean(feat1[i], dim=0)
-			center2 = torch.mean(feat2[i], dim=0)
-			if self.dist_type == 'l2' or self.dist_type == 'l1':
-				if i == 0:
-					dist = max(0, abs(self.dist(center1, center2)))
-				else:
-					dist += max(0, abs(self.dist(center1, center2)))
-			elif self.dist_type == 'cos':
-				if i == 0:
-					dist = max(0, 1-self.dist(center1, center2))
-				else:
-					dist += max(0, 1-self.dist(center1, center2))
-
-		return dist
-		
\ No newline at end of file
+		center1 = chunk_centers(feat1, label_num)
+		center2 = chunk_centers(feat2, label_num)
+		dist = center_dist(center1, center2, self.dist_type)
+		return torch.clamp(dist, min=0).sum()
@@ -0,0 +1,175 @@
+import torch
+import torch.nn.functional as F
+from .scale_consistency_loss import compute_scale_consistency_loss
+from .memory_bank import FeatureMemory
+
+# terms computed once per batch from the image-text similarity matrix
+BATCH_TERMS = ('sdm', 'cmpc', 'itc')
+
+
+def matching_loss(logits, target_dist, epsilon=1e-8):
+    # KL(pred || target) summed per row and averaged, the core of SDM and CMPM
+    pred = F.softmax(logits, dim=1)
+    return torch.mean(torch.sum(pred * (F.log_softmax(logits, dim=1) - torch.log(target_dist + epsilon)), dim=1))
+
+
+def similarity_terms(image_features, text_features, target, logit_scale, weights, image_id=None, factor=0.3,
+                     epsilon=1e-8, memory=None):
+    """
+    SDM, CMPM and ITC of one batch from a single normalized image-text similarity matrix (same values as
+    compute_sdm / compute_cmpm / compute_itc). Terms whose weight is zero are not computed.
+    `memory` is an optional (image, text, pids) set of normalized cross-batch keys (FeatureMemory.keys()):
+    SDM and ITC then score every query against the batch and the queued features of the other modality.
+    Returns the weighted sum and the unweighted terms that were computed.
+    """
+    image_len = image_features.norm(dim=1, keepdim=True)
+    text_len = text_features.norm(dim=1, keepdim=True)
+    # i2t[i, j] = cos(image_i, text_j), shared by every term
+    i2t = (image_features / image_len) @ (text_features / text_len).t()
+    pid = target.reshape(-1, 1)
+    match = (pid == pid.t()).float()
+    i2m = t2m = None
+    if memory is not None and (weights['sdm'] or weights['itc']):
+        memory_image, memory_text, memory_pids = (key.to(i2t.dtype) if key.is_floating_point() else key
+                                                  for key in memory)
+        # image queries against queued texts, text queries against queued images
+        i2m = (image_features / image_len) @ memory_text.t()
+        t2m = (text_features / text_len) @ memory_image.t()
+        memory_match = (pid == memory_pids.reshape(1, -1)).float()
+    terms = {}
+    if weights['sdm']:
+        labels = match
+        if image_id is not None:
+            image_id = image_id.reshape(-1, 1)
+            image_id_mask = (image_id == image_id.t()).float()
+            labels = (labels - image_id_mask) * factor + image_id_mask
+        if i2m is None:
+            labels_distribute = labels / labels.sum(dim=1)
+            terms['sdm'] = matching_loss(logit_scale * i2t, labels_distribute, epsilon) + \
+                matching_loss(logit_scale * i2t.t(), labels_distribute, epsilon)
+        else:
+            # queued keys count as other images of the same pid
+            labels = torch.cat([labels, memory_match * (factor if image_id is not None else 1.)], dim=1)
+            labels_distribute = labels / labels.sum(dim=1, keepdim=True)
+            terms['sdm'] = matching_loss(logit_scale * torch.cat([i2t, i2m], dim=1), labels_distribute, epsilon) + \
+                matching_loss(logit_scale * torch.cat([i2t.t(), t2m], dim=1), labels_distribute, epsilon)
+    if weights['cmpc']:
+        # CMPM projects the raw features on the normalized ones of the other modality
+        labels_mask_norm = match / match.norm(dim=1)
+        terms['cmpc'] = matching_loss(i2t * image_len, labels_mask_norm, epsilon) + \
+            matching_loss(i2t.t() * text_len, labels_mask_norm, epsilon)
+    if weights['itc']:
+        logits_per_image = logit_scale * i2t
+        logits_per_text = logits_per_image.t()
+        if i2m is not None:
+            # queued keys are extra negatives
+            logits_per_image = torch.cat([logits_per_image, logit_scale * i2m], dim=1)
+            logits_per_text = torch.cat([logits_per_text, logit_scale * t2m], dim=1)
+        labels = torch.arange(i2t.shape[0], device=i2t.device)
+        terms['itc'] = (F.cross_entropy(logits_per_image, labels) + F.cross_entropy(logits_per_text, labels)) / 2
+    total = sum(weights[name] * value for name, value in terms.items())
+    return total, terms
+
+
+class LossGraph(object):
+    """
+    Loss stage of one training step. Per-head terms (ID, triplet, scale consistency) are applied to every
+    (score, feat) head of the model output; batch-level image-text terms (SDM, CMPM, ITC) are computed once per
+    step from one shared similarity matrix. Terms with a zero weight are skipped. With MODEL.MEMORY_SIZE > 0,
+    SDM and ITC also use a cross-batch FeatureMemory of past image/text features, refreshed after every step.
+
+    `step(output, target)` returns the same total as calling the graph once per head (the former loss_func,
+    which recomputed the batch terms for every head): the batch terms are weighted by the number of heads.
+    """
+
+    def __init__(self, cfg, num_classes, id_loss, triplet, logit_scale):
+        self.sampler = cfg.DATALOADER.SAMPLER
+        self.id_loss_fn = id_loss
+        self.triplet = triplet
+        self.logit_scale = logit_scale
+        self.weights = {'id': cfg.MODEL.ID_LOSS_WEIGHT, 'triplet': cfg.MODEL.TRIPLET_LOSS_WEIGHT,
+                        'sdm': cfg.MODEL.SDM_LOSS_WEIGHT, 'cmpc': cfg.MODEL.CMPC_LOSS_WEIGHT,
+                        'itc': cfg.MODEL.ITC_LOSS_WEIGHT, 'scale': cfg.MODEL.SCALE_CONSISTENCY_WEIGHT}
+        if self.sampler == 'softmax':
+            # plain cross entropy, no metric or image-text terms
+            self.weights = dict.fromkeys(self.weights, 0.)
+            self.weights['id'] = 1.
+        self.memory = None
+        if cfg.MODEL.MEMORY_SIZE > 0 and (self.weights['sdm'] or self.weights['itc']):
+            self.memory = FeatureMemory(cfg.MODEL.MEMORY_SIZE)
+
+    def id_loss(self, score, target):
+        if isinstance(score, list):
+            loss = [self.id_loss_fn(scor, target) for scor in score[1:]]
+            return 0.5 * sum(loss) / len(loss) + 0.5 * self.id_loss_fn(score[0], target)
+        return self.id_loss_fn(score, target)
+
+    def triplet_loss(self, feat, target):
+        if isinstance(feat, list):
+            loss = [self.triplet(feats, target)[0] for feats in feat[1:]]
+            return 0.5 * sum(loss) / len(loss) + 0.5 * self.triplet(feat[0], target)[0]
+        return self.triplet(feat, target)[0]
+
+    def head(self, score, feat, target, intermediate_features=None, triplet=True):
+        # weighted per-head terms, triplet=False when the caller mines all heads at once (see step)
+        loss = 0
+        if self.weights['id']:
+            loss = loss + self.weights['id'] * self.id_loss(score, target)
+        if self.weights['triplet'] and triplet:
+            loss = loss + self.weights['triplet'] * self.triplet_loss(feat, target)
+        if self.weights['scale'] and intermediate_features is not None:
+            main = feat[0] if isinstance(feat, list) else feat
+            loss = loss + self.weights['scale'] * compute_scale_consistency_loss(main, intermediate_features)
+        return loss
+
+    def batch(self, image_features, text_features, target, image_id=None, memory=None):
+        # weighted batch-level image-text terms
+        if image_features is None or text_features is None or not any(self.weights[name] for name in BATCH_TERMS):
+            return 0
+        return similarity_terms(image_features, text_features, target, self.logit_scale, self.weights, image_id,
+                                memory=memory)[0]
+
+    def __call__(self, score, feat, target, target_cam=None, image_features=None, text_features=None, image_id=None,
+                 intermediate_features=None):
+        # one head plus the batch terms, the former per-head loss_func
+        return self.head(score, feat, target, intermediate_features) + \
+            self.batch(image_features, text_features, target, image_id)
+
+    def step(self, output, target, target_cam=None, image_id=None):
+        """Total loss of a model output tuple (score, feat, score, feat, ...[, intermediate][, extra])."""
+        output = tuple(output)
+        intermediate_features = None
+        if len(output) > 4 and torch.is_tensor(output[-1]) and output[-1].dim() == 2:
+            # trailing multi-scale intermediate feature
+            intermediate_features = output[-1]
+            output = output[:-1]
+        pairs = len(output) - len(output) % 2
+        heads = [(output[i], output[i + 1], 1.) for i in range(0, pairs, 2)]
+        extra = 0
+        if len(output) % 2 == 1:
+            if isinstance(output[-1], dict):
+                num_region = output[-1]['num']
+                heads += [(output[-1][f'score_{i}'], output[-1][f'feat_{i}'], 1 / num_region)
+                          for i in range(num_region)]
+            else:
+                extra = output[-1]
+        loss = extra
+        feats = [feat for _, feat, _ in heads]
+        # heads with features of one shape share a single batched triplet pass
+        stacked = bool(self.weights['triplet']) and len(feats) > 1 and \
+            all(torch.is_tensor(feat) and feat.shape == feats[0].shape for feat in feats)
+        for score, feat, weight in heads:
+            loss = loss + weight * self.head(score, feat, target, intermediate_features, triplet=not stacked)
+        if stacked:
+            # per-head losses weighted by python floats, no weight tensor copied to the device every step
+            triplet = self.triplet.stacked(feats, target)[0]
+            loss = loss + self.weights['triplet'] * sum(weight * term for (_, _, weight), term in
+                                                        zip(heads, triplet.unbind()))
+        if len(output) >= 4:
+            # image features: fusion_v, text features: ori_t
+            memory = self.memory.keys() if self.memory is not None else None
+            loss = loss + sum(weight for _, _, weight in heads) * self.batch(output[1], output[3], target, image_id,
+                                                                              memory)
+            if self.memory is not None:
+                self.memory.enqueue(output[1], output[3], target)
+        return loss
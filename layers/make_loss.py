@@ -8,10 +8,7 @@ import torch.nn.functional as F
 from .softmax_loss import CrossEntropyLabelSmooth, LabelSmoothingCrossEntropy
 from .triplet_loss import TripletLoss
 from .center_loss import CenterLoss
-from .sdm_loss import compute_sdm
-from .cmpc_loss import compute_cmpm
-from .itc_loss import compute_itc
-from .scale_consistency_loss import compute_scale_consistency_loss
+from .loss_graph import LossGraph
 
 def make_loss(cfg, num_classes):  # modified by gu
     sampler = cfg.DATALOADER.SAMPLER
@@ -34,91 +31,16 @@ def make_loss(cfg, num_classes):  # modified by gu
         print("label smooth on, numclasses:", num_classes)
 
     if sampler == 'softmax':
-        def loss_func(score, feat, target, target_cam):
-            return F.cross_entropy(score, target)
+        loss_func = LossGraph(cfg, num_classes, F.cross_entropy, None, logit_scale)
 
     elif cfg.DATALOADER.SAMPLER == 'softmax_triplet':
-        def loss_func(score, feat, target, target_cam, image_features=None, text_features=None, image_id=None, intermediate_features=None):
-            if cfg.MODEL.METRIC_LOSS_TYPE == 'triplet':
-                if cfg.MODEL.IF_LABELSMOOTH == 'on':
-                    if isinstance(score, list):
-                        ID_LOSS = [xent(scor, target) for scor in score[1:]]
-                        ID_LOSS = sum(ID_LOSS) / len(ID_LOSS)
-                        ID_LOSS = 0.5 * ID_LOSS + 0.5 * xent(score[0], target)
-                    else:
-                        ID_LOSS = xent(score, target)
-
-                    if isinstance(feat, list):
-                        TRI_LOSS = [triplet(feats, target)[0] for feats in feat[1:]]
-                        TRI_LOSS = sum(TRI_LOSS) / len(TRI_LOSS)
-                        TRI_LOSS = 0.5 * TRI_LOSS + 0.5 * triplet(feat[0], target)[0]
-                    else:
-                        TRI_LOSS = triplet(feat, target)[0]
-                    
-                    # 添加SDM损失权重（可在配置文件中设置，默认为1.0）
-                    SDM_LOSS = compute_sdm(image_features, text_features, target, logit_scale, image_id, 0.3, 1e-8)
-
-                    CMPC_LOSS = compute_cmpm(image_features, text_features,target)
-
-                    ITC_LOSS = compute_itc(image_features, text_features, logit_scale)
-
-                    # 计算多尺度一致性损失
-                    SCALE_CONSISTENCY_LOSS = torch.tensor(0.0, device=feat.device if not isinstance(feat, list) else feat[0].device)
-
-                    if intermediate_features is not None:
-                        if isinstance(feat, list):
-                            # 如果feat是列表，取第一个作为主要特征
-                            SCALE_CONSISTENCY_LOSS = compute_scale_consistency_loss(feat[0], intermediate_features)
-                        else:
-                            SCALE_CONSISTENCY_LOSS = compute_scale_consistency_loss(feat, intermediate_features)
-                    return cfg.MODEL.ID_LOSS_WEIGHT * ID_LOSS + \
-                        cfg.MODEL.TRIPLET_LOSS_WEIGHT * TRI_LOSS + \
-                        cfg.MODEL.SDM_LOSS_WEIGHT * SDM_LOSS  + \
-                        cfg.MODEL.CMPC_LOSS_WEIGHT * CMPC_LOSS + \
-                        cfg.MODEL.ITC_LOSS_WEIGHT * ITC_LOSS + \
-                        cfg.MODEL.SCALE_CONSISTENCY_WEIGHT * SCALE_CONSISTENCY_LOSS
-                else:
-                    if isinstance(score, list):
-                        ID_LOSS = [F.cross_entropy(scor, target) for scor in score[1:]]
-                        ID_LOSS = sum(ID_LOSS) / len(ID_LOSS)
-                        ID_LOSS = 0.5 * ID_LOSS + 0.5 * F.cross_entropy(score[0], target)
-                    else:
-                        ID_LOSS = F.cross_entropy(score, target)
-
-                    if isinstance(feat, list):
-                        TRI_LOSS = [triplet(feats, target)[0] for feats in feat[1:]]
-                        TRI_LOSS = sum(TRI_LOSS) / len(TRI_LOSS)
-                        TRI_LOSS = 0.5 * TRI_LOSS + 0.5 * triplet(feat[0], target)[0]
-                    else:
-                        TRI_LOSS = triplet(feat, target)[0]
-
-                    # 添加SDM损失权重（可在配置文件中设置，默认为1.0）
-                    SDM_LOSS = compute_sdm(image_features, text_features, target, logit_scale, image_id, 0.3, 1e-8)
-
-                    CMPC_LOSS = compute_cmpm(image_features, text_features,target)
-
-                    ITC_LOSS = compute_itc(image_features, text_features, logit_scale)
-
-                    # 计算多尺度一致性损失
-                    SCALE_CONSISTENCY_LOSS = torch.tensor(0.0, device=feat.device if not isinstance(feat, list) else feat[0].device)
-
-                    if intermediate_features is not None:
-                        if isinstance(feat, list):
-                            # 如果feat是列表，取第一个作为主要特征
-                            SCALE_CONSISTENCY_LOSS = compute_scale_consistency_loss(feat[0], intermediate_features, scale_consistency_weight)
-                        else:
-                            SCALE_CONSISTENCY_LOSS = compute_scale_consistency_loss(feat, intermediate_features, scale_consistency_weight)
-
-                    return cfg.MODEL.ID_LOSS_WEIGHT * ID_LOSS + \
-                        cfg.MODEL.TRIPLET_LOSS_WEIGHT * TRI_LOSS + \
-                        cfg.MODEL.SDM_LOSS_WEIGHT * SDM_LOSS  + \
-                        cfg.MODEL.CMPC_LOSS_WEIGHT * CMPC_LOSS + \
-                        cfg.MODEL.ITC_LOSS_WEIGHT * ITC_LOSS + \
-                        cfg.MODEL.SCALE_CONSISTENCY_WEIGHT * SCALE_CONSISTENCY_LOSS
-                        
-            else:
-                print('expected METRIC_LOSS_TYPE should be triplet'
-                      'but got {}'.format(cfg.MODEL.METRIC_LOSS_TYPE))
+        if cfg.MODEL.METRIC_LOSS_TYPE == 'triplet':
+            id_loss = xent if cfg.MODEL.IF_LABELSMOOTH == 'on' else F.cross_entropy
+            # per-head ID/triplet terms, SDM/CMPC/ITC once per step (see LossGraph.step)
+            loss_func = LossGraph(cfg, num_classes, id_loss, triplet, logit_scale)
+        else:
+            print('expected METRIC_LOSS_TYPE should be triplet'
+                  'but got {}'.format(cfg.MODEL.METRIC_LOSS_TYPE))
 
     else:
         print('expected sampler should be softmax, triplet, softmax_triplet or softmax_triplet_center'
@@ -0,0 +1,110 @@
+import torch
+import torch.distributed as dist
+import torch.nn.functional as F
+
+
+@torch.no_grad()
+def concat_all_gather(tensor):
+    # features of every DDP rank (equal batch sizes), the local tensor when not distributed
+    if not (dist.is_available() and dist.is_initialized()) or dist.get_world_size() == 1:
+        return tensor
+    gathered = [torch.empty_like(tensor) for _ in range(dist.get_world_size())]
+    dist.all_gather(gathered, tensor.contiguous())
+    return torch.cat(gathered, dim=0)
+
+
+class FeatureMemory(object):
+    """
+    Cross-batch FIFO queue of detached, L2-normalized image and text features with their pids, used as extra
+    keys by the SDM and ITC terms (see similarity_terms). Each enqueue adds the features of all DDP ranks.
+    Buffers are allocated on the first enqueue; every entry is stamped with the enqueue step it came from,
+    so `staleness()` reports how many steps old the keys are and `drift()` how far the encoder has moved.
+    Slots fill in order from 0, so the filled entries are always the first `len(self)` ones; the fill count is
+    kept on the host and no step reads the queue back from the device.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.image = None
+        self.text = None
+        self.pids = None
+        self.stamps = None
+        self.ptr = 0
+        self.steps = 0
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def _allocate(self, dim, dtype, device):
+        self.image = torch.zeros(self.size, dim, dtype=dtype, device=device)
+        self.text = torch.zeros(self.size, dim, dtype=dtype, device=device)
+        self.pids = torch.full((self.size,), -1, dtype=torch.long, device=device)
+        self.stamps = torch.zeros(self.size, dtype=torch.long, device=device)
+
+    def keys(self):
+        """(image, text, pids) of the filled entries, None while the queue is empty."""
+        if not len(self):
+            return None
+        return self.image[:self.count], self.text[:self.count], self.pids[:self.count]
+
+    @torch.no_grad()
+    def enqueue(self, image_features, text_features, pids):
+        image = concat_all_gather(F.normalize(image_features.detach().float(), dim=1))
+        text = concat_all_gather(F.normalize(text_features.detach().float(), dim=1))
+        pids = concat_all_gather(pids.detach())[-self.size:]
+        image, text = image[-self.size:], text[-self.size:]
+        if self.image is None:
+            self._allocate(image.size(1), image.dtype, image.device)
+        elif self.image.device != image.device:
+            # restored from a CPU checkpoint
+            self.image, self.text, self.pids, self.stamps = (buffer.to(image.device) for buffer in
+                                                             (self.image, self.text, self.pids, self.stamps))
+        self.steps += 1
+        index = (self.ptr + torch.arange(pids.size(0), device=pids.device)) % self.size
+        self.image[index] = image
+        self.text[index] = text
+        self.pids[index] = pids
+        self.stamps[index] = self.steps
+        self.ptr = (self.ptr + pids.size(0)) % self.size
+        self.count = min(self.count + pids.size(0), self.size)
+
+    def state_dict(self):
+        return {'size': self.size, 'image': self.image, 'text': self.text, 'pids': self.pids, 'stamps': self.stamps,
+                'ptr': self.ptr, 'steps': self.steps, 'count': self.count}
+
+    def load_state_dict(self, state):
+        if state['size'] != self.size:
+            raise ValueError('Memory of {} entries cannot be restored into one of {}'.format(state['size'], self.size))
+        self.image, self.text, self.pids, self.stamps = state['image'], state['text'], state['pids'], state['stamps']
+        self.ptr, self.steps, self.count = state['ptr'], state['steps'], state['count']
+
+    def staleness(self):
+        """Mean and max age in steps of the filled entries (1 = enqueued by the previous step)."""
+        if not len(self):
+            return 0., 0
+        age = self.steps + 1 - self.stamps[:self.count]
+        return age.float().mean().item(), int(age.max())
+
+    @torch.no_grad()
+    def drift(self, image_features, pids):
+        """
+        Mean cosine between the current per-pid image centers and the queued ones of the same pids (entries of
+        the latest enqueue, usually these very features, are left out), 1 means the stored keys still match the
+        encoder, None when no pid is shared.
+        """
+        if not len(self):
+            return None
+        image, memory_pids = self.image[:self.count], self.pids[:self.count]
+        older = (self.stamps[:self.count] < self.steps).float()
+        current = F.normalize(image_features.detach().float(), dim=1)
+        labels = torch.unique(pids)
+        current_mask = (labels.unsqueeze(1) == pids.unsqueeze(0)).float()
+        memory_mask = (labels.unsqueeze(1) == memory_pids.unsqueeze(0)).float() * older
+        # pids without older queued entries get a zero memory center and are left out of the mean
+        shared = (memory_mask.sum(dim=1) > 0).float()
+        current_center = F.normalize(current_mask @ current, dim=1)
+        memory_center = F.normalize(memory_mask @ image, dim=1)
+        cosine = (current_center * memory_center).sum(dim=1)
+        total, count = torch.stack([(cosine * shared).sum(), shared.sum()]).tolist()
+        return total / count if count else None
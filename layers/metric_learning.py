@@ -15,31 +15,13 @@ class ContrastiveLoss(nn.Module):
         n = inputs.size(0)
         # Compute similarity matrix
         sim_mat = torch.matmul(inputs, inputs.t())
-        targets = targets
-        loss = list()
-        c = 0
-
-        for i in range(n):
-            pos_pair_ = torch.masked_select(sim_mat[i], targets == targets[i])
-
-            #  move itself
-            pos_pair_ = torch.masked_select(pos_pair_, pos_pair_ < 1)
-            neg_pair_ = torch.masked_select(sim_mat[i], targets != targets[i])
-
-            pos_pair_ = torch.sort(pos_pair_)[0]
-            neg_pair_ = torch.sort(neg_pair_)[0]
-
-            neg_pair = torch.masked_select(neg_pair_, neg_pair_ > self.margin)
-
-            neg_loss = 0
-
-            pos_loss = torch.sum(-pos_pair_ + 1)
-            if len(neg_pair) > 0:
-                neg_loss = torch.sum(neg_pair)
-            loss.append(pos_loss + neg_loss)
-
-        loss = sum(loss) / n
-        return loss
+        same = targets.unsqueeze(0) == targets.unsqueeze(1)
+        # positives without the anchor itself (sim < 1), negatives above the margin
+        pos_mask = same & (sim_mat < 1)
+        neg_mask = ~same & (sim_mat > self.margin)
+        pos_loss = torch.where(pos_mask, 1 - sim_mat, torch.zeros_like(sim_mat)).sum()
+        neg_loss = torch.where(neg_mask, sim_mat, torch.zeros_like(sim_mat)).sum()
+        return (pos_loss + neg_loss) / n
 
 
 class CircleLoss(nn.Module):
@@ -1,7 +1,6 @@
-import numpy as np
-from torch import nn, tensor
+from torch import nn
 import torch
-from torch.autograd import Variable
+from .hcloss import chunk_centers, center_dist
 
 
 class multiModalMarginLossNew(nn.Module):
@@ -18,26 +17,12 @@ class multiModalMarginLossNew(nn.Module):
 
     def forward(self, feat1, feat2, feat3, label1):
         # print("using 3MLoss")
-        # print(feat1.shape, feat2.shape, label1.shape, label1)
         label_num = len(label1.unique())
-        feat1 = feat1.chunk(label_num, 0)
-        feat2 = feat2.chunk(label_num, 0)
-        feat3 = feat3.chunk(label_num, 0)
-        # loss = Variable(.cuda())
-        for i in range(label_num):
-          center1 = torch.mean(feat1[i], dim=0)
-          center2 = torch.mean(feat2[i], dim=0)
-          center3 = torch.mean(feat3[i], dim=0)
-          # print(self.dist(center1, center2), self.dist(center1, center3), self.dist(center2, center3))
-          if self.dist_type == 'l2' or self.dist_type == 'l1':
-            if i == 0:
-              # print(self.dist(center1, center2), self.dist(center1, center3), self.dist(center2, center3))
-              dist = max(abs(self.margin - self.dist(center1, center2)), abs(self.margin - self.dist(center2, center3)), abs(self.margin - self.dist(center1, center3)))
-              # dist = max(0, abs(self.margin - self.dist(center1, center2)))
-            else:
-              dist += max(abs(self.margin - self.dist(center1, center2)), abs(self.margin - self.dist(center2, center3)), abs(self.margin - self.dist(center1, center3)))
-              # dist += max(0, abs(self.margin - self.dist(center1, center2)))
-        return dist
-
-
-
+        center1 = chunk_centers(feat1, label_num)
+        center2 = chunk_centers(feat2, label_num)
+        center3 = chunk_centers(feat3, label_num)
+        # per chunk the largest |margin - d| of the three center pairs, summed over the chunks
+        dist = torch.stack([center_dist(center1, center2, self.dist_type),
+                            center_dist(center2, center3, self.dist_type),
+                            center_dist(center1, center3, self.dist_type)], dim=1)
+        return torch.abs(self.margin - dist).amax(dim=1).sum()
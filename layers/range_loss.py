@@ -2,6 +2,7 @@ from __future__ import absolute_import
 
 import torch
 from torch import nn
+from .cluster_loss import batch_labels, class_centers
 
 
 class RangeLoss(nn.Module):
@@ -31,7 +32,7 @@ class RangeLoss(nn.Module):
         n = features.size(0)
         dist = torch.pow(features, 2).sum(dim=1, keepdim=True).expand(n, n)
         dist = dist + dist.t()
-        dist.addmm_(1, -2, features, features.t())
+        dist = dist.addmm(features, features.t(), beta=1, alpha=-2)
         dist = dist.clamp(min=1e-12).sqrt()  # for numerical stability
         return dist
 
@@ -86,9 +87,10 @@ class RangeLoss(nn.Module):
         print(min_inter_class_dist)
         '''
         n = center_features.size(0)
-        dist_array2 = self._pairwise_distance(center_features)
-        min_inter_class_dist2 = dist_array2.view(1, -1).sort()[0][0][n]  # exclude self compare, the first one is the min_inter_class_dist
-        return min_inter_class_dist2
+        dist_array = self._pairwise_distance(center_features)
+        # exclude self compare, the smallest remaining entry is the min_inter_class_dist
+        eye = torch.eye(n, dtype=torch.bool, device=dist_array.device)
+        return dist_array.masked_fill(eye, float('inf')).min()
 
     def _calculate_centers(self, features, targets, ordered, ids_per_batch, imgs_per_id):
         """
@@ -101,32 +103,8 @@ class RangeLoss(nn.Module):
          Return:
             center_features: center matrix (before softmax) with shape (center_number, center_dim)
         """
-        if self.use_gpu:
-            if ordered:
-                if targets.size(0) == ids_per_batch * imgs_per_id:
-                    unique_labels = targets[0:targets.size(0):imgs_per_id]
-                else:
-                    unique_labels = targets.cpu().unique().cuda()
-            else:
-                unique_labels = targets.cpu().unique().cuda()
-        else:
-            if ordered:
-                if targets.size(0) == ids_per_batch * imgs_per_id:
-                    unique_labels = targets[0:targets.size(0):imgs_per_id]
-                else:
-                    unique_labels = targets.unique()
-            else:
-                unique_labels = targets.unique()
-
-        center_features = torch.zeros(unique_labels.size(0), features.size(1))
-        if self.use_gpu:
-            center_features = center_features.cuda()
-
-        for i in range(unique_labels.size(0)):
-            label = unique_labels[i]
-            same_class_features = features[targets == label]
-            center_features[i] = same_class_features.mean(dim=0)
-        return center_features
+        unique_labels, members = batch_labels(targets, ordered, ids_per_batch, imgs_per_id)
+        return class_centers(features, members)
 
     def _inter_class_loss(self, features, targets, ordered, ids_per_batch, imgs_per_id):
         """
@@ -156,31 +134,19 @@ class RangeLoss(nn.Module):
          Return:
             intra_class_loss
         """
-        if self.use_gpu:
-            if ordered:
-                if targets.size(0) == ids_per_batch * imgs_per_id:
-                    unique_labels = targets[0:targets.size(0):imgs_per_id]
-                else:
-                    unique_labels = targets.cpu().unique().cuda()
-            else:
-                unique_labels = targets.cpu().unique().cuda()
-        else:
-            if ordered:
-                if targets.size(0) == ids_per_batch * imgs_per_id:
-                    unique_labels = targets[0:targets.size(0):imgs_per_id]
-                else:
-                    unique_labels = targets.unique()
-            else:
-                unique_labels = targets.unique()
-
-        intra_distance = torch.zeros(unique_labels.size(0))
-        if self.use_gpu:
-            intra_distance = intra_distance.cuda()
-
-        for i in range(unique_labels.size(0)):
-            label = unique_labels[i]
-            same_class_distances = 1.0 / self._compute_top_k(features[targets == label])
-            intra_distance[i] = self.k / torch.sum(same_class_distances)
+        unique_labels, members = batch_labels(targets, ordered, ids_per_batch, imgs_per_id)
+        # top k of every class from one distance matrix: each pair appears twice, keep every second value
+        same_class = members.unsqueeze(2) & members.unsqueeze(1)
+        dist_array = self._pairwise_distance(features).unsqueeze(0).masked_fill(~same_class, float('-inf'))
+        top = dist_array.flatten(1).topk(self.k * 2, dim=1)[0]
+        # a class with fewer than 2k entries (m * m) keeps all of them from the smallest up, as sort()[-2k::2]:
+        # with an odd count that is every second value starting at the largest instead of the second largest
+        entries = members.sum(dim=1, keepdim=True) ** 2
+        start = torch.where((entries < self.k * 2) & (entries % 2 == 1), 0, 1)
+        position = start + 2 * torch.arange(self.k, device=top.device)
+        top_k = top.gather(1, position.clamp(max=self.k * 2 - 1))
+        inverse = torch.where(position < entries, 1.0 / top_k, torch.zeros_like(top_k))
+        intra_distance = self.k / torch.sum(inverse, dim=1)
         # print('intra_distace:', intra_distance)
         return torch.sum(intra_distance)
 
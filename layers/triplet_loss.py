@@ -1,5 +1,6 @@
 import torch
 from torch import nn
+import torch.nn.functional as F
 
 
 def normalize(x, axis=-1):
@@ -104,6 +105,35 @@ def hard_example_mining(dist_mat, labels, return_inds=False):
     return dist_ap, dist_an
 
 
+def batched_euclidean_dist(feats):
+    """
+    Args:
+      feats: pytorch Variable, stack of feature heads with shape [H, N, D]
+    Returns:
+      dist: pytorch Variable, per-head pairwise distances with shape [H, N, N], one batched matmul
+    """
+    sq = torch.pow(feats, 2).sum(-1)
+    dist = sq.unsqueeze(-1) + sq.unsqueeze(-2)
+    dist = dist - 2 * torch.matmul(feats, feats.transpose(-2, -1))
+    return dist.clamp(min=1e-12).sqrt()  # for numerical stability
+
+
+def batched_hard_example_mining(dist_mat, labels):
+    """Hardest positive and negative of every anchor for a stack of distance matrices.
+    Args:
+      dist_mat: pytorch Variable, pair wise distances with shape [H, N, N]
+      labels: pytorch LongTensor, with shape [N]
+    Returns:
+      dist_ap: pytorch Variable, distance(anchor, positive); shape [H, N]
+      dist_an: pytorch Variable, distance(anchor, negative); shape [H, N]
+    NOTE: masked max/min instead of gathers, identities may have any number of samples.
+    """
+    is_pos = labels.unsqueeze(0).eq(labels.unsqueeze(1))
+    dist_ap = dist_mat.masked_fill(~is_pos, float('-inf')).amax(dim=-1)
+    dist_an = dist_mat.masked_fill(is_pos, float('inf')).amin(dim=-1)
+    return dist_ap, dist_an
+
+
 class TripletLoss(object):
     """
     Triplet loss using HARDER example mining,
@@ -134,6 +164,26 @@ class TripletLoss(object):
             loss = self.ranking_loss(dist_an - dist_ap, y)
         return loss, dist_ap, dist_an
 
+    def stacked(self, feats, labels, normalize_feature=False):
+        """
+        Triplet loss of H heads sharing the labels in one pass, feats: [H, N, D] or a list of [N, D].
+        Returns the per-head losses [H] and dist_ap, dist_an [H, N]; each head equals __call__ on it alone.
+        """
+        if isinstance(feats, (list, tuple)):
+            feats = torch.stack(feats, dim=0)
+        if normalize_feature:
+            feats = normalize(feats, axis=-1)
+        dist_ap, dist_an = batched_hard_example_mining(batched_euclidean_dist(feats), labels)
+
+        dist_ap = dist_ap * (1.0 + self.hard_factor)
+        dist_an = dist_an * (1.0 - self.hard_factor)
+
+        y = torch.ones_like(dist_an)
+        if self.margin is not None:
+            loss = F.margin_ranking_loss(dist_an, dist_ap, y, margin=self.margin, reduction='none')
+        else:
+            loss = F.soft_margin_loss(dist_an - dist_ap, y, reduction='none')
+        return loss.mean(dim=-1), dist_ap, dist_an
 
 
 class MultiModalTripletLoss(object):
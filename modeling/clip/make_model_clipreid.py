@@ -3,7 +3,8 @@ import torch.nn as nn
 import numpy as np
 from modeling.clip.simple_tokenizer import SimpleTokenizer as _Tokenizer
 _tokenizer = _Tokenizer()
-from timm.models.layers import DropPath, to_2tuple, trunc_normal_
+from modeling.backbones.vit_pytorch import DropPath, to_2tuple, trunc_normal_
+from utils.startup import profiler as startup
 
 def weights_init_kaiming(m):
     classname = m.__class__.__name__
@@ -177,13 +178,14 @@ def load_clip_to_cpu(cfg, backbone_name, h_resolution, w_resolution, vision_stri
     print("Currently, the model path is set to: ", model_path)
     print("~Please Change the model path to your own path~")
 
-    try:
-        # loading JIT archive
-        model = torch.jit.load(model_path, map_location="cpu").eval()
-        state_dict = None
+    with startup.stage('weight load (CLIP)'):
+        try:
+            # loading JIT archive
+            model = torch.jit.load(model_path, map_location="cpu").eval()
+            state_dict = None
 
-    except RuntimeError:
-        state_dict = torch.load(model_path, map_location="cpu")
+        except RuntimeError:
+            state_dict = torch.load(model_path, map_location="cpu")
 
     model = clip.build_model(cfg,state_dict or model.state_dict(), h_resolution, w_resolution, vision_stride_size)
 
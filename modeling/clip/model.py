@@ -5,6 +5,7 @@ import numpy as np
 import torch
 import torch.nn.functional as F
 from torch import nn
+from torch.utils.checkpoint import checkpoint
 from modeling.backbones.vit_pytorch import trunc_normal_
 
 
@@ -165,6 +166,10 @@ class QuickGELU(nn.Module):
         return x * torch.sigmoid(1.702 * x)
 
 
+# order of the prompt groups appended to the token sequence, indexed by the tower modality
+PROMPT_SLOTS = ('rgb', 'nir', 'tir')
+
+
 class ResidualAttentionBlock(nn.Module):
     def __init__(self, d_model: int, n_head: int, attn_mask: torch.Tensor = None, pattern=None):
         super().__init__()
@@ -187,6 +192,8 @@ class ResidualAttentionBlock(nn.Module):
                 self.adapter_prompt_rgb = nn.Parameter(torch.zeros(self.k, d_model))
                 self.adapter_prompt_nir = nn.Parameter(torch.zeros(self.k, d_model))
                 self.adapter_prompt_tir = nn.Parameter(torch.zeros(self.k, d_model))
+                # constant cross-modal prompt groups per modality, see constant_prompts
+                self._prompt_cache = {}
                 self.adapter_transfer = nn.Sequential(nn.Linear(d_model, int(d_model // 2)),
                                                       QuickGELU(),
                                                       nn.Dropout(dropout),
@@ -225,6 +232,18 @@ class ResidualAttentionBlock(nn.Module):
         self.attn_mask = self.attn_mask.to(dtype=x.dtype, device=x.device) if self.attn_mask is not None else None
         return self.attn(x, x, x, need_weights=False, attn_mask=self.attn_mask)[0]
 
+    def cls_attention(self, x: torch.Tensor):
+        # attention of the CLS query over all tokens [B, L] (head averaged), only the CLS row is projected
+        y = self.ln_1(x)
+        d_model, num_heads = y.shape[-1], self.attn.num_heads
+        weight, bias = self.attn.in_proj_weight, self.attn.in_proj_bias
+        q = F.linear(y[0], weight[:d_model], bias[:d_model] if bias is not None else None)
+        k = F.linear(y, weight[d_model:2 * d_model], bias[d_model:2 * d_model] if bias is not None else None)
+        q = q.reshape(q.shape[0], num_heads, -1)
+        k = k.reshape(k.shape[0], k.shape[1], num_heads, -1)
+        scores = torch.einsum('bhd,lbhd->bhl', q, k) * q.shape[-1] ** -0.5
+        return scores.float().softmax(dim=-1).mean(dim=1)
+
     def forward_ori(self, x: torch.Tensor):
         x = x + self.attention(self.ln_1(x))
         x = x + self.mlp(self.ln_2(x))
@@ -236,157 +255,107 @@ class ResidualAttentionBlock(nn.Module):
         x = x + self.mlp(self.ln_2(x)) + adapter_ffn
         return x
 
+    def prompt_weights(self):
+        return [self.adapter_prompt_rgb, self.adapter_prompt_nir, self.adapter_prompt_tir] + \
+            [p for adapter in (self.adapter_r, self.adapter_n, self.adapter_t) for p in adapter.parameters()]
+
+    def constant_prompts(self, modality):
+        """
+        Prompt groups appended for `modality`, [3, k, D] in PROMPT_SLOTS order: the own slot holds the raw prompt,
+        the other two the prompt plus its cross-modal adapter. The adapters act per token, so they run on the k
+        prompt tokens once instead of on the batch-expanded copies. In eval mode under no_grad the result is
+        cached per modality until one of the weights changes.
+        """
+        cacheable = not self.training and not torch.is_grad_enabled() and not torch.compiler.is_compiling()
+        if cacheable:
+            stamp = tuple((p.data_ptr(), p._version) for p in self.prompt_weights())
+            cached = self._prompt_cache.get(modality)
+            if cached is not None and cached[0] == stamp:
+                return cached[1]
+        own = PROMPT_SLOTS.index(modality)
+        groups = []
+        for slot, (prompt, adapter) in enumerate(((self.adapter_prompt_rgb, self.adapter_r),
+                                                  (self.adapter_prompt_nir, self.adapter_n),
+                                                  (self.adapter_prompt_tir, self.adapter_t))):
+            groups.append(prompt if slot == own else prompt + adapter(prompt))
+        prompts = torch.stack(groups, dim=0)
+        if cacheable:
+            self._prompt_cache[modality] = (stamp, prompts)
+        return prompts
+
+    def prompt_sequence(self, x: torch.Tensor, modality, last_prompt=None):
+        """
+        [x; rgb; nir; tir] prompt groups of k tokens each, written into one buffer of the final length.
+        With a prompt carried over from the previous block, the own slot becomes
+        last_prompt + adapter_transfer(last_prompt) + own prompt.
+        """
+        L, B, D = x.shape
+        out = x.new_empty(L + 3 * self.k, B, D)
+        out[:L] = x
+        out[L:].view(3, self.k, B, D).copy_(self.constant_prompts(modality).unsqueeze(2))
+        if last_prompt is not None:
+            own = L + PROMPT_SLOTS.index(modality) * self.k
+            out[own:own + self.k] += last_prompt + self.adapter_transfer(last_prompt)
+        return out
+
     def forward_with_prompt_only_first_layer(self, x: torch.Tensor, modality=None, index=None, last_prompt=None):
-        if modality == 'rgb':
-            if index == 0:
-                n2r = self.adapter_prompt_nir.unsqueeze(1).expand(-1, x.shape[1], -1) + self.adapter_n(
-                    self.adapter_prompt_nir.unsqueeze(1).expand(-1, x.shape[1], -1))
-                t2r = self.adapter_prompt_tir.unsqueeze(1).expand(-1, x.shape[1], -1) + self.adapter_t(
-                    self.adapter_prompt_tir.unsqueeze(1).expand(-1, x.shape[1], -1))
-                r = self.adapter_prompt_rgb.unsqueeze(1).expand(-1, x.shape[1], -1)
-            elif index == 1:
-                r = last_prompt + self.adapter_transfer(last_prompt)
-                n2r = last_prompt
-                t2r = last_prompt
-            else:
-                r = last_prompt
-                n2r = last_prompt
-                t2r = last_prompt
-            x = torch.cat([x, r, n2r, t2r], dim=0)
-        elif modality == 'nir':
-            if index == 0:
-                r2n = self.adapter_prompt_rgb.unsqueeze(1).expand(-1, x.shape[1], -1) + self.adapter_r(
-                    self.adapter_prompt_rgb.unsqueeze(1).expand(-1, x.shape[1], -1))
-                t2n = self.adapter_prompt_tir.unsqueeze(1).expand(-1, x.shape[1], -1) + self.adapter_t(
-                    self.adapter_prompt_tir.unsqueeze(1).expand(-1, x.shape[1], -1))
-                n = self.adapter_prompt_nir.unsqueeze(1).expand(-1, x.shape[1], -1)
-            elif index == 1:
-                n = last_prompt + self.adapter_transfer(last_prompt)
-                r2n = last_prompt
-                t2n = last_prompt
-            else:
-                n = last_prompt
-                r2n = last_prompt
-                t2n = last_prompt
-            x = torch.cat([x, r2n, n, t2n], dim=0)
-        elif modality == 'tir':
-            if index == 0:
-                r2t = self.adapter_prompt_rgb.unsqueeze(1).expand(-1, x.shape[1], -1) + self.adapter_r(
-                    self.adapter_prompt_rgb.unsqueeze(1).expand(-1, x.shape[1], -1))
-                n2t = self.adapter_prompt_nir.unsqueeze(1).expand(-1, x.shape[1], -1) + self.adapter_n(
-                    self.adapter_prompt_nir.unsqueeze(1).expand(-1, x.shape[1], -1))
-                t = self.adapter_prompt_tir.unsqueeze(1).expand(-1, x.shape[1], -1)
-            elif index == 1:
-                t = last_prompt + self.adapter_transfer(last_prompt)
-                r2t = last_prompt
-                n2t = last_prompt
-            else:
-                t = last_prompt
-                r2t = last_prompt
-                n2t = last_prompt
-            x = torch.cat([x, r2t, n2t, t], dim=0)
+        if index == 0:
+            x = self.prompt_sequence(x, modality)
+        else:
+            groups = [last_prompt] * 3
+            if index == 1:
+                groups[PROMPT_SLOTS.index(modality)] = last_prompt + self.adapter_transfer(last_prompt)
+            x = torch.cat([x] + groups, dim=0)
         x = x + self.attention(self.ln_1(x))
         x = x + self.mlp(self.ln_2(x))
         prompt_current = (x[-3 * self.k:-2 * self.k] + x[-2 * self.k:-1 * self.k] + x[-1 * self.k:]) / 3
-        if modality == 'rgb':
-            return x[:-3 * self.k], prompt_current
-        elif modality == 'nir':
-            return x[:-3 * self.k], prompt_current
-        elif modality == 'tir':
-            return x[:-3 * self.k], prompt_current
+        return x[:-3 * self.k], prompt_current
 
     def forward_with_prompt(self, x: torch.Tensor, modality=None, index=None, last_prompt=None):
-        if modality == 'rgb':
-            n2r = self.adapter_prompt_nir.unsqueeze(1).expand(-1, x.shape[1], -1) + self.adapter_n(
-                self.adapter_prompt_nir.unsqueeze(1).expand(-1, x.shape[1], -1))
-            t2r = self.adapter_prompt_tir.unsqueeze(1).expand(-1, x.shape[1], -1) + self.adapter_t(
-                self.adapter_prompt_tir.unsqueeze(1).expand(-1, x.shape[1], -1))
-            if last_prompt != None:
-                r = (last_prompt + self.adapter_transfer(last_prompt) + self.adapter_prompt_rgb.unsqueeze(1).expand(
-                    -1, x.shape[1], -1))
-            else:
-                r = self.adapter_prompt_rgb.unsqueeze(1).expand(-1, x.shape[1], -1)
-            x = torch.cat([x, r, n2r, t2r], dim=0)
-        elif modality == 'nir':
-            r2n = self.adapter_prompt_rgb.unsqueeze(1).expand(-1, x.shape[1], -1) + self.adapter_r(
-                self.adapter_prompt_rgb.unsqueeze(1).expand(-1, x.shape[1], -1))
-            t2n = self.adapter_prompt_tir.unsqueeze(1).expand(-1, x.shape[1], -1) + self.adapter_t(
-                self.adapter_prompt_tir.unsqueeze(1).expand(-1, x.shape[1], -1))
-            if last_prompt != None:
-                n = (last_prompt + self.adapter_transfer(last_prompt) + self.adapter_prompt_nir.unsqueeze(1).expand(
-                    -1, x.shape[1], -1))
-            else:
-                n = self.adapter_prompt_nir.unsqueeze(1).expand(-1, x.shape[1], -1)
-            x = torch.cat([x, r2n, n, t2n], dim=0)
-        elif modality == 'tir':
-            r2t = self.adapter_prompt_rgb.unsqueeze(1).expand(-1, x.shape[1], -1) + self.adapter_r(
-                self.adapter_prompt_rgb.unsqueeze(1).expand(-1, x.shape[1], -1))
-            n2t = self.adapter_prompt_nir.unsqueeze(1).expand(-1, x.shape[1], -1) + self.adapter_n(
-                self.adapter_prompt_nir.unsqueeze(1).expand(-1, x.shape[1], -1))
-            if last_prompt != None:
-                t = (last_prompt + self.adapter_transfer(last_prompt) + self.adapter_prompt_tir.unsqueeze(
-                    1).expand(-1, x.shape[1], -1))
-            else:
-                t = self.adapter_prompt_tir.unsqueeze(1).expand(-1, x.shape[1], -1)
-            x = torch.cat([x, r2t, n2t, t], dim=0)
+        x = self.prompt_sequence(x, modality, last_prompt)
         x = x + self.attention(self.ln_1(x))
         x = x + self.mlp(self.ln_2(x))
         prompt_current = (x[-3 * self.k:-2 * self.k] + x[-2 * self.k:-1 * self.k] + x[-1 * self.k:]) / 3
-        if modality == 'rgb':
-            return x[:-3 * self.k], prompt_current
-        elif modality == 'nir':
-            return x[:-3 * self.k], prompt_current
-        elif modality == 'tir':
-            return x[:-3 * self.k], prompt_current
+        return x[:-3 * self.k], prompt_current
 
     def forward_with_prompt_adapter(self, x: torch.Tensor, modality=None, index=None, last_prompt=None):
-        if modality == 'rgb':
-            n2r = self.adapter_prompt_nir.unsqueeze(1).expand(-1, x.shape[1], -1) + self.adapter_n(
-                self.adapter_prompt_nir.unsqueeze(1).expand(-1, x.shape[1], -1))
-            t2r = self.adapter_prompt_tir.unsqueeze(1).expand(-1, x.shape[1], -1) + self.adapter_t(
-                self.adapter_prompt_tir.unsqueeze(1).expand(-1, x.shape[1], -1))
-            if last_prompt != None:
-                r = (last_prompt + self.adapter_transfer(last_prompt) + self.adapter_prompt_rgb.unsqueeze(1).expand(
-                    -1, x.shape[1], -1))
-            else:
-                r = self.adapter_prompt_rgb.unsqueeze(1).expand(-1, x.shape[1], -1)
-            x = torch.cat([x, r, n2r, t2r], dim=0)
-        elif modality == 'nir':
-            r2n = self.adapter_prompt_rgb.unsqueeze(1).expand(-1, x.shape[1], -1) + self.adapter_r(
-                self.adapter_prompt_rgb.unsqueeze(1).expand(-1, x.shape[1], -1))
-            t2n = self.adapter_prompt_tir.unsqueeze(1).expand(-1, x.shape[1], -1) + self.adapter_t(
-                self.adapter_prompt_tir.unsqueeze(1).expand(-1, x.shape[1], -1))
-            if last_prompt != None:
-                n = (last_prompt + self.adapter_transfer(last_prompt) + self.adapter_prompt_nir.unsqueeze(1).expand(
-                    -1, x.shape[1], -1))
-            else:
-                n = self.adapter_prompt_nir.unsqueeze(1).expand(-1, x.shape[1], -1)
-            x = torch.cat([x, r2n, n, t2n], dim=0)
-        elif modality == 'tir':
-            r2t = self.adapter_prompt_rgb.unsqueeze(1).expand(-1, x.shape[1], -1) + self.adapter_r(
-                self.adapter_prompt_rgb.unsqueeze(1).expand(-1, x.shape[1], -1))
-            n2t = self.adapter_prompt_nir.unsqueeze(1).expand(-1, x.shape[1], -1) + self.adapter_n(
-                self.adapter_prompt_nir.unsqueeze(1).expand(-1, x.shape[1], -1))
-            if last_prompt != None:
-                t = (last_prompt + self.adapter_transfer(last_prompt) + self.adapter_prompt_tir.unsqueeze(
-                    1).expand(-1, x.shape[1], -1))
-            else:
-                t = self.adapter_prompt_tir.unsqueeze(1).expand(-1, x.shape[1], -1)
-            x = torch.cat([x, r2t, n2t, t], dim=0)
-
+        x = self.prompt_sequence(x, modality, last_prompt)
         x = x + self.attention(self.ln_1(x))
         adapter_ffn = self.adapter_ffn(x)
         x = x + self.mlp(self.ln_2(x)) + adapter_ffn
         prompt_current = (x[-3 * self.k:-2 * self.k] + x[-2 * self.k:-1 * self.k] + x[-1 * self.k:]) / 3
-        if modality == 'rgb':
-            return x[:-3 * self.k], prompt_current
-        elif modality == 'nir':
-            return x[:-3 * self.k], prompt_current
-        elif modality == 'tir':
-            return x[:-3 * self.k], prompt_current
+        return x[:-3 * self.k], prompt_current
+
+    def plan_step(self, index, prompt_sign, adapter_sign, prompted):
+        """
+        Name of the step_* method that forward() dispatches to for this block at `index`, resolved once for a
+        tower: `prompted` is whether the tower runs with modality prompts (visual towers) or not (text tower).
+        """
+        if prompt_sign and prompted:
+            if adapter_sign:
+                return 'step_prompt_adapter'
+            return 'step_prompt' if index > self.begin else 'step_plain'
+        return 'step_adapter' if adapter_sign and index > self.begin else 'step_plain'
+
+    # uniform (x, modality, last_prompt) -> (x, last_prompt) steps of a layer plan
+    def step_plain(self, x: torch.Tensor, modality=None, last_prompt=None):
+        return self.forward_ori(x), last_prompt
+
+    def step_adapter(self, x: torch.Tensor, modality=None, last_prompt=None):
+        return self.forward_with_adapter(x), last_prompt
+
+    def step_prompt(self, x: torch.Tensor, modality=None, last_prompt=None):
+        return self.forward_with_prompt(x, modality, None, last_prompt)
+
+    def step_prompt_adapter(self, x: torch.Tensor, modality=None, last_prompt=None):
+        return self.forward_with_prompt_adapter(x, modality, None, last_prompt)
 
     def forward(self, x: torch.Tensor, modality=None, index=None, last_prompt=None, prompt_sign=True,
                 adapter_sign=True):
+        if prompt_sign and modality not in PROMPT_SLOTS:
+            # no modality prompts for this input (e.g. the text tower), the carried prompt passes through
+            x = self.forward_with_adapter(x) if adapter_sign and index > self.begin else self.forward_ori(x)
+            return x, last_prompt
         if prompt_sign and adapter_sign:
             return self.forward_with_prompt_adapter(x, modality, index, last_prompt)
         elif prompt_sign and not adapter_sign:
@@ -410,9 +379,28 @@ class Transformer(nn.Module):
         self.layers = layers
         self.resblocks = nn.Sequential(
             *[ResidualAttentionBlock(width, heads, attn_mask, pattern) for _ in range(layers)])
-
-    def forward(self, x: torch.Tensor, modality=None, index=None, last_prompt=None):
-        return self.resblocks(x, modality, index, last_prompt)
+        self.build_plan('prompt' in (pattern or ()), 'adapter' in (pattern or ()))
+        # activation checkpointing of every grad_ckpt-th block while training (0 disables)
+        self.grad_ckpt = 0
+
+    def build_plan(self, prompt_sign, adapter_sign):
+        # static per-layer call plan for prompted (visual) and unprompted (text) towers, no dispatch at run time
+        self.plan = {prompted: tuple(block.plan_step(i, prompt_sign, adapter_sign, prompted)
+                                     for i, block in enumerate(self.resblocks))
+                     for prompted in (True, False)}
+
+    def run_layer(self, i, x: torch.Tensor, modality=None, last_prompt=None):
+        # modality is a plain string, torch.compile guards on it as a constant (one graph per tower modality)
+        step = getattr(self.resblocks[i], self.plan[modality in PROMPT_SLOTS][i])
+        if self.grad_ckpt and i % self.grad_ckpt == 0 and self.training and torch.is_grad_enabled():
+            # the block's activations are recomputed in backward, only its inputs are kept
+            return checkpoint(step, x, modality, last_prompt, use_reentrant=False)
+        return step(x, modality, last_prompt)
+
+    def forward(self, x: torch.Tensor, modality=None, last_prompt=None):
+        for i in range(len(self.resblocks)):
+            x, last_prompt = self.run_layer(i, x, modality, last_prompt)
+        return x, last_prompt
 
 
 class VisionTransformer(nn.Module):
@@ -453,8 +441,115 @@ class VisionTransformer(nn.Module):
             self.ln_intermediate = LayerNorm(width)
             self.proj_intermediate = nn.Parameter(scale * torch.randn(width, output_dim))
 
-    def forward_old(self, x: torch.Tensor, cv_emb=None, modality=None, text_inverse=None):
+        # position embeddings resampled for other patch grids, keyed by (h, w)
+        self._pos_embed_cache = {}
+
+        # progressive patch-token pruning (CLS ranked), blocks before which the patch tokens are pruned
+        self.prune_layers = set(cfg.MODEL.PRUNE_LAYERS)
+        self.prune_keep = cfg.MODEL.PRUNE_KEEP
+
+    def grid_positional_embedding(self, h, w):
+        """
+        Position embedding for an h x w patch grid.
+        The native grid returns the parameter itself, other grids are resampled with the same
+        bilinear interpolation as `resize_pos_embed` and cached while the weights stay unchanged.
+        """
+        if (h, w) == (self.h_resolution, self.w_resolution):
+            return self.positional_embedding
+        posemb = self.positional_embedding
+        cacheable = not (torch.is_grad_enabled() and posemb.requires_grad) and not torch.compiler.is_compiling()
+        if cacheable:
+            stamp = (posemb.data_ptr(), posemb._version, posemb.dtype)
+            cached = self._pos_embed_cache.get((h, w))
+            if cached is not None and cached[0] == stamp:
+                return cached[1]
+        num_extra = 0 if self.forward_type == 'new' else 1
+        posemb_new = torch.cat([posemb[:num_extra], resample_pos_grid(posemb[num_extra:], (self.h_resolution,
+                                                                                          self.w_resolution),
+                                                                      (h, w))], dim=0)
+        if cacheable:
+            self._pos_embed_cache[(h, w)] = (stamp, posemb_new)
+        return posemb_new
+
+    def intermediate_split(self):
+        """
+        Number of blocks that run before the intermediate features are taken,
+        None when multi-scale features are disabled or INTERMEDIATE_LAYER_IDX is out of range.
+        """
+        depth = len(self.transformer.resblocks)
+        split = depth + self.intermediate_layer_idx + 1
+        if self.multi_scale and 0 < split <= depth:
+            return split
+        return None
+
+    def init_token_index(self, x: torch.Tensor, has_inverse=False):
+        """
+        Original position of every token row [L, B] when pruning is enabled (None otherwise):
+        patch index for patches, -1 for CLS, -2 for the aggregate of pruned patches, -3 for the inverse-text token.
+        """
+        if not self.prune_layers:
+            return None
+        num_patches = x.shape[0] - 1 - int(has_inverse)
+        token_index = torch.arange(-1, num_patches, device=x.device)
+        if has_inverse:
+            token_index = torch.cat([token_index, token_index.new_full((1,), -3)])
+        return token_index.unsqueeze(1).expand(-1, x.shape[1]).contiguous()
+
+    def prune_tokens(self, x: torch.Tensor, token_index: torch.Tensor, block):
+        """
+        Keep the top PRUNE_KEEP patch tokens ranked by the CLS attention of `block`. The dropped patches and the
+        previous aggregate are fused into one attention-weighted aggregate token. CLS and inverse-text tokens are
+        always kept, prompt tokens are concatenated inside the blocks and are not affected.
+        """
+        kind = token_index[:, 0]
+        patch_rows = (kind >= 0).nonzero().squeeze(1)
+        num_keep = max(1, int(round(patch_rows.numel() * self.prune_keep)))
+        if num_keep >= patch_rows.numel():
+            return x, token_index
+        attn = block.cls_attention(x)
+        patch_attn = attn[:, patch_rows]
+        keep = patch_attn.topk(num_keep, dim=1).indices.sort(dim=1).values  # [B, k], kept in spatial order
+        weights = patch_attn.scatter(1, keep, 0.)
+        fuse_rows = patch_rows
+        agg_rows = (kind == -2).nonzero().squeeze(1)
+        if agg_rows.numel():
+            weights = torch.cat([weights, attn[:, agg_rows]], dim=1)
+            fuse_rows = torch.cat([patch_rows, agg_rows])
+        weights = weights / weights.sum(dim=1, keepdim=True).clamp_min(1e-12)
+        aggregate = torch.einsum('bp,pbd->bd', weights.to(x.dtype), x[fuse_rows])
+
+        batch = torch.arange(x.shape[1], device=x.device)
+        keep_rows = patch_rows[keep].t()  # [k, B]
+        cls_rows, tail_rows = (kind == -1).nonzero().squeeze(1), (kind == -3).nonzero().squeeze(1)
+        x = torch.cat([x[cls_rows], x[keep_rows, batch], aggregate.unsqueeze(0), x[tail_rows]], dim=0)
+        token_index = torch.cat([token_index[cls_rows], token_index[keep_rows, batch],
+                                 token_index.new_full((1, x.shape[1]), -2), token_index[tail_rows]], dim=0)
+        return x, token_index
+
+    def unprune(self, x: torch.Tensor, token_index, num_patches):
+        # scatter pruned NLD features back to the full patch grid, dropped positions take the aggregate token
+        if token_index is None or not (token_index[:, 0] == -2).any():
+            return x
+        kind = token_index[:, 0]
+        patch_rows = (kind >= 0).nonzero().squeeze(1)
+        full = x[:, kind == -2].expand(-1, num_patches, -1).clone()
+        index = token_index[patch_rows].t().unsqueeze(-1).expand(-1, -1, x.shape[-1])
+        full.scatter_(1, index, x[:, patch_rows])
+        return torch.cat([x[:, kind == -1], full, x[:, kind == -3]], dim=1)
+
+    def run_blocks(self, x: torch.Tensor, modality=None, start=0, end=None, last_prompt=None, token_index=None):
+        # run resblocks[start:end] on LND tokens, carrying the prompt of the previous block and the pruning state
+        if end is None:
+            end = len(self.transformer.resblocks)
+        for i in range(start, end):
+            if token_index is not None and i in self.prune_layers:
+                x, token_index = self.prune_tokens(x, token_index, self.transformer.resblocks[i])
+            x, last_prompt = self.transformer.run_layer(i, x, modality, last_prompt)
+        return x, last_prompt, token_index
+
+    def embed_old(self, x: torch.Tensor, cv_emb=None, text_inverse=None):
         x = self.conv1(x)  # shape = [*, width, grid, grid]
+        grid_h, grid_w = x.shape[-2:]
         x = x.reshape(x.shape[0], x.shape[1], -1)  # shape = [*, width, grid ** 2]
         x = x.permute(0, 2, 1)  # shape = [*, grid ** 2, width]
         x = torch.cat(
@@ -462,108 +557,81 @@ class VisionTransformer(nn.Module):
              x], dim=1)  # shape = [*, grid ** 2 + 1, width]
         if cv_emb != None:
             x[:, 0] = x[:, 0] + cv_emb.squeeze(1)
-        x = x + self.positional_embedding.to(x.dtype)
+        x = x + self.grid_positional_embedding(grid_h, grid_w).to(x.dtype)
         if text_inverse is not None:
             text_inverse = text_inverse + cv_emb.squeeze(1) + self.new_positional_embedding.to(x.dtype)
             # add the inverse text features
             x = torch.cat([x, text_inverse.unsqueeze(1)], dim=1)
         x = self.ln_pre(x)
-        x = x.permute(1, 0, 2)  # NLD -> LND
-
-        # 用于存储中间特征
-        intermediate_features = None
-
-        for i in range(len(self.transformer.resblocks)):
-            if self.prompt_sign and self.adapter_sign:
-                if i == 0:
-                    x, last_prompt = self.transformer.resblocks[i](x, modality, i, None, prompt_sign=True,
-                                                                   adapter_sign=True)
-                else:
-                    x, last_prompt = self.transformer.resblocks[i](x, modality, i, last_prompt, prompt_sign=True,
-                                                                   adapter_sign=True)
-            elif self.prompt_sign and not self.adapter_sign:
-                if i == 0:
-                    x, last_prompt = self.transformer.resblocks[i](x, modality, i, None, prompt_sign=True,
-                                                                   adapter_sign=False)
-                else:
-                    x, last_prompt = self.transformer.resblocks[i](x, modality, i, last_prompt, prompt_sign=True,
-                                                                   adapter_sign=False)
-            elif not self.prompt_sign and self.adapter_sign:
-                x = self.transformer.resblocks[i](x, modality, i, None, prompt_sign=False, adapter_sign=True)
-            else:
-                x = self.transformer.resblocks[i](x, modality, i, None, prompt_sign=False, adapter_sign=False)
+        return x.permute(1, 0, 2)  # NLD -> LND
 
+    def project_intermediate(self, token: torch.Tensor):
+        intermediate_features = self.ln_intermediate(token)
+        if self.proj_intermediate is not None:
+            intermediate_features = intermediate_features @ self.proj_intermediate
+        return intermediate_features
 
-             # 在指定的中间层提取特征
-            if self.multi_scale and i == len(self.transformer.resblocks) + self.intermediate_layer_idx:
-                x_temp = x.permute(1, 0, 2)  # LND -> NLD
-                intermediate_features = x_temp[:, 0]  # 取cls token
-                intermediate_features = self.ln_intermediate(intermediate_features)
-                if self.proj_intermediate is not None:
-                    intermediate_features = intermediate_features @ self.proj_intermediate
+    def project(self, x: torch.Tensor):
         x = x.permute(1, 0, 2)  # LND -> NLD
         x = self.ln_post(x)
         if self.proj is not None:
             xproj = x @ self.proj
+        return xproj
+
+    def forward_stage1(self, x: torch.Tensor, cv_emb=None, modality=None, text_inverse=None):
+        """
+        Early exit at the intermediate layer (cascade retrieval, 'old' forward only).
+        Returns the intermediate features and the state consumed by forward_stage2.
+        """
+        split = self.intermediate_split()
+        if self.forward_type == 'new' or split is None:
+            raise ValueError('forward_stage1 needs FORWARD old and MULTI_SCALE with a valid INTERMEDIATE_LAYER_IDX')
+        x = self.embed_old(x, cv_emb, text_inverse)
+        token_index = self.init_token_index(x, text_inverse is not None)
+        num_patches = x.shape[0] - 1 - int(text_inverse is not None)
+        x, last_prompt, token_index = self.run_blocks(x, modality, 0, split, token_index=token_index)
+        return self.project_intermediate(x[0]), (x, last_prompt, token_index, num_patches)
+
+    def forward_stage2(self, state, modality=None):
+        # resume from forward_stage1 and run the remaining blocks
+        x, last_prompt, token_index, num_patches = state
+        x, _, token_index = self.run_blocks(x, modality, self.intermediate_split(), None, last_prompt, token_index)
+        return self.unprune(self.project(x), token_index, num_patches)
 
-        if self.multi_scale and intermediate_features is not None:
-            return xproj, intermediate_features
-        else:
-            return xproj
+    def forward_old(self, x: torch.Tensor, cv_emb=None, modality=None, text_inverse=None):
+        split = self.intermediate_split()
+        if split is None:
+            x = self.embed_old(x, cv_emb, text_inverse)
+            token_index = self.init_token_index(x, text_inverse is not None)
+            num_patches = x.shape[0] - 1 - int(text_inverse is not None)
+            x, _, token_index = self.run_blocks(x, modality, token_index=token_index)
+            return self.unprune(self.project(x), token_index, num_patches)
+        # 在指定的中间层提取特征（取cls token）
+        intermediate_features, state = self.forward_stage1(x, cv_emb, modality, text_inverse)
+        return self.forward_stage2(state, modality), intermediate_features
 
     def forward_new(self, x: torch.Tensor, text_inverse, cv_emb=None, modality=None):
         x = self.conv1(x)  # shape = [*, width, grid, grid]
+        grid_h, grid_w = x.shape[-2:]
         x = x.reshape(x.shape[0], x.shape[1], -1)  # shape = [*, width, grid ** 2]
         x = x.permute(0, 2, 1)  # shape = [*, grid ** 2, width]
         if cv_emb != None:
             x = x + cv_emb
-        x = x + self.positional_embedding.to(x.dtype)
+        x = x + self.grid_positional_embedding(grid_h, grid_w).to(x.dtype)
 
         x = self.ln_pre(x)
 
         x = x.permute(1, 0, 2)  # NLD -> LND
 
-         # 用于存储中间特征
-        intermediate_features = None
-
-        for i in range(len(self.transformer.resblocks)):
-            if self.prompt_sign and self.adapter_sign:
-                if i == 0:
-                    x, last_prompt = self.transformer.resblocks[i](x, modality, i, None, prompt_sign=True,
-                                                                   adapter_sign=True)
-                else:
-                    x, last_prompt = self.transformer.resblocks[i](x, modality, i, last_prompt, prompt_sign=True,
-                                                                   adapter_sign=True)
-            elif self.prompt_sign and not self.adapter_sign:
-                if i == 0:
-                    x, last_prompt = self.transformer.resblocks[i](x, modality, i, None, prompt_sign=True,
-                                                                   adapter_sign=False)
-                else:
-                    x, last_prompt = self.transformer.resblocks[i](x, modality, i, last_prompt, prompt_sign=True,
-                                                                   adapter_sign=False)
-            elif not self.prompt_sign and self.adapter_sign:
-                x = self.transformer.resblocks[i](x, modality, i, None, prompt_sign=False, adapter_sign=True)
-            else:
-                x = self.transformer.resblocks[i](x, modality, i, None, prompt_sign=False, adapter_sign=False)
-
-            # 在指定的中间层提取特征
-            if self.multi_scale and i == len(self.transformer.resblocks) + self.intermediate_layer_idx:
-                x_temp = x.permute(1, 0, 2)  # LND -> NLD
-                # 对于new forward，没有cls token，使用全局平均池化
-                intermediate_features = x_temp.mean(dim=1)  # 全局平均池化
-                intermediate_features = self.ln_intermediate(intermediate_features)
-                if self.proj_intermediate is not None:
-                    intermediate_features = intermediate_features @ self.proj_intermediate
-
-        x = x.permute(1, 0, 2)  # LND -> NLD
-        x = self.ln_post(x)
-        if self.proj is not None:
-            xproj = x @ self.proj
-
-        if self.multi_scale and intermediate_features is not None:
-            return xproj, intermediate_features
-        else:
-            return xproj
+        split = self.intermediate_split()
+        if split is None:
+            x, _, _ = self.run_blocks(x, modality)
+            return self.project(x)
+        x, last_prompt, _ = self.run_blocks(x, modality, 0, split)
+        # 对于new forward，没有cls token，使用全局平均池化
+        intermediate_features = self.project_intermediate(x.mean(dim=0))
+        x, _, _ = self.run_blocks(x, modality, split, None, last_prompt)
+        return self.project(x), intermediate_features
 
     def forward(self, x: torch.Tensor, cv_emb=None, modality=None, text_inverse=None):
         if self.forward_type == 'new':
@@ -653,6 +721,12 @@ class CLIP(nn.Module):
         self.text_projection.requires_grad = False
 
         self.logit_scale = nn.Parameter(torch.ones([]) * np.log(1 / 0.07))
+        # torch.compile'd forward functions of the towers, see compile_towers
+        self.compiled_towers = {}
+        # state_dict keys supplied by the pretrained file (build_model), the base of a delta checkpoint
+        self.pretrained_keys = frozenset()
+        # start(name)/stop(name) object timing every run_tower call (utils.telemetry.Telemetry)
+        self.tower_timer = None
 
         # text learnable parameters
         self.num_text_prompt = cfg.MODEL.TEXT_PROMPT
@@ -700,12 +774,44 @@ class CLIP(nn.Module):
         mask.triu_(1)  # zero out the lower diagonal
         return mask
 
+    def compile_towers(self, mode='default'):
+        """
+        Run the visual tower and the text transformer through torch.compile. The unbound forward functions are
+        compiled and called with the tower, so copies of the model (deepcopy) get their own graphs. With the
+        layer plans of the towers there is no per-layer branching; one graph is traced per modality. Compilation
+        errors surface at the first call. Returns False when torch.compile is unavailable.
+        """
+        if not hasattr(torch, 'compile'):
+            print('torch.compile is not available in this PyTorch version, the towers stay eager')
+            return False
+        self.compiled_towers = {'visual': torch.compile(type(self.visual).forward, mode=mode),
+                                'transformer': torch.compile(type(self.transformer).forward, mode=mode)}
+        return True
+
+    def set_grad_checkpointing(self, every=1):
+        # activation checkpointing of every `every`-th block of the visual and text towers (0 disables)
+        self.visual.transformer.grad_ckpt = every
+        self.transformer.grad_ckpt = every
+
+    def run_tower(self, name, *args):
+        tower = getattr(self, name)
+        compiled = self.compiled_towers.get(name)
+        timer = self.tower_timer
+        if timer is None:
+            return compiled(tower, *args) if compiled is not None else tower(*args)
+        # per-modality region for step telemetry: tower_rgb / tower_nir / tower_tir / tower_text
+        region = 'tower_{}'.format((args[2] or 'image') if name == 'visual' else 'text')
+        timer.start(region)
+        result = compiled(tower, *args) if compiled is not None else tower(*args)
+        timer.stop(region)
+        return result
+
     @property
     def dtype(self):
         return self.visual.conv1.weight.dtype
 
     def encode_image(self, image, cv_embed, modality, text_inverse=None):
-        result =  self.visual(image.type(self.dtype), cv_embed, modality, text_inverse)
+        result = self.run_tower('visual', image.type(self.dtype), cv_embed, modality, text_inverse)
 
         if self.multi_scale:
             if isinstance(result, tuple) and len(result) == 2:
@@ -729,25 +835,7 @@ class CLIP(nn.Module):
             x[:, 5] = x[:, 5] + image_inverse
         x = x + self.positional_embedding.type(self.dtype)
         x = x.permute(1, 0, 2)
-        for i in range(len(self.transformer.resblocks)):
-            if self.prompt_sign and self.adapter_sign:
-                if i == 0:
-                    x, last_prompt = self.transformer.resblocks[i](x, modality, i, None, prompt_sign=True,
-                                                                   adapter_sign=True)
-                else:
-                    x, last_prompt = self.transformer.resblocks[i](x, modality, i, last_prompt, prompt_sign=True,
-                                                                   adapter_sign=True)
-            elif self.prompt_sign and not self.adapter_sign:
-                if i == 0:
-                    x, last_prompt = self.transformer.resblocks[i](x, modality, i, None, prompt_sign=True,
-                                                                   adapter_sign=False)
-                else:
-                    x, last_prompt = self.transformer.resblocks[i](x, modality, i, last_prompt, prompt_sign=True,
-                                                                   adapter_sign=False)
-            elif not self.prompt_sign and self.adapter_sign:
-                x = self.transformer.resblocks[i](x, modality, i, None, prompt_sign=False, adapter_sign=True)
-            else:
-                x = self.transformer.resblocks[i](x, modality, i, None, prompt_sign=False, adapter_sign=False)
+        x, _ = self.run_tower('transformer', x, modality)
 
         x = x.permute(1, 0, 2)
         x = self.ln_final(x).type(self.dtype)
@@ -861,6 +949,7 @@ def build_model(cfg, state_dict: dict, h_resolution: int, w_resolution: int, vis
         print(f"Successfully load ckpt!")
         incompatibleKeys = model.load_state_dict(state_dict, strict=False)
         print(incompatibleKeys)
+        model.pretrained_keys = frozenset(state_dict) - set(incompatibleKeys.unexpected_keys)
     except Exception as e:
         print(f"Failed loading checkpoint!")
     return model.eval()
@@ -885,11 +974,17 @@ def resize_pos_embed(posemb, posemb_new, hight, width, cfg=None):
 
     gs_old = int(math.sqrt(len(posemb_grid)))  # 14
     print('Position embedding resize to height:{} width: {}'.format(hight, width))
-    posemb_grid = posemb_grid.reshape(1, gs_old, gs_old, -1).permute(0, 3, 1, 2)
-    posemb_grid = F.interpolate(posemb_grid, size=(hight, width), mode='bilinear')
-    posemb_grid = posemb_grid.permute(0, 2, 3, 1).reshape(1, hight * width, -1)
+    posemb_grid = resample_pos_grid(posemb_grid, (gs_old, gs_old), (hight, width))
     if cfg.MODEL.FORWARD == 'new':
-        posemb = posemb_grid.squeeze()
+        posemb = posemb_grid
     else:
-        posemb = torch.cat([posemb_token, posemb_grid.squeeze()], dim=0)
+        posemb = torch.cat([posemb_token, posemb_grid], dim=0)
     return posemb
+
+
+def resample_pos_grid(posemb_grid, old_size, new_size):
+    # Bilinearly resample a flattened (H * W, C) grid of position embeddings to new_size (h, w)
+    hight, width = new_size
+    posemb_grid = posemb_grid.reshape(1, old_size[0], old_size[1], -1).permute(0, 3, 1, 2)
+    posemb_grid = F.interpolate(posemb_grid, size=(hight, width), mode='bilinear')
+    return posemb_grid.permute(0, 2, 3, 1).reshape(hight * width, -1)
@@ -2,12 +2,8 @@ import torch.nn as nn
 import einops
 import torch.nn.functional as F
 import torch
-import matplotlib.pyplot as plt
 import numpy as np
-from PIL import Image
-import cv2
 from modeling.backbones.vit_pytorch import trunc_normal_
-import textwrap
 
 
 class DAttentionBaseline(nn.Module):
@@ -151,6 +147,9 @@ class DAttentionBaseline(nn.Module):
         :param title: 图形标题
         :param patch_size: 每个 patch 的尺寸 (height, width)
         """
+        # plotting backends are only needed for visualisation, not on the training/inference import path
+        import matplotlib.pyplot as plt
+        from PIL import Image
         # 根据模式设置图像路径前缀
         modality = ['RGB', 'NI', 'TI']
         if pattern == 0:
@@ -229,7 +228,7 @@ class DAttentionBaseline(nn.Module):
     def show_cam_on_image(self, img: np.ndarray,
                           mask: np.ndarray,
                           use_rgb: bool = False,
-                          colormap: int = cv2.COLORMAP_HOT,
+                          colormap: int = None,
                           image_weight: float = 0.3) -> np.ndarray:
         """ This function overlays the cam mask on the image as an heatmap.
         By default the heatmap is in BGR format.
@@ -237,10 +236,13 @@ class DAttentionBaseline(nn.Module):
         :param img: The base image in RGB or BGR format.
         :param mask: The cam mask.
         :param use_rgb: Whether to use an RGB or BGR heatmap, this should be set to True if 'img' is in RGB format.
-        :param colormap: The OpenCV colormap to be used.
+        :param colormap: The OpenCV colormap to be used, cv2.COLORMAP_HOT when None.
         :param image_weight: The final result is image_weight * img + (1-image_weight) * mask.
         :returns: The default image with the cam overlay.
         """
+        import cv2
+        if colormap is None:
+            colormap = cv2.COLORMAP_HOT
         heatmap = cv2.applyColorMap(np.uint8(255 * mask), colormap)
         if use_rgb:
             heatmap = cv2.cvtColor(heatmap, cv2.COLOR_BGR2RGB)
@@ -266,6 +268,9 @@ class DAttentionBaseline(nn.Module):
         """
         在原始图像上根据 attn_map 选择一个注意力分布，生成热图并覆盖，并显示描述文本
         """
+        import textwrap
+        import matplotlib.pyplot as plt
+        from PIL import Image
         modality = ['v_RGB', 'v_NIR', 'v_TIR', 't_RGB', 't_NIR', 't_TIR']
         if index == 0 or index == 3:
             prefix = '../RGBNT201/test/RGB/'
@@ -626,6 +631,7 @@ class CDA(nn.Module):
         :param input_tensor: 输入特征图，形状为 (B, C, H, W)
         :param block_size: 块的大小，默认为 (4, 4)，表示高和宽
         """
+        import matplotlib.pyplot as plt
         # 分块
         blocks = self.split_into_blocks(input_tensor, block_size)
 
@@ -662,3 +668,136 @@ class CDA(nn.Module):
         vision = torch.flatten(fea[:, :3], start_dim=1, end_dim=2)
         text = torch.flatten(fea[:, 3:], start_dim=1, end_dim=2)
         return vision, text
+
+
+class FusedCDA(CDA):
+    """
+    CDA with the per-block loop vectorized: the blocks are stacked as a batch dimension, the offset branches of all
+    blocks and modalities run as one grouped convolution, the three modalities are sampled with one grid_sample and
+    q/k/v/out use stacked weights. The reference grid is cached per (H, W, device, dtype).
+    Parameters are the ones of CDA (same state_dict keys), so checkpoints load in either module.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(FusedCDA, self).__init__(*args, **kwargs)
+        self._ref_cache = {}
+        self._weight_cache = (None, None)
+
+    def reference_points(self, H, W, dtype, device):
+        # (H_out, W_out, 2) centres of the offset windows, normalized to [-1, 1]
+        key = (H, W, device, dtype)
+        if key not in self._ref_cache:
+            self._ref_cache[key] = self.da_group[0]._get_ref_points(H, W, 1, self.da_group[0].ksize,
+                                                                    self.da_group[0].stride, dtype, device)[0]
+        return self._ref_cache[key]
+
+    def stacked_weights(self):
+        """
+        Weights of all blocks stacked along a leading branch/block dimension. Rebuilt on every call while
+        gradients are needed or the module is being compiled/exported, otherwise cached until a parameter changes.
+        """
+        params = list(self.da_group.parameters())
+        # no cache while torch.compile/torch.export trace the module (no data pointers on traced tensors)
+        cacheable = not (torch.is_grad_enabled() and any(p.requires_grad for p in params)) and \
+            not torch.compiler.is_compiling()
+        if cacheable:
+            stamp = tuple((p.data_ptr(), p._version) for p in params)
+            if self._weight_cache[0] == stamp:
+                return self._weight_cache[1]
+        if self.da_group[0].share_offset:
+            branches = [da.conv_offset for da in self.da_group]
+        else:
+            branches = [conv for da in self.da_group for conv in (da.conv_offset_r, da.conv_offset_n, da.conv_offset_t)]
+        weights = {
+            'offset_in': torch.stack([branch[0].weight.flatten(1) for branch in branches], dim=0),
+            'offset_in_bias': torch.stack([branch[0].bias for branch in branches], dim=0).unsqueeze(-1),
+            'offset_dw': torch.cat([branch[2].weight for branch in branches], dim=0),
+            'offset_dw_bias': torch.cat([branch[2].bias for branch in branches], dim=0),
+            'offset_out': torch.stack([branch[4].weight.flatten(1) for branch in branches], dim=0),
+            'q': torch.stack([da.proj_q.weight.flatten(1) for da in self.da_group], dim=0),
+            'q_bias': torch.stack([da.proj_q.bias for da in self.da_group], dim=0).unsqueeze(-1),
+            # k and v share their input, one matmul for both
+            'kv': torch.stack([torch.cat([da.proj_k.weight.flatten(1), da.proj_v.weight.flatten(1)], dim=0)
+                               for da in self.da_group], dim=0),
+            'kv_bias': torch.stack([torch.cat([da.proj_k.bias, da.proj_v.bias], dim=0)
+                                    for da in self.da_group], dim=0).unsqueeze(-1),
+            'out': torch.stack([da.proj_out.weight.flatten(1) for da in self.da_group], dim=0),
+            'out_bias': torch.stack([da.proj_out.bias for da in self.da_group], dim=0).unsqueeze(-1),
+        }
+        if cacheable:
+            self._weight_cache = (stamp, weights)
+        return weights
+
+    def offsets(self, data, weights):
+        """
+        Offsets of all branches (block x modality, or block when offsets are shared) at once.
+        data: (branch, c_in, B * g, H, W), the 1x1 convs run as one matmul per branch and the depthwise conv as
+        one grouped conv. Returns (branch, offset channels, B * g, Hk, Wk).
+        """
+        n_branch, _, Bg, H, W = data.shape
+        offset = torch.baddbmm(weights['offset_in_bias'], weights['offset_in'], data.flatten(2))
+        offset = F.gelu(offset).reshape(n_branch, -1, Bg, H, W).permute(2, 0, 1, 3, 4).flatten(1, 2)
+        offset = F.conv2d(offset, weights['offset_dw'], weights['offset_dw_bias'], stride=self.da_group[0].stride,
+                          groups=offset.shape[1])
+        Hk, Wk = offset.shape[-2:]
+        offset = F.gelu(offset).reshape(Bg, n_branch, -1, Hk * Wk).permute(1, 2, 0, 3).flatten(2)
+        return torch.matmul(weights['offset_out'], offset).reshape(n_branch, -1, Bg, Hk, Wk)
+
+    def forward(self, x, y, z, boss, writer=None, epoch=None, img_path=None, texts=''):
+        block = self.da_group[0]
+        weights = self.stacked_weights()
+        n_da, g, cg = self.num_da, block.n_groups, block.n_group_channels
+        B, C = x.size(0), x.size(-1)
+        H, W = self.window_size
+        dtype, device = x.dtype, x.device
+        # overlapping blocks of the three modalities as a view (3, B, C, n_h, n_w, H, W) of one stacked copy
+        stacked = torch.stack([x, y, z], dim=0).reshape(3, B, self.q_size[0], self.q_size[1], C).permute(0, 1, 4, 2, 3)
+        stacked = stacked.unfold(3, H, self.stride_block[0]).unfold(4, W, self.stride_block[1])
+        # (n_da, 3, B, C, H, W)
+        blocks = stacked.permute(3, 4, 0, 1, 2, 5, 6).reshape(n_da, 3, B, C, H, W)
+
+        # offsets for every branch, data laid out as (branch, channels, B * g, H, W)
+        if block.share_offset:
+            # one branch per block over cat([x, y, z]) split into groups, as in off_set_shared
+            data = blocks.transpose(1, 2).reshape(n_da, B, g, 3 * cg, H, W).permute(0, 3, 1, 2, 4, 5)
+            offset = self.offsets(data.reshape(n_da, 3 * cg, B * g, H, W), weights)
+            offset = offset.unsqueeze(1).expand(-1, 3, -1, -1, -1, -1)
+        else:
+            data = blocks.reshape(n_da, 3, B, g, cg, H, W).permute(0, 1, 4, 2, 3, 5, 6)
+            offset = self.offsets(data.reshape(n_da * 3, cg, B * g, H, W), weights)
+            offset = offset.reshape(n_da, 3, *offset.shape[1:])
+        Hk, Wk = offset.shape[-2:]
+        if block.offset_range_factor > 0:
+            offset_range = torch.tensor([1.0 / (Hk - 1.0), 1.0 / (Wk - 1.0)], device=device).reshape(1, 1, 2, 1, 1, 1)
+            offset = offset.tanh().mul(offset_range).mul(block.offset_range_factor)
+        pos = (offset.permute(0, 1, 3, 4, 5, 2) + self.reference_points(H, W, dtype, device)).clamp(-1., +1.)
+
+        # one grid_sample over all blocks and modalities: (n_da * 3 * B * g, cg, Hk, Wk)
+        n_sample = Hk * Wk
+        sampled = F.grid_sample(
+            input=blocks.reshape(n_da * 3 * B * g, cg, H, W),
+            grid=pos.reshape(n_da * 3 * B * g, Hk, Wk, 2)[..., (1, 0)],  # y, x -> x, y
+            mode='bilinear', align_corners=True)
+        # (n_da, C, B * 3 * n_sample), samples of a batch item ordered (modality, position) as in the reference
+        sampled = sampled.reshape(n_da, 3, B, C, n_sample).permute(0, 3, 2, 1, 4).reshape(n_da, C, -1)
+
+        # q/k/v/out 1x1 convs of every block as one matmul per block
+        heads, head_channels = block.n_heads, block.n_head_channels
+        query = boss.permute(2, 0, 1)  # (C, B, M)
+        M = query.shape[-1]
+        q = torch.baddbmm(weights['q_bias'], weights['q'], query.reshape(1, C, -1).expand(n_da, -1, -1))
+        q = q.reshape(n_da, heads, head_channels, B, M).permute(0, 3, 1, 4, 2)  # (n_da, B, heads, M, hc)
+        kv = torch.baddbmm(weights['kv_bias'], weights['kv'], sampled)
+        k, v = kv.reshape(n_da, 2, heads, head_channels, B, 3 * n_sample).permute(1, 0, 4, 2, 3, 5)
+        attn = torch.matmul(q, k).mul(block.scale)  # (n_da, B, heads, M, Ns)
+        attn = F.softmax(attn, dim=-1)
+        attn = F.dropout(attn, block.attn_drop.p, self.training)
+        out = torch.matmul(v, attn.transpose(-2, -1))  # (n_da, B, heads, hc, M)
+        out = out.reshape(n_da, B, C, M).transpose(1, 2).reshape(n_da, C, -1)
+        out = torch.baddbmm(weights['out_bias'], weights['out'], out).reshape(n_da, C, B, M)
+        out = query + F.dropout(out, block.proj_drop.p, self.training)
+
+        fea = out[0].permute(1, 2, 0)
+        vision = torch.flatten(fea[:, :3], start_dim=1, end_dim=2)
+        text = torch.flatten(fea[:, 3:], start_dim=1, end_dim=2)
+        return vision, text
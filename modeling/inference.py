@@ -0,0 +1,188 @@
+import torch
+import torch.nn as nn
+from modeling.clip.model import ResidualAttentionBlock
+
+EXPORT_FORMAT = 'idea-inference'
+EXPORT_VERSION = 1
+
+# BatchNorm1d -> Linear pairs that run back to back at inference
+FOLD_PAIRS = (('bottleneck_fusion_v', 'fusion_v'),
+              ('bottleneck_fusion_v_intermediate', 'fusion_v_intermediate'))
+
+
+@torch.no_grad()
+def fold_batchnorm_linear(bn, linear):
+    """Linear layer computing linear(bn(x)) with the running statistics of `bn` (eval mode)."""
+    scale = torch.rsqrt(bn.running_var.double() + bn.eps)
+    shift = -bn.running_mean.double() * scale
+    if bn.affine:
+        scale = scale * bn.weight.double()
+        shift = shift * bn.weight.double() + bn.bias.double()
+    weight = linear.weight.double()
+    bias = weight @ shift
+    if linear.bias is not None:
+        bias = bias + linear.bias.double()
+    folded = nn.Linear(linear.in_features, linear.out_features, bias=True,
+                       device=linear.weight.device, dtype=linear.weight.dtype)
+    folded.weight.copy_(weight * scale)
+    folded.bias.copy_(bias)
+    return folded
+
+
+def is_training_head(name, module):
+    # ID classifiers and the BNNecks in front of them only feed the losses
+    return 'classifier' in name or (name.startswith('bottleneck') and isinstance(module, nn.BatchNorm1d))
+
+
+@torch.no_grad()
+def optimize_for_inference(model):
+    """
+    In-place inference transform of IDEA / IDEA_woText:
+    BNNeck -> fusion Linear pairs are folded into one Linear,
+    the classifiers and training-only BNNecks are removed, and constants (attention masks, resampled
+    position embeddings of the NIR/TIR grids) are materialised once. The model can no longer be trained.
+    """
+    model.eval()
+    for bn_name, linear_name in FOLD_PAIRS:
+        bn, linear = getattr(model, bn_name, None), getattr(model, linear_name, None)
+        if isinstance(bn, nn.BatchNorm1d) and isinstance(linear, nn.Linear):
+            setattr(model, linear_name, fold_batchnorm_linear(bn, linear))
+            setattr(model, bn_name, nn.Identity())
+    for name, module in list(model.named_children()):
+        if is_training_head(name, module):
+            delattr(model, name)
+    model.requires_grad_(False)
+
+    for module in model.modules():
+        if isinstance(module, ResidualAttentionBlock) and module.attn_mask is not None:
+            weight = module.attn.in_proj_weight
+            module.attn_mask = module.attn_mask.to(dtype=weight.dtype, device=weight.device)
+    visual = model.BACKBONE.base.visual if getattr(model.BACKBONE, 'clip', 0) else None
+    if visual is not None and hasattr(visual, 'grid_positional_embedding'):
+        for grid in getattr(model, 'modality_grid', {}).values():
+            visual.grid_positional_embedding(*grid)
+    model.inference_only = True
+    return model
+
+
+def export_inference(model, path, num_class, camera_num, view_num=0):
+    """Serialise an optimized model: config, constructor arguments and the reduced state dict."""
+    if not getattr(model, 'inference_only', False):
+        raise ValueError('export_inference expects a model transformed by optimize_for_inference')
+    torch.save({'format': EXPORT_FORMAT, 'version': EXPORT_VERSION, 'config': model.cfg.dump(),
+                'num_class': num_class, 'camera_num': camera_num, 'view_num': view_num,
+                'state_dict': model.state_dict()}, path)
+
+
+def load_inference(path, map_location='cpu'):
+    """Rebuild an exported model: the architecture from the stored config, then a strict load of the weights."""
+    from config import cfg as default_cfg
+    from modeling.make_model import make_model
+    checkpoint = torch.load(path, map_location=map_location)
+    if checkpoint.get('format') != EXPORT_FORMAT:
+        raise ValueError('{} is not an {} export'.format(path, EXPORT_FORMAT))
+    if checkpoint['version'] > EXPORT_VERSION:
+        raise ValueError('{} has export version {}, this code reads up to {}'.format(
+            path, checkpoint['version'], EXPORT_VERSION))
+    # the dump holds every key, it is loaded as is (a merge would re-check types against the defaults)
+    cfg = type(default_cfg).load_cfg(checkpoint['config'])
+    cfg.freeze()
+    model = make_model(cfg, num_class=checkpoint['num_class'], camera_num=checkpoint['camera_num'],
+                       view_num=checkpoint['view_num'])
+    optimize_for_inference(model)
+    model.load_state_dict(checkpoint['state_dict'], strict=True)
+    # warm the constant caches again for the loaded weights
+    optimize_for_inference(model)
+    return model
+
+
+def feature_parity(expected, actual, keys=None):
+    """Largest absolute difference per feature between two feature dicts (all keys of `expected` by default)."""
+    return {key: (expected[key].float() - actual[key].float()).abs().max().item() for key in keys or expected}
+
+
+class IDEAInference(nn.Module):
+    """
+    Tensor-only eval entry point of IDEA for torch.jit.trace / torch.export: image tensors, text tokens and
+    camera labels in, the features of FEATURE_NAMES (in that order) out. No dict inputs, no caption decoding,
+    no train/eval branching; the tower set follows TEST.MISS at construction time. With MODEL.SIE_CAMERA and no
+    cam_label every sample gets camera 0, callers that know the cameras should pass them.
+    """
+
+    def __init__(self, model):
+        super(IDEAInference, self).__init__()
+        from modeling.make_model import PROMPT_MODALITIES
+        self.model = model.eval()
+        self.towers = tuple((modality, PROMPT_MODALITIES[modality])
+                            for modality in model.present_modalities({'RGB': None, 'NI': None, 'TI': None}))
+        self.names = feature_names(model)
+        self.sie_camera = bool(model.BACKBONE.cv_embed_sign)
+
+    def forward(self, rgb, nir, tir, rgb_text, ni_text, ti_text, cam_label=None):
+        if cam_label is None and self.sie_camera:
+            cam_label = torch.zeros(rgb.shape[0], dtype=torch.long, device=rgb.device)
+        image = {'RGB': rgb, 'NI': nir, 'TI': tir}
+        v_results = {}
+        for modality, prompt_modality in self.towers:
+            v_results[modality] = self.model.BACKBONE.forward_image(
+                image=self.model.fit_modality(image[modality], modality), cam_label=cam_label,
+                modality=prompt_modality)
+        feats = self.model.eval_head(v_results, rgb_text, ni_text, ti_text, cam_label=cam_label)
+        return tuple(feats[name] for name in self.names)
+
+
+def feature_names(model):
+    # output order of IDEAInference, the multi_modal_dict keys of the model's configuration
+    names = ('V_RGB', 'V_NIR', 'V_TIR', 'T_RGB', 'LOCAL_v')
+    return names + ('LOCAL_t', 'LOCAL') if model.DA else names
+
+
+def wrapper_inputs(image, text, cam_label=None):
+    # positional inputs of IDEAInference from the dicts the data loaders produce, a None cam_label means camera 0
+    return (image['RGB'], image['NI'], image['TI'], text['rgb_text'], text['ni_text'], text['ti_text'], cam_label)
+
+
+@torch.no_grad()
+def deploy(wrapper, inputs, path, fmt='torchscript'):
+    """
+    Trace IDEAInference into a deployment artifact and save it: a TorchScript archive (torch.jit.trace, loadable
+    from C++ with torch::jit::load) or a torch.export program (.pt2). The batch dimension stays dynamic.
+    """
+    inputs = tuple(item for item in inputs if item is not None)
+    if fmt == 'torchscript':
+        artifact = torch.jit.trace(wrapper, inputs, check_trace=False)
+        torch.jit.save(artifact, path)
+    elif fmt == 'export':
+        batch = torch.export.Dim('batch', min=1, max=4096)
+        artifact = torch.export.export(wrapper, inputs, dynamic_shapes=tuple({0: batch} for _ in inputs))
+        torch.export.save(artifact, path)
+    else:
+        raise ValueError('Unknown deployment format {}, expected torchscript or export'.format(fmt))
+    return artifact
+
+
+def load_deployed(path, map_location='cpu'):
+    """Callable of a deploy() artifact, same positional inputs and output tuple as IDEAInference."""
+    if path.endswith('.pt2'):
+        return torch.export.load(path).module()
+    return torch.jit.load(path, map_location=map_location)
+
+
+@torch.no_grad()
+def latency(fn, inputs, iters=20, warmup=3):
+    """Median wall time in seconds of fn(*inputs)."""
+    import time
+    inputs = tuple(item for item in inputs if item is not None)
+    synchronize = any(torch.is_tensor(item) and item.is_cuda for item in inputs)
+    for _ in range(warmup):
+        fn(*inputs)
+    times = []
+    for _ in range(iters):
+        if synchronize:
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        fn(*inputs)
+        if synchronize:
+            torch.cuda.synchronize()
+        times.append(time.perf_counter() - start)
+    return sorted(times)[len(times) // 2]
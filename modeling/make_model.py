@@ -1,15 +1,19 @@
 import torch.nn as nn
+import torch.nn.functional as F
 from modeling.backbones.vit_pytorch import vit_base_patch16_224, vit_small_patch16_224, \
     deit_small_patch16_224
-from modeling.backbones.t2t import t2t_vit_t_24
-from fvcore.nn import flop_count
-from utils.flops import give_supported_ops
-import copy
 from modeling.meta_arch import build_transformer, weights_init_classifier, weights_init_kaiming
 import torch
-from modeling.clip import clip
-from modeling.fusion_part.CDA_Module import CDA
+from modeling.fusion_part.CDA_Module import CDA, FusedCDA
+from modeling.inference import optimize_for_inference
 from utils.simple_tokenizer import SimpleTokenizer
+from utils.checkpoint import load_delta
+
+# visual tower -> modality of its prompt group in the CLIP blocks (MODEL.PROMPT)
+PROMPT_MODALITIES = {'RGB': 'rgb', 'NI': 'nir', 'TI': 'tir'}
+# TEST.MISS letters -> visual tower that is absent
+MISS_MODALITIES = {'r': 'RGB', 'n': 'NI', 't': 'TI'}
+MISS_PATTERNS = ('r', 'n', 't', 'rn', 'rt', 'nt')
 
 
 class IDEA(nn.Module):
@@ -35,12 +39,22 @@ class IDEA(nn.Module):
         self.q_size = cfg.INPUT.SIZE_TRAIN[0] // 16, cfg.INPUT.SIZE_TRAIN[1] // 16
         self.window_size = self.q_size
         self.stride_block = self.q_size
+        # NIR/TIR towers may run at a lower resolution (fewer patch tokens) than RGB
+        self.modality_size = {'NI': tuple(cfg.INPUT.SIZE_NI), 'TI': tuple(cfg.INPUT.SIZE_TI)}
+        self.modality_grid = {'RGB': self.q_size}
+        for key, size in self.modality_size.items():
+            if size:
+                self.modality_grid[key] = ((size[0] - 16) // cfg.MODEL.STRIDE_SIZE[0] + 1,
+                                           (size[1] - 16) // cfg.MODEL.STRIDE_SIZE[1] + 1)
+            else:
+                self.modality_grid[key] = self.q_size
 
         # 多尺度特征配置
         self.multi_scale = cfg.MODEL.MULTI_SCALE
 
         if self.DA:
-            self.CDA = CDA(q_size=self.q_size, window_size=self.q_size, ksize=4,
+            cda = FusedCDA if cfg.MODEL.DA_FUSED else CDA
+            self.CDA = cda(q_size=self.q_size, window_size=self.q_size, ksize=4,
                                                                stride=2,
                                                                stride_block=self.q_size,
                                                                offset_range_factor=cfg.MODEL.OFF_FAC,
@@ -125,40 +139,122 @@ class IDEA(nn.Module):
             self.bottleneck_v_rgb.apply(weights_init_kaiming)
 
         self.tokenizer = SimpleTokenizer()
+        # set by optimize_for_inference: heads removed, BNNeck folded, training is no longer possible
+        self.inference_only = False
 
     def load_param(self, trained_path):
         state_dict = torch.load(trained_path, map_location="cpu")
+        if 'base_hash' in state_dict:
+            # trainable delta (SOLVER.CHECKPOINT_DELTA), this model provides the frozen base
+            print(f"Successfully load delta ckpt!")
+            print(load_delta(self, state_dict))
+            return
+        if 'model' in state_dict and 'rng' in state_dict:
+            # training checkpoint of utils/checkpoint.py
+            state_dict = state_dict['model']
         print(f"Successfully load ckpt!")
         incompatibleKeys = self.load_state_dict(state_dict, strict=False)
         print(incompatibleKeys)
 
-    def flops(self, shape=(3, 256, 128)):
-        if self.image_size[0] != shape[1] or self.image_size[1] != shape[2]:
-            shape = (3, self.image_size[0], self.image_size[1])
-            # For vehicle reid, the input shape is (3, 128, 256)
-        supported_ops = give_supported_ops()
-        model = copy.deepcopy(self)
-        model.cuda().eval()
-        input_r = torch.ones((1, *shape), device=next(model.parameters()).device, dtype=torch.float32)
-        input_n = torch.ones((1, *shape), device=next(model.parameters()).device, dtype=torch.float32)
-        input_t = torch.ones((1, *shape), device=next(model.parameters()).device, dtype=torch.float32)
-        cam_label = torch.tensor(0, device=next(model.parameters()).device, dtype=torch.int64)
-        input = {"RGB": input_r, "NI": input_n, "TI": input_t, "cam_label": cam_label,
-                 'text': {'rgb_text': clip.tokenize('just a test').cuda(),
-                          'ni_text': clip.tokenize('just a test').cuda(),
-                          'ti_text': clip.tokenize('just a test').cuda()}}
-        Gflops, unsupported = flop_count(model=model, inputs=(input,), supported_ops=supported_ops)
-        print("~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~")
-        print(
-            "The out_proj here is called by the nn.MultiheadAttention, which has been calculated in th .forward(), so just ignore it.")
-        print("~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~")
-        print("For the bottleneck or classifier, it is not calculated during inference, so just ignore it.")
-        print("~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~")
-        print(
-            "For the Mamba Series, the code implementations are all used with the inner weight instead of directly calling the model, the FLOPs has been calculated with our inner function 'MambaInnerFn_jit', so just ignore it.")
-        print("~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~")
-        del model, input
-        return sum(Gflops.values()) * 1e9
+    def fit_modality(self, image, modality):
+        # Resize the NIR/TIR input to its own token budget (INPUT.SIZE_NI / INPUT.SIZE_TI)
+        size = self.modality_size.get(modality)
+        if not size or tuple(image.shape[-2:]) == size:
+            return image
+        return F.interpolate(image, size=size, mode='bilinear', align_corners=False, antialias=True)
+
+    def patch_grid(self, feas, modality):
+        # Patch tokens (CLS stripped) resampled back onto the common q_size grid expected by CDA
+        tokens = feas[:, 1:]
+        grid = self.modality_grid[modality]
+        if grid == self.q_size:
+            return tokens
+        tokens = tokens[:, :grid[0] * grid[1]].permute(0, 2, 1).reshape(tokens.shape[0], -1, *grid)
+        tokens = F.interpolate(tokens, size=self.q_size, mode='bilinear', align_corners=False)
+        return tokens.flatten(2).permute(0, 2, 1)
+
+    def optimize_for_inference(self):
+        # fold BNNeck into fusion_v, drop the classifiers, precompute constants, see modeling/inference.py
+        return optimize_for_inference(self)
+
+    def flops(self, shape=None, batch_size=1):
+        """
+        FLOPs of one eval forward on (C, H, W) images of `shape`, None = the training resolution. See
+        profile_model.py for the per-module view.
+        """
+        from utils.profiler import count_flops
+        from utils.inputs import random_inputs
+        image_size = self.image_size if shape is None else shape[-2:]
+        training = self.training
+        self.eval()
+        flops = count_flops(self, random_inputs(batch_size, image_size, next(self.parameters()).device))
+        self.train(training)
+        return flops
+
+    def present_modalities(self, image):
+        # visual towers to run: modalities given in `image` minus the ones TEST.MISS marks as missing
+        missing = {MISS_MODALITIES[key] for key in self.miss_type} if self.miss_type in MISS_PATTERNS else set()
+        return [modality for modality in ('RGB', 'NI', 'TI') if modality in image and modality not in missing]
+
+    def eval_head(self, v_results, RGB_Text, NI_Text, TI_Text, cam_label=None, label=None, view_label=None,
+                  writer=None, epoch=None, img_path=None, text_real=''):
+        """
+        Text tower, fusion and CDA on top of the visual towers, returns the inference feature dict.
+        v_results maps 'RGB'/'NI'/'TI' to the forward_image outputs of the towers that ran, the global features
+        and patch grids of absent modalities are the mean of the present ones.
+        """
+        present = [modality for modality in ('RGB', 'NI', 'TI') if modality in v_results]
+        if not present:
+            raise ValueError('At least one of RGB/NI/TI is needed for inference')
+        v_global = {modality: v_results[modality][1] for modality in present}
+        if len(present) < 3:
+            fill = torch.stack(list(v_global.values()), dim=0).mean(dim=0)
+            v_global = {modality: v_global.get(modality, fill) for modality in ('RGB', 'NI', 'TI')}
+        RGB_t_results = self.BACKBONE.forward_text(text=RGB_Text, cam_label=cam_label, label=label, view_label=view_label)
+
+         # 提取最终特征
+        RGB_v_global, NI_v_global, TI_v_global = v_global['RGB'], v_global['NI'], v_global['TI']
+        RGB_t_feas, RGB_t_global = RGB_t_results[:2]
+
+        ori_v = torch.cat([RGB_v_global, NI_v_global, TI_v_global], dim=-1)
+        fusion_v = self.fusion_v(self.bottleneck_fusion_v(ori_v))
+
+        multi_modal_dict = {"V_RGB": RGB_v_global, "V_NIR": NI_v_global, "V_TIR": TI_v_global,
+                            "T_RGB": RGB_t_global,
+                            'LOCAL_v': fusion_v}
+        if self.DA:
+            NI_t_global = self.BACKBONE.forward_text(text=NI_Text, cam_label=cam_label, label=label,
+                                                     view_label=view_label)[1]
+            TI_t_global = self.BACKBONE.forward_text(text=TI_Text, cam_label=cam_label, label=label,
+                                                     view_label=view_label)[1]
+            boss_fea = torch.stack([RGB_v_global, NI_v_global, TI_v_global, RGB_t_global, NI_t_global, TI_t_global],
+                                   dim=1)
+            v_grid = {modality: self.patch_grid(v_results[modality][0], modality) for modality in present}
+            if len(present) < 3:
+                fill = torch.stack(list(v_grid.values()), dim=0).mean(dim=0)
+                v_grid = {modality: v_grid.get(modality, fill) for modality in ('RGB', 'NI', 'TI')}
+            visual, textual = self.CDA(v_grid['RGB'], v_grid['NI'], v_grid['TI'], boss_fea, writer=writer,
+                                       epoch=epoch,
+                                       img_path=img_path, texts=text_real)
+            local = torch.cat([visual, textual], dim=-1)
+            multi_modal_dict['LOCAL_v'] = visual
+            multi_modal_dict['LOCAL_t'] = textual
+            multi_modal_dict['LOCAL'] = local
+        return multi_modal_dict
+
+    def encode_coarse(self, image, cam_label=None):
+        """
+        First stage of cascade retrieval, every visual tower stops after INTERMEDIATE_LAYER_IDX.
+        Returns the fused intermediate feature used for shortlisting.
+        """
+        if 'cam_label' in image:
+            cam_label = image['cam_label']
+        intermediate = []
+        for modality in ('RGB', 'NI', 'TI'):
+            feature, _ = self.BACKBONE.forward_image_stage1(self.fit_modality(image[modality], modality),
+                                                            cam_label=cam_label, modality=PROMPT_MODALITIES[modality])
+            intermediate.append(feature)
+        return self.fusion_v_intermediate(self.bottleneck_fusion_v_intermediate(torch.cat(intermediate, dim=-1)))
 
     def forward(self, image, text=None, label=None, cam_label=None, view_label=None, return_pattern=3, img_path=None,
                 writer=None, epoch=None):
@@ -172,18 +268,23 @@ class IDEA(nn.Module):
             RGB_Text = text['rgb_text']
             NI_Text = text['ni_text']
             TI_Text = text['ti_text']
+        if self.training and self.inference_only:
+            raise RuntimeError('The model was transformed by optimize_for_inference and cannot be trained')
         real_text_rgb = []
         real_text_nir = []
         real_text_tir = []
-        for i in range(len(RGB_Text)):
-            real_text_rgb.append(self.tokenizer.decode(RGB_Text[i].tolist()))
-            real_text_nir.append(self.tokenizer.decode(NI_Text[i].tolist()))
-            real_text_tir.append(self.tokenizer.decode(TI_Text[i].tolist()))
+        if not self.training and not self.inference_only:
+            # decoded captions are only consumed by the CDA visualisation of the eval forward; decoding reads the
+            # tokens back to the host, so training skips it
+            for i in range(len(RGB_Text)):
+                real_text_rgb.append(self.tokenizer.decode(RGB_Text[i].tolist()))
+                real_text_nir.append(self.tokenizer.decode(NI_Text[i].tolist()))
+                real_text_tir.append(self.tokenizer.decode(TI_Text[i].tolist()))
         text_real = {'rgb_text': real_text_rgb, 'ni_text': real_text_nir, 'ti_text': real_text_tir}
         if self.training:
             RGB = image['RGB']
-            NI = image['NI']
-            TI = image['TI']
+            NI = self.fit_modality(image['NI'], 'NI')
+            TI = self.fit_modality(image['TI'], 'TI')
             
             # RGB_v_feas, RGB_v_global = self.BACKBONE.forward_image(image=RGB, cam_label=cam_label, label=label,view_label=view_label)
             # NI_v_feas, NI_v_global = self.BACKBONE.forward_image(image=NI, cam_label=cam_label, label=label,view_label=view_label)
@@ -191,9 +292,12 @@ class IDEA(nn.Module):
             # RGB_t_feas, RGB_t_global = self.BACKBONE.forward_text(text=RGB_Text, cam_label=cam_label, label=label,view_label=view_label)
 
             # 获取图像特征（可能包含多尺度特征）
-            RGB_v_results = self.BACKBONE.forward_image(image=RGB, cam_label=cam_label, label=label, view_label=view_label)
-            NI_v_results = self.BACKBONE.forward_image(image=NI, cam_label=cam_label, label=label, view_label=view_label)
-            TI_v_results = self.BACKBONE.forward_image(image=TI, cam_label=cam_label, label=label, view_label=view_label)
+            RGB_v_results = self.BACKBONE.forward_image(image=RGB, cam_label=cam_label, label=label, view_label=view_label,
+                                                        modality=PROMPT_MODALITIES['RGB'])
+            NI_v_results = self.BACKBONE.forward_image(image=NI, cam_label=cam_label, label=label, view_label=view_label,
+                                                       modality=PROMPT_MODALITIES['NI'])
+            TI_v_results = self.BACKBONE.forward_image(image=TI, cam_label=cam_label, label=label, view_label=view_label,
+                                                       modality=PROMPT_MODALITIES['TI'])
             RGB_t_results = self.BACKBONE.forward_text(text=RGB_Text, cam_label=cam_label, label=label, view_label=view_label)
 
             # 提取最终特征
@@ -244,9 +348,13 @@ class IDEA(nn.Module):
                         score_rgb_t, RGB_t_global, score_nir_t, NI_t_global, score_tir_t, TI_t_global
 
         else:
-            RGB = image['RGB']
-            NI = image['NI']
-            TI = image['TI']
+            # only the towers of the present modalities run (subset of image keys and TEST.MISS)
+            v_results = {}
+            for modality in self.present_modalities(image):
+                v_results[modality] = self.BACKBONE.forward_image(image=self.fit_modality(image[modality], modality),
+                                                                  cam_label=cam_label, label=label,
+                                                                  view_label=view_label,
+                                                                  modality=PROMPT_MODALITIES[modality])
             
             
             # NI_v_feas, NI_v_global, NI_t_feas, NI_t_global = self.BACKBONE(image=NI, text=NI_Text, cam_label=cam_label,
@@ -264,35 +372,9 @@ class IDEA(nn.Module):
             #                         [RGB_v_global, NI_v_global, TI_v_global, RGB_t_global, NI_t_global, TI_t_global],
             #                         dim=-1)}
 
-             # 获取图像特征（可能包含多尺度特征）
-            RGB_v_results = self.BACKBONE.forward_image(image=RGB, cam_label=cam_label, label=label, view_label=view_label)
-            NI_v_results = self.BACKBONE.forward_image(image=NI, cam_label=cam_label, label=label, view_label=view_label)
-            TI_v_results = self.BACKBONE.forward_image(image=TI, cam_label=cam_label, label=label, view_label=view_label)
-            RGB_t_results = self.BACKBONE.forward_text(text=RGB_Text, cam_label=cam_label, label=label, view_label=view_label)
-        
-             # 提取最终特征
-            RGB_v_feas, RGB_v_global = RGB_v_results[:2]
-            NI_v_feas, NI_v_global = NI_v_results[:2]
-            TI_v_feas, TI_v_global = TI_v_results[:2]
-            RGB_t_feas, RGB_t_global = RGB_t_results[:2]
-            
-            ori_v = torch.cat([RGB_v_global, NI_v_global, TI_v_global], dim=-1)
-            fusion_v = self.fusion_v(self.bottleneck_fusion_v(ori_v))
-            
-            multi_modal_dict = {"V_RGB": RGB_v_global, "V_NIR": NI_v_global, "V_TIR": TI_v_global,
-                                "T_RGB": RGB_t_global, 
-                                'LOCAL_v': fusion_v}
-            if self.DA:
-                boss_fea = torch.stack([RGB_v_global, NI_v_global, TI_v_global, RGB_t_global, NI_t_global, TI_t_global],
-                                       dim=1)
-                visual, textual = self.CDA(RGB_v_feas, NI_v_feas, TI_v_feas, boss_fea, writer=writer,
-                                                             epoch=epoch,
-                                                             img_path=img_path, texts=text_real)
-                local = torch.cat([visual, textual], dim=-1)
-                multi_modal_dict['LOCAL_v'] = visual
-                multi_modal_dict['LOCAL_t'] = textual
-                multi_modal_dict['LOCAL'] = local
-            return multi_modal_dict
+            return self.eval_head(v_results, RGB_Text, NI_Text, TI_Text, cam_label=cam_label, label=label,
+                                  view_label=view_label, writer=writer, epoch=epoch, img_path=img_path,
+                                  text_real=text_real)
 
 
 class IDEA_woText(nn.Module):
@@ -319,7 +401,8 @@ class IDEA_woText(nn.Module):
         self.window_size = self.q_size
         self.stride_block = self.q_size
         if self.DA:
-            self.CDA = CDA(q_size=self.q_size, window_size=self.q_size, ksize=4,
+            cda = FusedCDA if cfg.MODEL.DA_FUSED else CDA
+            self.CDA = cda(q_size=self.q_size, window_size=self.q_size, ksize=4,
                                                                stride=2,
                                                                stride_block=self.q_size,
                                                                offset_range_factor=cfg.MODEL.OFF_FAC,
@@ -357,40 +440,39 @@ class IDEA_woText(nn.Module):
             self.bottleneck_v_rgb = nn.BatchNorm1d(self.feat_dim)
             self.bottleneck_v_rgb.bias.requires_grad_(False)
             self.bottleneck_v_rgb.apply(weights_init_kaiming)
+        self.inference_only = False
 
     def load_param(self, trained_path):
         state_dict = torch.load(trained_path, map_location="cpu")
+        if 'base_hash' in state_dict:
+            # trainable delta (SOLVER.CHECKPOINT_DELTA), this model provides the frozen base
+            print(f"Successfully load delta ckpt!")
+            print(load_delta(self, state_dict))
+            return
+        if 'model' in state_dict and 'rng' in state_dict:
+            # training checkpoint of utils/checkpoint.py
+            state_dict = state_dict['model']
         print(f"Successfully load ckpt!")
         incompatibleKeys = self.load_state_dict(state_dict, strict=False)
         print(incompatibleKeys)
 
-    def flops(self, shape=(3, 256, 128)):
-        if self.image_size[0] != shape[1] or self.image_size[1] != shape[2]:
-            shape = (3, self.image_size[0], self.image_size[1])
-            # For vehicle reid, the input shape is (3, 128, 256)
-        supported_ops = give_supported_ops()
-        model = copy.deepcopy(self)
-        model.cuda().eval()
-        input_r = torch.ones((1, *shape), device=next(model.parameters()).device, dtype=torch.float32)
-        input_n = torch.ones((1, *shape), device=next(model.parameters()).device, dtype=torch.float32)
-        input_t = torch.ones((1, *shape), device=next(model.parameters()).device, dtype=torch.float32)
-        cam_label = torch.tensor(0, device=next(model.parameters()).device, dtype=torch.int64)
-        input = {"RGB": input_r, "NI": input_n, "TI": input_t, "cam_label": cam_label,
-                 'text': {'rgb_text': clip.tokenize('just a test').cuda(),
-                          'ni_text': clip.tokenize('just a test').cuda(),
-                          'ti_text': clip.tokenize('just a test').cuda()}}
-        Gflops, unsupported = flop_count(model=model, inputs=(input,), supported_ops=supported_ops)
-        print("~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~")
-        print(
-            "The out_proj here is called by the nn.MultiheadAttention, which has been calculated in th .forward(), so just ignore it.")
-        print("~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~")
-        print("For the bottleneck or classifier, it is not calculated during inference, so just ignore it.")
-        print("~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~")
-        print(
-            "For the Mamba Series, the code implementations are all used with the inner weight instead of directly calling the model, the FLOPs has been calculated with our inner function 'MambaInnerFn_jit', so just ignore it.")
-        print("~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~")
-        del model, input
-        return sum(Gflops.values()) * 1e9
+    def optimize_for_inference(self):
+        # fold BNNeck into fusion_v, drop the classifiers, precompute constants, see modeling/inference.py
+        return optimize_for_inference(self)
+
+    def flops(self, shape=None, batch_size=1):
+        """
+        FLOPs of one eval forward on (C, H, W) images of `shape`, None = the training resolution. See
+        profile_model.py for the per-module view.
+        """
+        from utils.profiler import count_flops
+        from utils.inputs import random_inputs
+        image_size = self.image_size if shape is None else shape[-2:]
+        training = self.training
+        self.eval()
+        flops = count_flops(self, random_inputs(batch_size, image_size, next(self.parameters()).device))
+        self.train(training)
+        return flops
 
 
     def forward(self, image, text=None, label=None, cam_label=None, view_label=None, return_pattern=3, img_path=None,
@@ -400,6 +482,8 @@ class IDEA_woText(nn.Module):
         RGB_Text = None
         NI_Text = None
         TI_Text = None
+        if self.training and self.inference_only:
+            raise RuntimeError('The model was transformed by optimize_for_inference and cannot be trained')
         if self.training:
             RGB = image['RGB']
             NI = image['NI']
@@ -483,6 +567,12 @@ class IDEA_woText(nn.Module):
             return multi_modal_dict
 
 
+def t2t_vit_t_24(**kwargs):
+    # t2t pulls in timm, import it only when the backbone is actually requested
+    from modeling.backbones.t2t import t2t_vit_t_24 as build
+    return build(**kwargs)
+
+
 __factory_T_type = {
     'vit_base_patch16_224': vit_base_patch16_224,
     'deit_base_patch16_224': vit_base_patch16_224,
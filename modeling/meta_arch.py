@@ -1,9 +1,8 @@
 import torch
 import torch.nn as nn
-from timm.models.layers import trunc_normal_
+from modeling.backbones.vit_pytorch import Mlp, trunc_normal_
 from modeling.clip.make_model_clipreid import load_clip_to_cpu
 from modeling.clip.LoRA import mark_only_lora_as_trainable as lora_train
-from modeling.backbones.vit_pytorch import Mlp
 
 
 def weights_init_kaiming(m):
@@ -79,8 +78,12 @@ class build_transformer(nn.Module):
                                           cfg.INPUT.SIZE_TRAIN[1] // cfg.MODEL.STRIDE_SIZE[1],
                                           cfg.MODEL.STRIDE_SIZE)
             print('Loading pretrained model from CLIP')
-            clip_model.to("cuda")
+            clip_model.to(cfg.MODEL.DEVICE)
             self.base = clip_model
+            if cfg.MODEL.GRAD_CKPT:
+                self.base.set_grad_checkpointing(cfg.MODEL.GRAD_CKPT)
+            if cfg.MODEL.COMPILE:
+                self.base.compile_towers(cfg.MODEL.COMPILE_MODE)
             if cfg.MODEL.FROZEN:
                 lora_train(self.base)
             if cfg.MODEL.SIE_CAMERA and cfg.MODEL.SIE_VIEW:
@@ -164,8 +167,12 @@ class build_transformer(nn.Module):
             return image_features, global_feat_img
             #        (64，128，512)      (64,512)        (64,77,512)     (64,512)
         # 返回特征
-        # return_values = image_features[:, 1:] 
-        
+        # return_values = image_features[:, 1:]
+
+    def forward_image_stage1(self, image, cam_label=None, modality=None):
+        # cascade retrieval: stop at the intermediate layer, returns (intermediate_features, state)
+        cv_embed = self.sie_xishu * self.cv_embed[cam_label] if self.cv_embed_sign else None
+        return self.base.visual.forward_stage1(image.type(self.base.dtype), cv_embed, modality)
 
     def forward_text(self, text=None, label=None, cam_label=None, view_label=None, modality=None):
         text_features = self.base.encode_text(text, modality)
@@ -0,0 +1,101 @@
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from modeling.clip.model import ResidualAttentionBlock
+
+QUANT_MODES = ('dynamic', 'static')
+
+
+def linear_weight(linear):
+    # float weight/bias of an nn.Linear, a dynamic/static quantized Linear or a QuantWrapper around one
+    linear = getattr(linear, 'module', linear)
+    if isinstance(linear, nn.Linear):
+        return linear.weight, linear.bias
+    return linear.weight().dequantize(), linear.bias()
+
+
+class LinearAttention(nn.Module):
+    """
+    nn.MultiheadAttention (need_weights=False) with the packed q/k/v input projection as a plain nn.Linear,
+    so that both projections of the CLIP blocks are visible to the quantization passes (the module stores
+    `in_proj_weight` as a raw parameter and its `out_proj` is excluded from dynamic quantization).
+    """
+
+    def __init__(self, attn):
+        super(LinearAttention, self).__init__()
+        self.num_heads = attn.num_heads
+        self.embed_dim = attn.embed_dim
+        self.in_proj = nn.Linear(attn.embed_dim, 3 * attn.embed_dim, bias=attn.in_proj_bias is not None,
+                                 device=attn.in_proj_weight.device, dtype=attn.in_proj_weight.dtype)
+        self.out_proj = nn.Linear(attn.embed_dim, attn.embed_dim, bias=attn.out_proj.bias is not None,
+                                  device=attn.out_proj.weight.device, dtype=attn.out_proj.weight.dtype)
+        with torch.no_grad():
+            self.in_proj.weight.copy_(attn.in_proj_weight)
+            self.out_proj.weight.copy_(attn.out_proj.weight)
+            if attn.in_proj_bias is not None:
+                self.in_proj.bias.copy_(attn.in_proj_bias)
+            if attn.out_proj.bias is not None:
+                self.out_proj.bias.copy_(attn.out_proj.bias)
+
+    @property
+    def in_proj_weight(self):
+        return linear_weight(self.in_proj)[0]
+
+    @property
+    def in_proj_bias(self):
+        return linear_weight(self.in_proj)[1]
+
+    def forward(self, query, key, value, need_weights=False, attn_mask=None):
+        # self-attention only (query is key is value), sequence-first [L, B, D] like nn.MultiheadAttention
+        length, batch, _ = query.shape
+        q, k, v = self.in_proj(query).chunk(3, dim=-1)
+        q, k, v = (t.reshape(length, batch * self.num_heads, -1).transpose(0, 1) for t in (q, k, v))
+        if attn_mask is not None:
+            attn_mask = attn_mask.to(q.dtype)
+        out = F.scaled_dot_product_attention(q, k, v, attn_mask=attn_mask)
+        out = out.transpose(0, 1).reshape(length, batch, self.embed_dim)
+        return self.out_proj(out), None
+
+
+def swap_attention(model):
+    """Replace the nn.MultiheadAttention of every CLIP block by the equivalent LinearAttention (in place)."""
+    for module in model.modules():
+        if isinstance(module, ResidualAttentionBlock) and isinstance(module.attn, nn.MultiheadAttention):
+            module.attn = LinearAttention(module.attn)
+    return model
+
+
+@torch.no_grad()
+def quantize_dynamic_int8(model, backend='x86'):
+    """
+    Post-training dynamic int8 quantization for CPU inference: int8 weights for every nn.Linear, activations
+    quantized per batch at run time. Expects a model transformed by optimize_for_inference.
+    """
+    torch.backends.quantized.engine = backend
+    model.float().cpu()
+    swap_attention(model)
+    return torch.ao.quantization.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8, inplace=True)
+
+
+@torch.no_grad()
+def prepare_static_int8(model, backend='x86'):
+    """
+    First half of static int8 quantization: every nn.Linear is wrapped with quant/dequant stubs and observers.
+    Run calibration batches through the returned model, then call convert_static_int8.
+    """
+    torch.backends.quantized.engine = backend
+    model.float().cpu()
+    swap_attention(model)
+    qconfig = torch.ao.quantization.get_default_qconfig(backend)
+    for parent in list(model.modules()):
+        for name, child in list(parent.named_children()):
+            if type(child) is nn.Linear:
+                child.qconfig = qconfig
+                setattr(parent, name, torch.ao.quantization.QuantWrapper(child))
+    return torch.ao.quantization.prepare(model, inplace=True)
+
+
+@torch.no_grad()
+def convert_static_int8(model):
+    """Second half of static int8 quantization: observed Linear layers become int8 Linear layers."""
+    return torch.ao.quantization.convert(model, inplace=True)
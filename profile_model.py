@@ -0,0 +1,61 @@
+import os
+import json
+import argparse
+import torch
+from config import cfg
+import modeling.meta_arch as meta_arch
+from modeling import make_model
+from utils.profiler import ModuleProfiler, COLUMNS, format_table
+from utils.inputs import random_inputs, random_clip
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="IDEA per-module FLOPs / parameters / memory / latency profile")
+    parser.add_argument(
+        "--config_file", default="", help="path to config file", type=str
+    )
+    parser.add_argument("--batch", default=1, type=int, help="batch size of the profiled eval forward")
+    parser.add_argument("--return_keys", default="", type=str,
+                        help="comma separated output keys that are consumed, e.g. LOCAL_v,LOCAL_t")
+    parser.add_argument("--depth", default=2, type=int, help="submodules up to this many dots deep are regions")
+    parser.add_argument("--sort", default="ms", choices=[key for key, _, _, _ in COLUMNS] + ['order'],
+                        help="column to sort by, order keeps the execution order")
+    parser.add_argument("--iters", default=5, type=int, help="timed forward passes")
+    parser.add_argument("--output", default="", type=str, help="optional .json or .csv copy of the table")
+    parser.add_argument("opts", help="Modify config options using the command-line", default=None,
+                        nargs=argparse.REMAINDER)
+
+    args = parser.parse_args()
+
+    if args.config_file != "":
+        cfg.merge_from_file(args.config_file)
+    cfg.merge_from_list(args.opts)
+    if cfg.MODEL.DEVICE == 'cuda' and not torch.cuda.is_available():
+        cfg.MODEL.DEVICE = 'cpu'
+    if not os.path.exists(cfg.MODEL.PRETRAIN_PATH_T):
+        # FLOPs, parameters and latency do not depend on the weights
+        meta_arch.load_clip_to_cpu = random_clip(12)
+        print('{} not found, profiling a randomly initialized CLIP'.format(cfg.MODEL.PRETRAIN_PATH_T))
+    cfg.freeze()
+    os.environ['CUDA_VISIBLE_DEVICES'] = cfg.MODEL.DEVICE_ID
+    device = cfg.MODEL.DEVICE
+
+    model = make_model(cfg, num_class=10, camera_num=1, view_num=1)
+    if cfg.TEST.WEIGHT:
+        model.load_param(cfg.TEST.WEIGHT)
+    model.to(device)
+    model.eval()
+    inputs = random_inputs(args.batch, cfg.INPUT.SIZE_TEST, device)
+    return_keys = [key for key in args.return_keys.split(',') if key]
+
+    rows = ModuleProfiler(model, depth=args.depth).profile(inputs, return_keys=return_keys, iters=args.iters)
+    print('batch {} on {}, return keys {}'.format(args.batch, device, return_keys or 'all'))
+    print(format_table(rows, sort=args.sort))
+    if args.output.endswith('.json'):
+        with open(args.output, 'w') as f:
+            json.dump(rows, f, indent=2)
+    elif args.output:
+        with open(args.output, 'w') as f:
+            f.write(','.join(key for key, _, _, _ in COLUMNS) + '\n')
+            for row in rows:
+                f.write(','.join(str(row[key]) for key, _, _, _ in COLUMNS) + '\n')
@@ -1,37 +1,68 @@
+import inspect
+from collections import OrderedDict
 import torch
 
 
+def param_rule(cfg, key):
+    # (lr, weight_decay) of one parameter
+    lr = cfg.SOLVER.BASE_LR
+    weight_decay = cfg.SOLVER.WEIGHT_DECAY
+    if "bias" in key:
+        lr = cfg.SOLVER.BASE_LR * cfg.SOLVER.BIAS_LR_FACTOR
+        weight_decay = cfg.SOLVER.WEIGHT_DECAY_BIAS
+
+    if cfg.MODEL.TRANSFORMER_TYPE == 'ViT-B-16':
+        if not cfg.MODEL.FROZEN:
+            lr = cfg.SOLVER.BASE_LR * 0.01
+
+    if cfg.SOLVER.LARGE_FC_LR:
+        if "classifier" in key or "arcface" in key:
+            lr = cfg.SOLVER.BASE_LR * 2
+    return lr, weight_decay
+
+
+def build_optimizer(optimizer_cls, params, fused=True, **kwargs):
+    """
+    optimizer_cls(params, **kwargs) with the fused kernels when the class has them and accepts the parameters
+    (devices, dtypes), else with the foreach (multi-tensor) ones, else the per-tensor loop.
+    """
+    accepted = inspect.signature(optimizer_cls).parameters
+    if fused and 'fused' in accepted:
+        try:
+            return optimizer_cls(params, fused=True, **kwargs)
+        except (RuntimeError, ValueError):
+            pass
+    if fused and 'foreach' in accepted:
+        return optimizer_cls(params, foreach=True, **kwargs)
+    return optimizer_cls(params, **kwargs)
+
+
 def make_optimizer(cfg, model, center_criterion):
-    params = []
+    # one param group per (lr, weight_decay) rule, in order of first use, instead of one group per tensor
+    buckets = OrderedDict()
     print('~' * 50)
     print("Initializing optimizer checking: ")
     for key, value in model.named_parameters():
         if not value.requires_grad:
             continue
-        lr = cfg.SOLVER.BASE_LR
-        weight_decay = cfg.SOLVER.WEIGHT_DECAY
-        if "bias" in key:
-            lr = cfg.SOLVER.BASE_LR * cfg.SOLVER.BIAS_LR_FACTOR
-            weight_decay = cfg.SOLVER.WEIGHT_DECAY_BIAS
-
-        if cfg.MODEL.TRANSFORMER_TYPE == 'ViT-B-16':
-            if not cfg.MODEL.FROZEN:
-                lr = cfg.SOLVER.BASE_LR * 0.01
-
-        if cfg.SOLVER.LARGE_FC_LR:
-            if "classifier" in key or "arcface" in key:
-                lr = cfg.SOLVER.BASE_LR * 2
-                print('Using two times learning rate for fc ')
-
-        params += [{"params": [value], "lr": lr, "weight_decay": weight_decay}]
+        lr, weight_decay = param_rule(cfg, key)
+        if cfg.SOLVER.LARGE_FC_LR and ("classifier" in key or "arcface" in key):
+            print('Using two times learning rate for fc ')
+        buckets.setdefault((lr, weight_decay), []).append(value)
         print("key: ", key, "lr: ", lr, "weight_decay: ", weight_decay)
+    params = [{"params": values, "lr": lr, "weight_decay": weight_decay}
+              for (lr, weight_decay), values in buckets.items()]
+    for group in params:
+        print("group: ", len(group["params"]), "tensors, lr: ", group["lr"], "weight_decay: ", group["weight_decay"])
     print('~' * 50)
+    fused = cfg.SOLVER.FUSED_OPTIMIZER
     if cfg.SOLVER.OPTIMIZER_NAME == 'SGD':
-        optimizer = getattr(torch.optim, cfg.SOLVER.OPTIMIZER_NAME)(params, momentum=cfg.SOLVER.MOMENTUM)
+        optimizer = build_optimizer(torch.optim.SGD, params, fused, momentum=cfg.SOLVER.MOMENTUM)
     elif cfg.SOLVER.OPTIMIZER_NAME == 'AdamW':
-        optimizer = torch.optim.AdamW(params, lr=cfg.SOLVER.BASE_LR, weight_decay=cfg.SOLVER.WEIGHT_DECAY)
+        optimizer = build_optimizer(torch.optim.AdamW, params, fused, lr=cfg.SOLVER.BASE_LR,
+                                    weight_decay=cfg.SOLVER.WEIGHT_DECAY)
     else:
-        optimizer = getattr(torch.optim, cfg.SOLVER.OPTIMIZER_NAME)(params)
+        optimizer = build_optimizer(getattr(torch.optim, cfg.SOLVER.OPTIMIZER_NAME), params, fused)
     optimizer_center = torch.optim.SGD(center_criterion.parameters(), lr=cfg.SOLVER.CENTER_LR)
 
     return optimizer, optimizer_center
@@ -1,11 +1,30 @@
+from utils.startup import profiler as startup
 import os
+import sys
+import torch
 from config import cfg
 import argparse
 from data import make_dataloader
 from modeling import make_model
-from engine.processor import do_inference
+from engine.processor import do_inference, do_missing_inference, do_quant_inference
+from engine.cascade import do_cascade_inference
 from utils.logger import setup_logger
 
+startup.mark('imports')
+
+
+def profile_first_batch(cfg, model, val_loader):
+    device = cfg.MODEL.DEVICE
+    with startup.stage('first batch (load)'):
+        img, pid, camid, camids, target_view, imgpath, text = next(iter(val_loader))
+    with startup.stage('first batch (forward)', synchronize=True):
+        model.to(device)
+        img = {key: value.to(device) for key, value in img.items()}
+        text = {key: value.to(device) for key, value in text.items()}
+        with torch.no_grad():
+            model(image=img, text=text, cam_label=camids.to(device), view_label=target_view.to(device),
+                  img_path=imgpath)
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="IDEA Testing")
     parser.add_argument(
@@ -13,6 +32,8 @@ if __name__ == "__main__":
     )
     parser.add_argument("opts", help="Modify config options using the command-line", default=None,
                         nargs=argparse.REMAINDER)
+    parser.add_argument("--profile-startup", dest="profile_startup", action="store_true",
+                        help="report the wall time of imports, dataset, model build, weight load and the first batch, then exit")
 
     args = parser.parse_args()
 
@@ -36,9 +57,23 @@ if __name__ == "__main__":
 
     os.environ['CUDA_VISIBLE_DEVICES'] = cfg.MODEL.DEVICE_ID
 
-    train_loader, train_loader_normal, val_loader, num_query, num_classes, camera_num, view_num = make_dataloader(cfg)
+    with startup.stage('dataset construction'):
+        train_loader, train_loader_normal, val_loader, num_query, num_classes, camera_num, view_num = make_dataloader(cfg)
 
-    model = make_model(cfg, num_class=num_classes, camera_num=camera_num, view_num=view_num)
+    with startup.stage('model build', synchronize=True):
+        model = make_model(cfg, num_class=num_classes, camera_num=camera_num, view_num=view_num)
     model.eval()
-    model.load_param("~")
-    do_inference(cfg, model, val_loader, num_query, logger)
+    with startup.stage('weight load'):
+        model.load_param("~")
+    if args.profile_startup:
+        profile_first_batch(cfg, model, val_loader)
+        startup.report(logger)
+        sys.exit(0)
+    if cfg.TEST.CASCADE:
+        do_cascade_inference(cfg, model, val_loader, num_query, logger)
+    elif cfg.TEST.MISS_SWEEP:
+        do_missing_inference(cfg, model, val_loader, num_query, logger)
+    elif cfg.TEST.QUANT:
+        do_quant_inference(cfg, model, val_loader, num_query, logger)
+    else:
+        do_inference(cfg, model, val_loader, num_query, logger)
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the tests import the repo packages (config, layers, modeling, utils) from the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
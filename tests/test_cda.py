@@ -0,0 +1,60 @@
+import torch
+from modeling.fusion_part.CDA_Module import CDA, FusedCDA
+
+# FusedCDA against the per-block CDA loop it vectorizes: one CDA state_dict is loaded into both modules and the
+# outputs, the input gradients and the parameter gradients are compared in float64
+
+
+def cda_pair(share, q_size, window_size, stride_block, n_heads=2, n_head_channels=16):
+    kwargs = dict(q_size=q_size, window_size=window_size, ksize=4, stride=2, stride_block=stride_block,
+                  offset_range_factor=2, share=share, n_heads=n_heads, n_head_channels=n_head_channels)
+    torch.manual_seed(0)
+    reference = CDA(**kwargs).double()
+    fused = FusedCDA(**kwargs).double()
+    fused.load_state_dict(reference.state_dict())
+    return reference, fused
+
+
+def inputs(module, batch=3):
+    generator = torch.Generator().manual_seed(1)
+    n = module.q_size[0] * module.q_size[1]
+    shapes = [(batch, n, module.feat_dim)] * 3 + [(batch, 6, module.feat_dim)]
+    return [torch.randn(*shape, generator=generator, dtype=torch.float64, requires_grad=True) for shape in shapes]
+
+
+def gradients(module, tensors):
+    outputs = module(*tensors)
+    loss = sum((output * torch.linspace(-1, 1, output.numel(), dtype=output.dtype).view_as(output)).sum()
+               for output in outputs)
+    params = list(module.parameters())
+    grads = torch.autograd.grad(loss, tensors + params, allow_unused=True)
+    # blocks after the first do not reach the output: no gradient in the loop, zeros in the stacked weights
+    grads = [torch.zeros_like(p) if g is None else g for g, p in zip(grads, tensors + params)]
+    return outputs, grads
+
+
+def test_fused_cda_matches_cda():
+    # num_da 1 (window = grid, as built by make_model) and 4 (overlapping 6 x 6 windows of a 10 x 10 grid)
+    for q_size, window_size, stride_block in (((16, 8), (16, 8), (16, 8)), ((10, 10), (6, 6), (4, 4))):
+        for share in (True, False):
+            reference, fused = cda_pair(share, q_size, window_size, stride_block)
+            assert reference.num_da == fused.num_da
+            tensors = inputs(reference)
+            outputs, grads = gradients(reference, tensors)
+            fused_outputs, fused_grads = gradients(fused, tensors)
+            for output, fused_output in zip(outputs, fused_outputs):
+                torch.testing.assert_close(fused_output, output, rtol=1e-10, atol=1e-12)
+            for grad, fused_grad in zip(grads, fused_grads):
+                torch.testing.assert_close(fused_grad, grad, rtol=1e-10, atol=1e-12)
+
+
+def test_fused_cda_eval_weight_cache():
+    # without gradients the stacked weights are cached, a parameter update has to invalidate them
+    reference, fused = cda_pair(False, (10, 10), (6, 6), (4, 4))
+    tensors = [tensor.detach() for tensor in inputs(reference)]
+    with torch.no_grad():
+        fused(*tensors)
+        for module in (reference, fused):
+            module.da_group[0].proj_q.weight.add_(0.1)
+        for output, fused_output in zip(reference(*tensors), fused(*tensors)):
+            torch.testing.assert_close(fused_output, output, rtol=1e-10, atol=1e-12)
@@ -0,0 +1,67 @@
+import os
+import sys
+import subprocess
+import torch
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# one process of the test: `pretrained` writes a small CLIP file, `save` builds IDEA on it and writes a delta
+# checkpoint plus its full state, `load` builds IDEA on it and composes the delta; argv: mode, directory, seed
+SCRIPT = '''
+import os
+import sys
+import torch
+from config import cfg
+import modeling.meta_arch as meta_arch
+from modeling import make_model
+from modeling.clip import clip
+from modeling.clip.model import CLIP, convert_weights
+from utils.checkpoint import CheckpointManager
+
+mode, out, seed = sys.argv[1], sys.argv[2], int(sys.argv[3])
+cfg.merge_from_file('configs/RGBNT201/IDEA.yml')
+cfg.merge_from_list(['MODEL.DEVICE', 'cpu', 'MODEL.FROZEN', True, 'MODEL.INTERMEDIATE_LAYER_IDX', -2,
+                     'SOLVER.CHECKPOINT_DELTA', True, 'OUTPUT_DIR', out])
+torch.manual_seed(seed)
+pretrained = os.path.join(out, 'clip.pt')
+if mode == 'pretrained':
+    # two-layer towers in the layout of the released ViT-B-16 file (224 resolution), which has none of the
+    # tensors this repo adds to CLIP
+    model = CLIP(cfg, 512, 224, 2, 768, 16, 16, 77, 49408, 512, 8, 1, 14, 14)
+    convert_weights(model)
+    added = ('text_prompt', 'visual.new_positional_embedding', 'visual.proj_intermediate', 'visual.ln_intermediate.')
+    torch.save({key: value for key, value in model.state_dict().items() if not key.startswith(added)}, pretrained)
+    sys.exit()
+meta_arch.load_clip_to_cpu = lambda cfg, name, h, w, stride: clip.build_model(cfg, torch.load(pretrained), h, w,
+                                                                             stride)
+model = make_model(cfg, num_class=10, camera_num=4, view_num=1)
+manager = CheckpointManager(cfg)
+if mode == 'save':
+    with torch.no_grad():
+        for p in model.parameters():
+            if p.requires_grad:
+                p.add_(0.01)
+    manager.save(manager.state(model, epoch=2, iteration=0, best_index={}), 1)
+    manager.wait()
+    torch.save(model.state_dict(), os.path.join(out, 'expected.pth'))
+else:
+    model.load_param(manager.path(1))
+    expected = torch.load(os.path.join(out, 'expected.pth'))
+    different = [key for key, value in model.state_dict().items() if not torch.equal(value, expected[key])]
+    assert not different, different
+'''
+
+
+def run(mode, directory, seed):
+    subprocess.run([sys.executable, '-c', SCRIPT, mode, str(directory), str(seed)], cwd=ROOT, check=True,
+                   stdout=subprocess.DEVNULL)
+
+
+def test_delta_reloads_under_another_seed(tmp_path):
+    run('pretrained', tmp_path, 0)
+    run('save', tmp_path, 1)
+    run('load', tmp_path, 2)
+    delta = torch.load(str(tmp_path / 'IDEA_1.pth'))['model']
+    # the pretrained tower weights stay out of the delta, the randomly initialized frozen ones are in it
+    assert 'BACKBONE.base.transformer.resblocks.0.attn.in_proj_weight' not in delta
+    assert 'BACKBONE.base.visual.proj_intermediate' in delta
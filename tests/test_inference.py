@@ -0,0 +1,40 @@
+import copy
+import torch
+from config import cfg as default_cfg
+import modeling.meta_arch as meta_arch
+from modeling import make_model
+from utils.inputs import random_inputs, random_clip
+
+# optimize_for_inference of IDEA on a random two-layer CLIP: the folded BNNeck -> fusion Linear pairs, the dropped
+# classifiers and the precomputed constants leave the eval features of the original multi_modal_dict unchanged
+
+
+def test_optimize_for_inference_keeps_features(monkeypatch):
+    cfg = default_cfg.clone()
+    cfg.merge_from_file('configs/RGBNT201/IDEA.yml')
+    cfg.merge_from_list(['MODEL.DEVICE', 'cpu', 'MODEL.INTERMEDIATE_LAYER_IDX', -2])
+    monkeypatch.setattr(meta_arch, 'load_clip_to_cpu', random_clip(2))
+    torch.manual_seed(0)
+    model = make_model(cfg, num_class=10, camera_num=4, view_num=1).float().eval()
+    generator = torch.Generator().manual_seed(1)
+    with torch.no_grad():
+        # running statistics and affine parameters away from the identity, or the fold would be trivially exact
+        for module in model.modules():
+            if isinstance(module, torch.nn.BatchNorm1d):
+                size = module.num_features
+                module.running_mean.copy_(torch.randn(size, generator=generator))
+                module.running_var.copy_(torch.rand(size, generator=generator) * 4 + 0.25)
+                module.weight.copy_(torch.rand(size, generator=generator) + 0.5)
+                module.bias.copy_(torch.randn(size, generator=generator))
+    inputs = random_inputs(2, cfg.INPUT.SIZE_TEST, 'cpu')
+    inputs['image'] = {key: torch.randn(value.shape, generator=generator) for key, value in inputs['image'].items()}
+    with torch.no_grad():
+        expected = model(**inputs)
+        optimized = copy.deepcopy(model).optimize_for_inference()
+        actual = optimized(**inputs)
+
+    assert not any('classifier' in name for name, _ in optimized.named_modules())
+    assert isinstance(optimized.bottleneck_fusion_v, torch.nn.Identity)
+    assert list(actual) == list(expected)
+    for key in expected:
+        torch.testing.assert_close(actual[key], expected[key], rtol=1e-4, atol=1e-4)
@@ -0,0 +1,213 @@
+import torch
+from torch import nn
+from layers.cluster_loss import ClusterLoss, ClusterLoss_local
+from layers.range_loss import RangeLoss
+from layers.hcloss import hetero_loss
+from layers.mutilmargin import multiModalMarginLossNew
+from layers.metric_learning import ContrastiveLoss
+
+# the per-class / per-anchor loop implementations the vectorized losses replaced, kept as references; only the
+# deprecated addmm_ signature, torch.range and the float32 buffers are adapted so that they run in float64
+
+
+def reference_euclidean_dist(x, y):
+    m, n = x.size(0), y.size(0)
+    xx = torch.pow(x, 2).sum(1, keepdim=True).expand(m, n)
+    yy = torch.pow(y, 2).sum(1, keepdim=True).expand(n, m).t()
+    dist = (xx + yy).addmm(x, y.t(), beta=1, alpha=-2)
+    return dist.clamp(min=1e-12).sqrt()
+
+
+def reference_shortest_dist(dist_mat):
+    m, n = dist_mat.size()[:2]
+    dist = [[0 for _ in range(n)] for _ in range(m)]
+    for i in range(m):
+        for j in range(n):
+            if (i == 0) and (j == 0):
+                dist[i][j] = dist_mat[i, j]
+            elif (i == 0) and (j > 0):
+                dist[i][j] = dist[i][j - 1] + dist_mat[i, j]
+            elif (i > 0) and (j == 0):
+                dist[i][j] = dist[i - 1][j] + dist_mat[i, j]
+            else:
+                dist[i][j] = torch.min(dist[i - 1][j], dist[i][j - 1]) + dist_mat[i, j]
+    return dist[-1][-1]
+
+
+def reference_local_dist(x, y):
+    M, m, d = x.size()
+    N, n, d = y.size()
+    dist_mat = reference_euclidean_dist(x.contiguous().view(M * m, d), y.contiguous().view(N * n, d))
+    dist_mat = (torch.exp(dist_mat) - 1.) / (torch.exp(dist_mat) + 1.)
+    return reference_shortest_dist(dist_mat.contiguous().view(M, m, N, n).permute(1, 3, 0, 2))
+
+
+def reference_labels(targets, ordered, ids_per_batch, imgs_per_id):
+    if ordered and targets.size(0) == ids_per_batch * imgs_per_id:
+        return targets[0:targets.size(0):imgs_per_id]
+    return targets.unique()
+
+
+def reference_cluster_loss(features, targets, margin, ordered, ids_per_batch, imgs_per_id, dist):
+    unique_labels = reference_labels(targets, ordered, ids_per_batch, imgs_per_id)
+    inter_min_distance = torch.zeros(unique_labels.size(0), dtype=features.dtype)
+    intra_max_distance = torch.zeros(unique_labels.size(0), dtype=features.dtype)
+    center_features = torch.zeros(unique_labels.size(0), *features.shape[1:], dtype=features.dtype)
+    index = torch.arange(unique_labels.size(0))
+    for i in range(unique_labels.size(0)):
+        same_class_features = features[targets == unique_labels[i]]
+        center_features[i] = same_class_features.mean(dim=0)
+        intra_max_distance[i] = dist(center_features[index == i], same_class_features).max()
+    for i in range(unique_labels.size(0)):
+        inter_min_distance[i] = dist(center_features[index == i], center_features[index != i]).min()
+    cluster_loss = torch.mean(torch.relu(intra_max_distance - inter_min_distance + margin))
+    return cluster_loss, intra_max_distance, inter_min_distance
+
+
+def reference_intra_class_loss(features, targets, k, ordered, ids_per_batch, imgs_per_id):
+    unique_labels = reference_labels(targets, ordered, ids_per_batch, imgs_per_id)
+    intra_distance = torch.zeros(unique_labels.size(0), dtype=features.dtype)
+    for i in range(unique_labels.size(0)):
+        same_class_features = features[targets == unique_labels[i]]
+        dist_array = reference_euclidean_dist(same_class_features, same_class_features).view(1, -1)
+        top_k = dist_array.sort()[0][0, -k * 2::2]
+        intra_distance[i] = k / torch.sum(1.0 / top_k)
+    return torch.sum(intra_distance)
+
+
+def reference_inter_class_loss(features, targets, margin, ordered, ids_per_batch, imgs_per_id):
+    unique_labels = reference_labels(targets, ordered, ids_per_batch, imgs_per_id)
+    center_features = torch.stack([features[targets == label].mean(dim=0) for label in unique_labels])
+    n = center_features.size(0)
+    min_inter_class_dist = reference_euclidean_dist(center_features, center_features).view(1, -1).sort()[0][0][n]
+    return torch.relu(margin - min_inter_class_dist)
+
+
+def reference_center_dist(center1, center2, dist_type):
+    if dist_type == 'l2':
+        return nn.MSELoss(reduction='sum')(center1, center2)
+    if dist_type == 'l1':
+        return nn.L1Loss()(center1, center2)
+    return 1 - nn.CosineSimilarity(dim=0)(center1, center2)
+
+
+def reference_hetero_loss(feat1, feat2, label1, dist_type):
+    label_num = len(label1.unique())
+    feat1, feat2 = feat1.chunk(label_num, 0), feat2.chunk(label_num, 0)
+    dist = 0
+    for i in range(len(feat1)):
+        center_dist = reference_center_dist(feat1[i].mean(dim=0), feat2[i].mean(dim=0), dist_type)
+        dist += max(0, center_dist) if dist_type == 'cos' else max(0, abs(center_dist))
+    return dist
+
+
+def reference_margin_loss(feat1, feat2, feat3, label1, margin, dist_type):
+    # the loop only had the l2 / l1 branches, cos uses the 1 - cosine distance of hetero_loss
+    label_num = len(label1.unique())
+    feat1, feat2, feat3 = feat1.chunk(label_num, 0), feat2.chunk(label_num, 0), feat3.chunk(label_num, 0)
+    dist = 0
+    for i in range(len(feat1)):
+        center1, center2, center3 = feat1[i].mean(dim=0), feat2[i].mean(dim=0), feat3[i].mean(dim=0)
+        dist += max(abs(margin - reference_center_dist(center1, center2, dist_type)),
+                    abs(margin - reference_center_dist(center2, center3, dist_type)),
+                    abs(margin - reference_center_dist(center1, center3, dist_type)))
+    return dist
+
+
+def reference_contrastive_loss(inputs, targets, margin):
+    n = inputs.size(0)
+    sim_mat = torch.matmul(inputs, inputs.t())
+    loss = []
+    for i in range(n):
+        pos_pair_ = torch.masked_select(sim_mat[i], targets == targets[i])
+        pos_pair_ = torch.masked_select(pos_pair_, pos_pair_ < 1)
+        neg_pair_ = torch.masked_select(sim_mat[i], targets != targets[i])
+        neg_pair = torch.masked_select(torch.sort(neg_pair_)[0], torch.sort(neg_pair_)[0] > margin)
+        neg_loss = torch.sum(neg_pair) if len(neg_pair) > 0 else 0
+        loss.append(torch.sum(-torch.sort(pos_pair_)[0] + 1) + neg_loss)
+    return sum(loss) / n
+
+
+def batches(*shape):
+    """(features, targets, ordered) of an ordered 4 x 4 batch and of a shuffled one with 1 to 5 images per id."""
+    generator = torch.Generator().manual_seed(0)
+    ordered = torch.arange(4).repeat_interleave(4)
+    unequal = torch.tensor([0, 1, 1, 2, 2, 2, 3, 3, 3, 3, 4, 4, 4, 4, 4])
+    unequal = unequal[torch.randperm(unequal.numel(), generator=generator)]
+    return [(torch.randn(targets.numel(), *shape, generator=generator, dtype=torch.float64), targets, flag)
+            for targets, flag in ((ordered, True), (unequal, False))]
+
+
+def assert_parity(loss, reference, features, outputs=None, reference_outputs=None):
+    # values (and extra outputs) and the gradients with respect to the features
+    gradient, = torch.autograd.grad(loss, features, retain_graph=True)
+    reference_gradient, = torch.autograd.grad(reference, features)
+    torch.testing.assert_close(loss, reference, rtol=1e-10, atol=1e-12)
+    torch.testing.assert_close(gradient, reference_gradient, rtol=1e-10, atol=1e-12)
+    for output, reference_output in zip(outputs or (), reference_outputs or ()):
+        torch.testing.assert_close(output, reference_output, rtol=1e-10, atol=1e-12)
+
+
+def test_cluster_loss():
+    for features, targets, ordered in batches(32):
+        features.requires_grad_()
+        loss = ClusterLoss(margin=10, use_gpu=False, ordered=ordered, ids_per_batch=4, imgs_per_id=4)
+        outputs = loss(features, targets)
+        reference = reference_cluster_loss(features, targets, 10, ordered, 4, 4, reference_euclidean_dist)
+        assert_parity(outputs[0], reference[0], features, outputs[1:], reference[1:])
+
+
+def test_cluster_loss_local():
+    # small features so that the exp form of the reference does not overflow
+    for features, targets, ordered in batches(3, 8):
+        features = (0.1 * features).requires_grad_()
+        loss = ClusterLoss_local(margin=10, use_gpu=False, ordered=ordered, ids_per_batch=4, imgs_per_id=4)
+        outputs = loss(features, targets)
+        reference = reference_cluster_loss(features, targets, 10, ordered, 4, 4, reference_local_dist)
+        assert_parity(outputs[0], reference[0], features, outputs[1:], reference[1:])
+
+
+def test_shortest_dist():
+    # anti-diagonal DP against the cell loop, square and rectangular grids with batch dimensions
+    generator = torch.Generator().manual_seed(0)
+    loss = ClusterLoss_local(use_gpu=False)
+    for m, n in ((1, 1), (3, 3), (2, 5), (5, 2)):
+        dist_mat = torch.rand(m, n, 4, 3, generator=generator, dtype=torch.float64, requires_grad=True)
+        assert_parity(loss._shortest_dist(dist_mat).sum(), reference_shortest_dist(dist_mat).sum(), dist_mat)
+
+
+def test_range_loss():
+    # k = 2 and 3: the 1 and 2 image classes of the shuffled batch have fewer than k pairs
+    for k in (2, 3):
+        for features, targets, ordered in batches(32):
+            features.requires_grad_()
+            loss = RangeLoss(k=k, margin=10, use_gpu=False, ordered=ordered, ids_per_batch=4, imgs_per_id=4)
+            intra = loss._intra_class_loss(features, targets, ordered, 4, 4)
+            assert_parity(intra, reference_intra_class_loss(features, targets, k, ordered, 4, 4), features)
+            inter = loss._inter_class_loss(features, targets, ordered, 4, 4)
+            assert_parity(inter, reference_inter_class_loss(features, targets, 10, ordered, 4, 4), features)
+
+
+def test_hetero_loss():
+    for dist_type in ('l2', 'l1', 'cos'):
+        for features, targets, _ in batches(2, 32):
+            features.requires_grad_()
+            feat1, feat2 = features.unbind(1)
+            loss = hetero_loss(dist_type=dist_type)(feat1, feat2, targets)
+            assert_parity(loss, reference_hetero_loss(feat1, feat2, targets, dist_type), features)
+
+
+def test_multi_modal_margin_loss():
+    for dist_type in ('l2', 'l1', 'cos'):
+        for features, targets, _ in batches(3, 32):
+            features.requires_grad_()
+            feat1, feat2, feat3 = features.unbind(1)
+            loss = multiModalMarginLossNew(margin=3, dist_type=dist_type)(feat1, feat2, feat3, targets)
+            assert_parity(loss, reference_margin_loss(feat1, feat2, feat3, targets, 3, dist_type), features)
+
+
+def test_contrastive_loss():
+    for features, targets, _ in batches(32):
+        features = nn.functional.normalize(features, dim=1).detach().requires_grad_()
+        loss = ContrastiveLoss(margin=0.1)(features, targets)
+        assert_parity(loss, reference_contrastive_loss(features, targets, 0.1), features)
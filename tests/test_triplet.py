@@ -0,0 +1,46 @@
+import torch
+import layers.triplet_loss as triplet_loss
+from layers.triplet_loss import TripletLoss
+
+# every head of TripletLoss.stacked against __call__ on that head alone, values and gradients in float64
+
+
+def masked_example_mining(dist_mat, labels):
+    # per-anchor hardest positive / negative for identities with any number of samples; hard_example_mining
+    # gathers a [N, instances] view and so only holds when every identity has the same count
+    dist_ap = torch.stack([row[labels == label].max() for row, label in zip(dist_mat, labels)])
+    dist_an = torch.stack([row[labels != label].min() for row, label in zip(dist_mat, labels)])
+    return dist_ap, dist_an
+
+
+def batches(heads=3, dim=16):
+    generator = torch.Generator().manual_seed(0)
+    ordered = torch.arange(4).repeat_interleave(4)
+    unequal = torch.tensor([0, 1, 1, 2, 2, 2, 3, 3, 3, 3, 4, 4, 4, 4, 4])
+    unequal = unequal[torch.randperm(unequal.numel(), generator=generator)]
+    return [(torch.randn(heads, labels.numel(), dim, generator=generator, dtype=torch.float64), labels)
+            for labels in (ordered, unequal)]
+
+
+def check_heads(loss, feats, labels, normalize_feature):
+    feats.requires_grad_()
+    stacked = loss.stacked(list(feats.unbind(0)), labels, normalize_feature=normalize_feature)
+    for head in range(feats.size(0)):
+        outputs = loss(feats[head], labels, normalize_feature=normalize_feature)
+        for output, stacked_output in zip(outputs, stacked):
+            torch.testing.assert_close(stacked_output[head], output, rtol=1e-10, atol=1e-12)
+        gradient, = torch.autograd.grad(outputs[0], feats)
+        stacked_gradient, = torch.autograd.grad(stacked[0][head], feats, retain_graph=True)
+        torch.testing.assert_close(stacked_gradient, gradient, rtol=1e-10, atol=1e-12)
+
+
+def test_stacked_matches_call(monkeypatch):
+    (feats, labels), (unequal_feats, unequal_labels) = batches()
+    for margin in (None, 0.3):
+        for hard_factor in (0.0, 0.1):
+            for normalize_feature in (False, True):
+                loss = TripletLoss(margin=margin, hard_factor=hard_factor)
+                check_heads(loss, feats.clone(), labels, normalize_feature)
+                with monkeypatch.context() as patch:
+                    patch.setattr(triplet_loss, 'hard_example_mining', masked_example_mining)
+                    check_heads(loss, unequal_feats.clone(), unequal_labels, normalize_feature)
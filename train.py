@@ -1,3 +1,4 @@
+from utils.startup import profiler as startup
 from utils.logger import setup_logger
 from data import make_dataloader
 from modeling import make_model
@@ -9,9 +10,12 @@ import random
 import torch
 import numpy as np
 import os
+import sys
 import argparse
 from config import cfg
 
+startup.mark('imports')
+
 
 def set_seed(seed):
     torch.manual_seed(seed)
@@ -23,6 +27,22 @@ def set_seed(seed):
     torch.backends.cudnn.benchmark = True
 
 
+def profile_first_batch(cfg, model, train_loader):
+    # the first training iteration without the optimizer step: loader start-up and one forward/backward
+    device = cfg.MODEL.DEVICE
+    with startup.stage('first batch (load)'):
+        img, vid, target_cam, target_view, img_path, text = next(iter(train_loader))
+    with startup.stage('first batch (forward/backward)', synchronize=True):
+        model.to(device)
+        model.train()
+        img = {key: value.to(device) for key, value in img.items()}
+        text = {key: value.to(device) for key, value in text.items()}
+        with torch.autocast(device_type=device, enabled=device == 'cuda'):
+            output = model(image=img, text=text, label=vid.to(device), cam_label=target_cam.to(device),
+                           view_label=target_view.to(device), img_path=img_path)
+        sum(item.float().sum() for item in output if torch.is_tensor(item) and item.requires_grad).backward()
+
+
 if __name__ == '__main__':
 
     parser = argparse.ArgumentParser(description="IDEA Training")
@@ -33,6 +53,10 @@ if __name__ == '__main__':
     parser.add_argument("opts", help="Modify config options using the command-line", default=None,
                         nargs=argparse.REMAINDER)
     parser.add_argument("--local_rank", default=0, type=int)
+    parser.add_argument("--resume", default="", metavar="PATH", type=str,
+                        help="continue training from a checkpoint of utils/checkpoint.py, 'auto' for the latest in OUTPUT_DIR")
+    parser.add_argument("--profile-startup", dest="profile_startup", action="store_true",
+                        help="report the wall time of imports, dataset, model build, weight load and the first batch, then exit")
     args = parser.parse_args()
 
     if args.config_file != "":
@@ -65,9 +89,15 @@ if __name__ == '__main__':
         torch.distributed.init_process_group(backend='nccl', init_method='env://')
 
     os.environ['CUDA_VISIBLE_DEVICES'] = cfg.MODEL.DEVICE_ID
-    train_loader, train_loader_normal, val_loader, num_query, num_classes, camera_num, view_num = make_dataloader(cfg)
+    with startup.stage('dataset construction'):
+        train_loader, train_loader_normal, val_loader, num_query, num_classes, camera_num, view_num = make_dataloader(cfg)
     print("data is ready")
-    model = make_model(cfg, num_class=num_classes, camera_num=camera_num, view_num=view_num)
+    with startup.stage('model build', synchronize=True):
+        model = make_model(cfg, num_class=num_classes, camera_num=camera_num, view_num=view_num)
+    if args.profile_startup:
+        profile_first_batch(cfg, model, train_loader)
+        startup.report(logger)
+        sys.exit(0)
     # if hasattr(model, 'flops'):
     #     logger.info(str(model))
     #     n_parameters = sum(p.numel() for p in model.parameters() if p.requires_grad)
@@ -91,5 +121,5 @@ if __name__ == '__main__':
         optimizer_center,
         scheduler,
         loss_func,
-        num_query, args.local_rank
+        num_query, args.local_rank, resume=args.resume
     )
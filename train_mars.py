@@ -33,6 +33,8 @@ if __name__ == '__main__':
     parser.add_argument("opts", help="Modify config options using the command-line", default=None,
                         nargs=argparse.REMAINDER)
     parser.add_argument("--local_rank", default=0, type=int)
+    parser.add_argument("--resume", default="", metavar="PATH", type=str,
+                        help="continue training from a checkpoint of utils/checkpoint.py, 'auto' for the latest in OUTPUT_DIR")
     args = parser.parse_args()
 
     if args.config_file != "":
@@ -91,5 +93,5 @@ if __name__ == '__main__':
         optimizer_center,
         scheduler,
         loss_func,
-        num_query, args.local_rank
+        num_query, args.local_rank, resume=args.resume
     )
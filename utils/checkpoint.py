@@ -0,0 +1,245 @@
+import os
+import re
+import glob
+import random
+import hashlib
+import shutil
+import logging
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import torch
+
+
+def to_cpu(value):
+    # detached CPU copy of a state tree, later in-place updates of the live tensors do not reach it;
+    # numpy values become tensors / Python numbers so that the file loads with torch.load(weights_only=True)
+    if torch.is_tensor(value):
+        if value.is_cuda:
+            # pinned target so the copies overlap, CheckpointManager.save synchronizes once
+            return torch.empty(value.shape, dtype=value.dtype, pin_memory=True).copy_(value.detach(),
+                                                                                      non_blocking=True)
+        return value.detach().to('cpu', copy=True)
+    if isinstance(value, np.ndarray):
+        return torch.from_numpy(value.copy())
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, dict):
+        return type(value)((k, to_cpu(v)) for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        return type(value)(to_cpu(v) for v in value)
+    return value
+
+
+def rng_state():
+    state = {'python': random.getstate(), 'numpy': np.random.get_state(), 'torch': torch.get_rng_state()}
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    random.setstate(state['python'])
+    name, keys, pos, has_gauss, cached_gaussian = state['numpy']
+    np.random.set_state((name, np.asarray(keys, dtype=np.uint32), pos, has_gauss, cached_gaussian))
+    torch.set_rng_state(state['torch'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'][:torch.cuda.device_count()])
+
+
+def base_parameters(model):
+    """
+    (name, parameter) of the frozen parameters loaded from a pretrained file (CLIP.pretrained_keys), in name order.
+    Frozen parameters that are randomly initialized (text prompts, intermediate projections, ...) are not part of
+    the base: they differ between processes unless seeded, so a delta checkpoint carries them.
+    """
+    model = getattr(model, 'module', model)
+    pretrained = {prefix + ('.' if prefix else '') + key for prefix, module in model.named_modules()
+                  for key in getattr(module, 'pretrained_keys', ())}
+    return sorted((name, p) for name, p in model.named_parameters() if not p.requires_grad and name in pretrained)
+
+
+def base_hash(model):
+    """sha256 of the names, dtypes, shapes and values of the base parameters, i.e. of what a delta is applied to."""
+    digest = hashlib.sha256()
+    for name, p in base_parameters(model):
+        digest.update('{}:{}:{}'.format(name, p.dtype, tuple(p.shape)).encode())
+        digest.update(p.detach().cpu().contiguous().reshape(-1).view(torch.uint8).numpy().tobytes())
+    return digest.hexdigest()
+
+
+def delta_state_dict(model):
+    """Every state entry but the base parameters (see base_parameters): trainable and random frozen ones, buffers."""
+    model = getattr(model, 'module', model)
+    base = {name for name, _ in base_parameters(model)}
+    return type(model.state_dict())((k, v) for k, v in model.state_dict().items() if k not in base)
+
+
+def load_delta(model, checkpoint):
+    """
+    Compose a delta checkpoint ({'base_hash', 'model'}) with `model`, which must hold the same frozen base weights
+    (built from the same config and pretrained files, with any seed). Returns the load_state_dict result.
+    """
+    model = getattr(model, 'module', model)
+    expected = base_hash(model)
+    if checkpoint['base_hash'] != expected:
+        raise ValueError('Delta checkpoint was saved on base {} but the model has base {}: the pretrained '
+                         'weights differ (pretrained file or MODEL.FROZEN)'.format(checkpoint['base_hash'][:12],
+                                                                                  expected[:12]))
+    result = model.load_state_dict(checkpoint['model'], strict=False)
+    base = {name for name, _ in base_parameters(model)}
+    missing = [key for key in result.missing_keys if key not in base]
+    if missing or result.unexpected_keys:
+        raise KeyError('Delta checkpoint does not match the trainable state of the model, missing {}, unexpected {}'
+                       .format(missing, result.unexpected_keys))
+    return result
+
+
+def loader_sampler(loader):
+    # index sampler of a DataLoader (plain sampler or the one inside a DDP BatchSampler)
+    sampler = getattr(loader.batch_sampler, 'sampler', None)
+    return sampler if hasattr(sampler, 'state_dict') else None
+
+
+class CheckpointManager(object):
+    """
+    Full training-state checkpoints in OUTPUT_DIR: model, optimizers, scheduler, GradScaler, RNG states, sampler
+    position and the trainer's own counters (epoch, iteration, best metrics).
+
+    `save` snapshots the state to CPU on the calling thread (the only part that waits for the device) and
+    serializes it on a single background thread: the file is written to `<name>.tmp` and renamed over
+    `<name>`, so a checkpoint on disk is always complete. Periodic checkpoints are MODEL.NAME_<epoch>.pth
+    (MODEL.NAME_<epoch>_<iter>.pth inside an epoch), only the last SOLVER.CHECKPOINT_KEEP are kept (0 keeps all);
+    MODEL.NAMEbest.pth is replaced whenever the metric improves. The `model` entry is what load_param reads.
+    With SOLVER.CHECKPOINT_DELTA, `model` holds everything but the frozen weights loaded from the pretrained CLIP
+    file, and `base_hash` identifies those (see base_parameters, load_delta). Only DDP rank 0 writes.
+    """
+
+    def __init__(self, cfg, keep=None):
+        self.dir = cfg.OUTPUT_DIR
+        self.name = cfg.MODEL.NAME
+        self.keep = cfg.SOLVER.CHECKPOINT_KEEP if keep is None else keep
+        self.delta = cfg.SOLVER.CHECKPOINT_DELTA
+        # (base parameter versions, hash), the base is only rehashed when one of its tensors changed
+        self.base = None
+        self.enabled = not (torch.distributed.is_available() and torch.distributed.is_initialized() and
+                            torch.distributed.get_rank() != 0)
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.pending = []
+        self.logger = logging.getLogger("IDEA.checkpoint")
+
+    def path(self, epoch=None, iteration=None, best=False):
+        if best:
+            return os.path.join(self.dir, self.name + 'best.pth')
+        suffix = '_{}'.format(epoch) if iteration is None else '_{}_{}'.format(epoch, iteration)
+        return os.path.join(self.dir, self.name + suffix + '.pth')
+
+    def periodic(self):
+        # (epoch, iteration, path) of the periodic checkpoints on disk, oldest first; iteration None = epoch end
+        pattern = re.compile(re.escape(self.name) + r'_(\d+)(?:_(\d+))?\.pth$')
+        found = []
+        for path in glob.glob(os.path.join(glob.escape(self.dir), glob.escape(self.name) + '_*.pth')):
+            match = pattern.match(os.path.basename(path))
+            if match:
+                epoch, iteration = int(match.group(1)), match.group(2)
+                # an epoch-end checkpoint comes after every checkpoint taken inside that epoch
+                found.append((epoch, float('inf') if iteration is None else int(iteration), path))
+        return sorted(found)
+
+    def latest(self):
+        """Path of the newest periodic checkpoint, None when there is none."""
+        found = self.periodic()
+        return found[-1][2] if found else None
+
+    def base_hash(self, model):
+        key = tuple((name, p._version, p.data_ptr()) for name, p in base_parameters(model))
+        if self.base is None or self.base[0] != key:
+            self.base = key, base_hash(model)
+        return self.base[1]
+
+    def state(self, model, optimizer=None, optimizer_center=None, scheduler=None, scaler=None, sampler=None,
+              consumed=None, memory=None, **trainer):
+        """
+        Training state as a tree of live objects; `consumed` is the number of samples of the epoch done, `memory`
+        the cross-batch FeatureMemory of the loss (MODEL.MEMORY_SIZE).
+        """
+        model = getattr(model, 'module', model)
+        if self.delta:
+            state = {'model': delta_state_dict(model), 'base_hash': self.base_hash(model)}
+        else:
+            state = {'model': model.state_dict()}
+        state.update({'rng': rng_state(), 'trainer': trainer})
+        for key, value in (('optimizer', optimizer), ('optimizer_center', optimizer_center),
+                           ('scheduler', scheduler), ('scaler', scaler), ('memory', memory)):
+            if value is not None:
+                state[key] = value.state_dict()
+        if sampler is not None and consumed is not None:
+            state['sampler'] = sampler.state_dict(consumed)
+        return state
+
+    def save(self, state, epoch, iteration=None, periodic=True, best=False):
+        """Queue `state` (see CheckpointManager.state) as the periodic checkpoint and/or the best one."""
+        if not self.enabled or not (periodic or best):
+            return
+        self.check()
+        snapshot = to_cpu(state)
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        paths = ([self.path(epoch, iteration)] if periodic else []) + ([self.path(best=True)] if best else [])
+        self.pending.append(self.executor.submit(self.write, snapshot, paths, periodic))
+
+    def write(self, snapshot, paths, periodic):
+        os.makedirs(self.dir, exist_ok=True)
+        first = paths[0]
+        self.atomic(lambda tmp: torch.save(snapshot, tmp), first)
+        for path in paths[1:]:
+            self.atomic(lambda tmp: shutil.copyfile(first, tmp), path)
+        if periodic and self.keep > 0:
+            for _, _, path in self.periodic()[:-self.keep]:
+                os.remove(path)
+
+    @staticmethod
+    def atomic(write, path):
+        tmp = path + '.tmp'
+        write(tmp)
+        with open(tmp, 'rb') as f:
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+
+    def check(self):
+        # re-raise the error of a finished write on the training thread
+        for future in [future for future in self.pending if future.done()]:
+            self.pending.remove(future)
+            future.result()
+
+    def wait(self):
+        """Block until every queued checkpoint is on disk."""
+        for future in self.pending:
+            future.result()
+        self.pending = []
+
+    def load(self, path):
+        if path == 'auto':
+            path = self.latest()
+            if path is None:
+                raise FileNotFoundError('No checkpoint to resume from in {}'.format(self.dir))
+        self.logger.info('Resuming from {}'.format(path))
+        return torch.load(path, map_location='cpu')
+
+    @staticmethod
+    def restore(state, model, optimizer=None, optimizer_center=None, scheduler=None, scaler=None, sampler=None,
+                memory=None):
+        """Load a checkpoint into the live objects and the RNGs, returns its trainer counters."""
+        if 'rng' not in state:
+            raise ValueError('Not a training checkpoint (weights only), it cannot be resumed')
+        if 'base_hash' in state:
+            load_delta(model, state)
+        else:
+            getattr(model, 'module', model).load_state_dict(state['model'])
+        for key, value in (('optimizer', optimizer), ('optimizer_center', optimizer_center),
+                           ('scheduler', scheduler), ('scaler', scaler), ('memory', memory)):
+            if value is not None and key in state:
+                value.load_state_dict(state[key])
+        if sampler is not None and state.get('sampler') is not None:
+            sampler.load_state_dict(state['sampler'])
+        set_rng_state(state['rng'])
+        return state['trainer']
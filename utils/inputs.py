@@ -0,0 +1,22 @@
+import torch
+from modeling.clip import clip
+from modeling.clip.model import CLIP, convert_weights
+
+
+def random_inputs(batch_size, image_size, device, caption='just a test'):
+    # eval inputs of IDEA / IDEA_woText: ones images, one tokenized caption for every modality
+    image = {key: torch.ones(batch_size, 3, *image_size, device=device) for key in ('RGB', 'NI', 'TI')}
+    tokens = clip.tokenize(caption).to(device).expand(batch_size, -1).contiguous()
+    text = {'rgb_text': tokens, 'ni_text': tokens, 'ti_text': tokens}
+    cam_label = torch.zeros(batch_size, dtype=torch.long, device=device)
+    return {'image': image, 'text': text, 'cam_label': cam_label}
+
+
+def random_clip(layers):
+    # ViT-B/16 CLIP with random weights (same build as load_clip_to_cpu) when the checkpoint is not on disk
+    def load(cfg, backbone_name, h_resolution, w_resolution, vision_stride_size):
+        model = CLIP(cfg, 512, 224, layers, 768, 16, vision_stride_size[0], 77, 49408, 512, 8, layers,
+                     h_resolution, w_resolution)
+        convert_weights(model)
+        return model.eval()
+    return load
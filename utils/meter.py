@@ -1,3 +1,7 @@
+import time
+import torch
+
+
 class AverageMeter(object):
     """Computes and stores the average and current value"""
 
@@ -17,4 +21,77 @@ class AverageMeter(object):
         self.val = val
         self.sum += val * n
         self.count += n
-        self.avg = self.sum / self.count
\ No newline at end of file
+        self.avg = self.sum / self.count
+
+
+class DeviceAverageMeter(object):
+    """
+    AverageMeter whose sum stays on the device of the values: update() never waits for the device,
+    reading `avg` (e.g. once per LOG_PERIOD) is the only host sync.
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.val = 0
+        self.sum = 0
+        self.count = 0
+
+    def update(self, val, n=1):
+        if torch.is_tensor(val):
+            val = val.detach()
+        self.val = val
+        self.sum = self.sum + val * n
+        self.count += n
+
+    @property
+    def avg(self):
+        if not self.count:
+            return 0
+        avg = self.sum / self.count
+        return avg.item() if torch.is_tensor(avg) else avg
+
+
+class StepTimer(object):
+    """
+    Named wall-time regions (start(name) ... stop(name)) recorded with CUDA events on the current stream, so timing
+    a step adds no host sync; read() waits for the last event once and returns the elapsed times in ms.
+    Falls back to perf_counter when CUDA is not used. A disabled timer records nothing.
+    """
+
+    def __init__(self, enabled=True, cuda=None):
+        self.enabled = enabled
+        self.cuda = torch.cuda.is_available() if cuda is None else cuda
+        self.opened = {}
+        self.pending = {}
+
+    def _mark(self):
+        if self.cuda:
+            event = torch.cuda.Event(enable_timing=True)
+            event.record()
+            return event
+        return time.perf_counter()
+
+    def start(self, name='step'):
+        if self.enabled:
+            self.opened[name] = self._mark()
+
+    def stop(self, name='step'):
+        if self.enabled and name in self.opened:
+            self.pending.setdefault(name, []).append((self.opened.pop(name), self._mark()))
+
+    def read(self):
+        """{name: [ms, ...]} of the regions closed since the last read."""
+        pending, self.pending = self.pending, {}
+        if not pending:
+            return {}
+        if self.cuda:
+            for marks in pending.values():
+                marks[-1][1].synchronize()
+            return {name: [start.elapsed_time(end) for start, end in marks] for name, marks in pending.items()}
+        return {name: [(end - start) * 1e3 for start, end in marks] for name, marks in pending.items()}
+
+    def mean(self):
+        """{name: mean ms} of the regions closed since the last read."""
+        return {name: sum(times) / len(times) for name, times in self.read().items()}
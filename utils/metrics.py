@@ -2,12 +2,6 @@ import torch
 import os
 from utils.reranking import re_ranking
 import numpy as np
-from sklearn import manifold
-import matplotlib.patches as patches
-from PIL import Image
-from sklearn.metrics.pairwise import cosine_similarity
-import matplotlib.pyplot as plt
-import seaborn as sns
 
 def euclidean_distance(qf, gf):
     m = qf.shape[0]
@@ -18,6 +12,47 @@ def euclidean_distance(qf, gf):
     return dist_mat.cpu().numpy()
 
 
+class FeatureBank():
+    """
+    Features of the evaluated set, one contiguous [N, D] buffer per key in `dtype` (e.g. fp16/bf16 to halve the
+    memory of the stored features). Buffers are allocated once for `capacity` rows when the set size is known,
+    otherwise they grow geometrically. `device=None` keeps every key on the device of its first batch.
+    """
+
+    def __init__(self, capacity=None, dtype=torch.float32, device='cpu'):
+        self.capacity = capacity
+        self.dtype = dtype
+        self.device = device
+        self.buffers = {}
+        self.sizes = {}
+
+    def append(self, key, feat):
+        feat = feat.detach().reshape(feat.shape[0], -1)
+        size = self.sizes.get(key, 0)
+        buffer = self.buffers.get(key)
+        if buffer is None or size + feat.shape[0] > buffer.shape[0]:
+            rows = max(self.capacity or 0, size + feat.shape[0], 2 * size)
+            grown = torch.empty(rows, feat.shape[1], dtype=self.dtype,
+                                device=self.device if self.device is not None else feat.device)
+            if buffer is not None:
+                grown[:size] = buffer[:size]
+            buffer = self.buffers[key] = grown
+        buffer[size:size + feat.shape[0]] = feat
+        self.sizes[key] = size + feat.shape[0]
+
+    def __getitem__(self, key):
+        return self.buffers[key][:self.sizes[key]]
+
+    def __contains__(self, key):
+        return self.sizes.get(key, 0) > 0
+
+    def keys(self):
+        return self.buffers.keys()
+
+    def nbytes(self):
+        return sum(self[key].nelement() * self[key].element_size() for key in self.buffers)
+
+
 def eval_func_msrv(distmat, q_pids, g_pids, q_camids, g_camids, q_sceneids, g_sceneids, max_rank=50):
     """Evaluation with market1501 metric
         Key: for each query identity, its gallery images from the same camera view are discarded.
@@ -170,17 +205,20 @@ def eval_func(distmat, q_pids, g_pids, q_camids, g_camids, max_rank=50):
 
 
 class R1_mAP():
-    def __init__(self, num_query, max_rank=50, feat_norm=True, reranking=False):
+    def __init__(self, num_query, max_rank=50, feat_norm=True, reranking=False, num_samples=None,
+                 feat_dtype=torch.float32):
         super(R1_mAP, self).__init__()
         self.num_query = num_query
         self.max_rank = max_rank
         self.feat_norm = feat_norm
         self.reranking = reranking
+        # features are stored in feat_dtype, distances are computed in fp32
+        self.num_samples = num_samples
+        self.feat_dtype = feat_dtype
         self.reset()
 
     def reset(self):
-        self.feats = {'V_RGB': [], 'V_NIR': [], 'V_TIR': [], 'T_RGB': [], 
-                      'LOCAL_v': []}
+        self.feats = FeatureBank(self.num_samples, self.feat_dtype, device=None)
         self.pids = []
         self.camids = []
         # Store image paths as simple names
@@ -198,6 +236,7 @@ class R1_mAP():
         self.img_prefixes['th'] = tir_prefix
 
     def load_image(self, path):
+        from PIL import Image
         if not os.path.isfile(path):
             print(f"Warning: File {path} does not exist.")
             return np.zeros((100, 100, 3), dtype=np.uint8)  # Return a dummy image with default size
@@ -256,6 +295,8 @@ class R1_mAP():
         Helper function to plot the query images and the gallery images.
         Correctly retrieved images are marked with a green box, incorrect ones with a red box.
         """
+        import matplotlib.patches as patches
+        import matplotlib.pyplot as plt
         num_results = len(gallery_imgs[0])  # Number of top-ranked results
         fig, axs = plt.subplots(3, num_results + 1, figsize=(20, 6),
                                 gridspec_kw={'wspace': 0.2, 'hspace': 0.1})
@@ -289,14 +330,14 @@ class R1_mAP():
     def update(self, output):
         feat, pid, camid, sceneid, img_path = output
         for key in feat.keys():
-            self.feats[key].append(feat[key])
+            self.feats.append(key, feat[key])
         self.pids.extend(np.asarray(pid))
         self.camids.extend(np.asarray(camid))
         self.sceneids.extend(np.asarray(sceneid))
         self.img_paths.extend(img_path)
 
     def compute(self, query, gallery):  # called after each epoch
-        feats_all = {key: torch.cat(self.feats[key], dim=0) for key in self.feats.keys()}
+        feats_all = {key: self.feats[key].float() for key in set(query) | set(gallery)}
 
         feats_query = torch.cat([feats_all[key_item] for key_item in query], dim=1)
         feats_gallery = torch.cat([feats_all[key_item] for key_item in gallery], dim=1)
@@ -329,18 +370,22 @@ class R1_mAP():
 
 
 class R1_mAP_eval():
-    def __init__(self, num_query, max_rank=50, feat_norm=True, reranking=False):
+    def __init__(self, num_query, max_rank=50, feat_norm=True, reranking=False, num_samples=None,
+                 feat_dtype=torch.float32):
         super(R1_mAP_eval, self).__init__()
         self.num_query = num_query
         self.max_rank = max_rank
         self.feat_norm = feat_norm
         self.reranking = reranking
+        # features are stored in feat_dtype, distances are computed in fp32
+        self.num_samples = num_samples
+        self.feat_dtype = feat_dtype
         self.reset()
 
     def reset(self):
         # self.feats = {'V_RGB': [], 'V_NIR': [], 'V_TIR': [], 'T_RGB': [], 'T_NIR': [], 'T_TIR': [], 'LOCAL': [],
         #               'LOCAL_v': [], 'LOCAL_t': []}
-        self.feats = {'V_RGB': [], 'V_NIR': [], 'V_TIR': [], 'T_RGB': [],'LOCAL_v': []}
+        self.feats = FeatureBank(self.num_samples, self.feat_dtype, device='cpu')
         
         self.pids = []
         self.camids = []
@@ -362,7 +407,7 @@ class R1_mAP_eval():
     def update(self, output):  # called once for each batch
         feat, pid, camid, img_paths = output
         for key in feat.keys():
-            self.feats[key].append(feat[key].cpu())
+            self.feats.append(key, feat[key])
         self.pids.extend(np.asarray(pid))
         self.camids.extend(np.asarray(camid))
         # img_paths should be a list of image names, not full paths
@@ -374,6 +419,7 @@ class R1_mAP_eval():
         self.img_prefixes['TIR'] = tir_prefix
 
     def load_image_RGBNT201(self, path):
+        from PIL import Image
         if not os.path.isfile(path):
             print(f"Warning: File {path} does not exist.")
             return np.zeros((100, 100, 3), dtype=np.uint8)  # Return a dummy image with default size
@@ -382,6 +428,7 @@ class R1_mAP_eval():
         return np.array(image)  # Convert to NumPy array
 
     def load_image_RGBNT100(self, path,modality):
+        from PIL import Image
         if not os.path.isfile(path):
             print(f"Warning: File {path} does not exist.")
             return np.zeros((100, 100, 3), dtype=np.uint8)  # Return a dummy image with default size
@@ -451,6 +498,8 @@ class R1_mAP_eval():
         Helper function to plot the query images and the gallery images.
         Correctly retrieved images are marked with a green box, incorrect ones with a red box.
         """
+        import matplotlib.patches as patches
+        import matplotlib.pyplot as plt
         num_results = len(gallery_imgs[0])  # Number of top-ranked results
         fig, axs = plt.subplots(3, num_results + 1, figsize=(20, 8))
 
@@ -481,7 +530,7 @@ class R1_mAP_eval():
         plt.close()
 
     def compute(self, query, gallery):  # called after each epoch
-        feats_all = {key: torch.cat(self.feats[key], dim=0) for key in self.feats.keys()}
+        feats_all = {key: self.feats[key].float() for key in set(query) | set(gallery)}
 
         feats_query = torch.cat([feats_all[key_item] for key_item in query], dim=1)
         feats_gallery = torch.cat([feats_all[key_item] for key_item in gallery], dim=1)
@@ -519,6 +568,8 @@ class R1_mAP_eval():
 
     def showPointMultiModal(self, features, real_label, draw_label,
                             save_path='../A2A_CVPR2025/tsne'):
+        import matplotlib.pyplot as plt
+        from sklearn import manifold
         id_show = 25
         num_ids = len(np.unique(real_label))
         save_path = os.path.join(save_path, str(draw_label) + ".pdf")
@@ -553,6 +604,9 @@ class R1_mAP_eval():
             ids (numpy.ndarray): 样本对应的ID，形状为 (num_samples,)。
             title (str): 分布图的标题。
         """
+        import matplotlib.pyplot as plt
+        import seaborn as sns
+        from sklearn.metrics.pairwise import cosine_similarity
         features = features.cpu().detach().numpy()
         # Step 1: 计算余弦相似度矩阵
         similarity_matrix = cosine_similarity(features)
@@ -659,6 +713,8 @@ def visualize_similarity(pre_fusion_src_tokens, pre_fusion_tgt_tokens, post_fusi
     Returns:
         None
     """
+    import matplotlib.pyplot as plt
+    import seaborn as sns
 
     # 计算融合前后patch token的相似度
     similarities_ori = _calculate_similarity(pre_fusion_src_tokens, pre_fusion_tgt_tokens)
@@ -0,0 +1,258 @@
+import time
+from collections import OrderedDict
+import torch
+from torch.utils.flop_counter import FlopCounterMode
+from modeling.clip.model import Transformer
+
+# table columns: row key, header, width, number format
+COLUMNS = (('name', 'module', 48, ''), ('calls', 'calls', 6, 'd'), ('params_m', 'params(M)', 10, '.2f'),
+           ('gflops', 'GFLOPs', 10, '.3f'), ('ms', 'ms', 10, '.2f'), ('ms_pct', 'ms%', 7, '.1f'),
+           ('act_mb', 'act(MB)', 9, '.2f'), ('peak_mb', 'peak(MB)', 9, '.2f'), ('used', 'used', 5, ''))
+
+
+def count_flops(model, inputs):
+    """FLOPs of one no-grad forward of model(**inputs) (torch.utils.flop_counter, any device)."""
+    with torch.no_grad(), FlopCounterMode(display=False) as counter:
+        model(**inputs)
+    return counter.get_total_flops()
+
+
+def tensors(value):
+    if torch.is_tensor(value):
+        yield value
+    elif isinstance(value, (list, tuple)):
+        for item in value:
+            yield from tensors(item)
+    elif isinstance(value, dict):
+        for item in value.values():
+            yield from tensors(item)
+
+
+def grad_leaves(value):
+    # copy of an input tree whose float tensors require grad, so every module output joins the autograd graph
+    if torch.is_tensor(value):
+        return value.detach().requires_grad_(value.is_floating_point())
+    if isinstance(value, dict):
+        return {k: grad_leaves(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return type(value)(grad_leaves(v) for v in value)
+    return value
+
+
+def reachable(outputs):
+    # autograd nodes that the given output tensors depend on
+    seen = set()
+    todo = [t.grad_fn for t in outputs if t.grad_fn is not None]
+    while todo:
+        node = todo.pop()
+        if node in seen:
+            continue
+        seen.add(node)
+        todo.extend(next_node for next_node, _ in node.next_functions if next_node is not None)
+    return seen
+
+
+class ModuleProfiler(object):
+    """
+    Attribution of one forward pass of `model` to its submodules: FLOPs (torch.utils.flop_counter), parameters,
+    activation memory (bytes of the module outputs, plus the peak allocated over the call on CUDA) and measured
+    latency. Regions are the submodules up to `depth` dots deep (CDA, fusion heads, BACKBONE.inverseNet, ...), every
+    block of the CLIP visual and text transformers, and the per-modality towers of CLIP.run_tower.
+    Numbers are inclusive (a region contains its children) and summed over the calls of a region; the same
+    transformer block runs once per tower.
+
+    FLOPs and memory come from one pass, latency is the median over `iters` passes with a device sync at every
+    region boundary; the `total` row is timed without hooks. With `return_keys`, regions whose outputs do not
+    reach those keys of the eval output dict are marked as unused, i.e. work that could be skipped.
+    """
+
+    def __init__(self, model, depth=2):
+        self.model = model
+        self.device = next(model.parameters()).device
+        self.cuda = self.device.type == 'cuda'
+        # region name -> module whose parameters it owns
+        self.regions = OrderedDict((name, module) for name, module in model.named_modules()
+                                   if name and name.count('.') < depth)
+        self.transformers = OrderedDict((name, module) for name, module in model.named_modules()
+                                        if isinstance(module, Transformer))
+        for name, module in self.transformers.items():
+            for i, block in enumerate(module.resblocks):
+                self.regions['{}.resblocks.{}'.format(name, i)] = block
+        backbone = getattr(model, 'BACKBONE', None)
+        self.clip = backbone.base if getattr(backbone, 'clip', 0) else None
+        self.phase = None
+        self.stack = []
+        self.stats = OrderedDict()
+
+    # region boundaries, also the start/stop interface of CLIP.tower_timer
+    def start(self, name):
+        if self.phase == 'time':
+            self.sync()
+            self.stack.append([name, time.perf_counter()])
+        elif self.phase == 'count':
+            self.flush_peak()
+            allocated = torch.cuda.memory_allocated() if self.cuda else 0
+            self.stack.append([name, self.counter_total(), allocated, allocated])
+        elif self.phase == 'trace':
+            self.stack.append([name, set()])
+
+    def stop(self, name, output=None):
+        stats = self.stats.setdefault(name, {'calls': 0, 'flops': 0, 'act': 0, 'peak': 0, 'ms': [], 'nodes': set()})
+        if self.phase == 'time':
+            self.sync()
+            _, start = self.stack.pop()
+            stats['ms'][-1] += (time.perf_counter() - start) * 1e3
+        elif self.phase == 'count':
+            self.flush_peak()
+            _, flops, allocated, peak = self.stack.pop()
+            stats['calls'] += 1
+            stats['flops'] += self.counter_total() - flops
+            stats['act'] += sum(t.numel() * t.element_size() for t in tensors(output))
+            stats['peak'] = max(stats['peak'], peak - allocated)
+        elif self.phase == 'trace':
+            _, nodes = self.stack.pop()
+            nodes.update(t.grad_fn for t in tensors(output) if t.grad_fn is not None)
+            stats['nodes'].update(nodes)
+            if self.stack:
+                # outputs of a child count for its parents (tower regions have no outputs of their own)
+                self.stack[-1][1].update(nodes)
+
+    def sync(self):
+        if self.cuda:
+            torch.cuda.synchronize()
+
+    def counter_total(self):
+        return sum(self.counter.flop_counts['Global'].values())
+
+    def flush_peak(self):
+        # every open region sees the peak since the last boundary, then the peak restarts for the next one
+        if not self.cuda:
+            return
+        peak = torch.cuda.max_memory_allocated()
+        for frame in self.stack:
+            frame[3] = max(frame[3], peak)
+        torch.cuda.reset_peak_memory_stats()
+
+    def attach(self):
+        handles = []
+        for name, module in self.regions.items():
+            if '.resblocks.' in name and name.rsplit('.resblocks.', 1)[0] in self.transformers:
+                continue
+            handles.append(module.register_forward_pre_hook(lambda *_, name=name: self.start(name)))
+            handles.append(module.register_forward_hook(lambda _, __, output, name=name: self.stop(name, output)))
+        for name, module in self.transformers.items():
+            # blocks run through Transformer.run_layer and their step_* methods, not through __call__
+            module.run_layer = self.wrap_layer(module.run_layer, name)
+        previous = None
+        if self.clip is not None:
+            previous, self.clip.tower_timer = self.clip.tower_timer, self
+        return handles, previous
+
+    def detach(self, handles, previous):
+        for handle in handles:
+            handle.remove()
+        for module in self.transformers.values():
+            del module.run_layer
+        if self.clip is not None:
+            self.clip.tower_timer = previous
+
+    def wrap_layer(self, run_layer, prefix):
+        def run(i, *args, **kwargs):
+            name = '{}.resblocks.{}'.format(prefix, i)
+            self.start(name)
+            output = run_layer(i, *args, **kwargs)
+            self.stop(name, output)
+            return output
+        return run
+
+    def params(self, name):
+        if name.startswith('tower_') and self.clip is not None:
+            module = self.clip.transformer if name == 'tower_text' else self.clip.visual
+        else:
+            module = self.regions.get(name)
+        return sum(p.numel() for p in module.parameters()) if module is not None else 0
+
+    def forward(self, inputs):
+        with torch.no_grad():
+            return self.model(**inputs)
+
+    def trace(self, inputs, return_keys):
+        # one forward with autograd on, every parameter and input image requiring grad, output keys -> nodes
+        flags = [(p, p.requires_grad) for p in self.model.parameters()]
+        for p, _ in flags:
+            p.requires_grad_(True)
+        try:
+            with torch.enable_grad():
+                output = self.model(**grad_leaves(inputs))
+        finally:
+            for p, flag in flags:
+                p.requires_grad_(flag)
+        missing = [key for key in return_keys if key not in output]
+        if missing:
+            raise KeyError('{} not in the model output, expected some of {}'.format(missing, list(output)))
+        return reachable([output[key] for key in return_keys])
+
+    def profile(self, inputs, return_keys=None, iters=5, warmup=1):
+        """Rows (dicts with the COLUMNS keys) of the regions that ran, in execution order, plus a `total` row."""
+        self.stats = OrderedDict()
+        training = self.model.training
+        handles, previous = self.attach()
+        try:
+            self.phase = 'count'
+            with FlopCounterMode(display=False) as self.counter:
+                self.forward(inputs)
+            total_flops = self.counter.get_total_flops()
+            self.phase = 'time'
+            for i in range(warmup + iters):
+                for stats in self.stats.values():
+                    stats['ms'].append(0.)
+                self.forward(inputs)
+            if return_keys:
+                self.phase = 'trace'
+                needed = self.trace(inputs, return_keys)
+        finally:
+            self.phase = None
+            self.stack = []
+            self.detach(handles, previous)
+            self.model.train(training)
+
+        if self.cuda:
+            torch.cuda.reset_peak_memory_stats()
+        base = torch.cuda.memory_allocated() if self.cuda else 0
+        times = []
+        for i in range(warmup + iters):
+            self.sync()
+            start = time.perf_counter()
+            output = self.forward(inputs)
+            self.sync()
+            times.append((time.perf_counter() - start) * 1e3)
+        total_ms = sorted(times[warmup:])[iters // 2]
+
+        rows = []
+        for name, stats in self.stats.items():
+            ms = sorted(stats['ms'][warmup:])[iters // 2]
+            used = '-'
+            if return_keys:
+                used = 'yes' if stats['nodes'] & needed else ('no' if stats['nodes'] else '?')
+            rows.append({'name': name, 'calls': stats['calls'], 'params_m': self.params(name) / 1e6,
+                         'gflops': stats['flops'] / 1e9, 'ms': ms, 'ms_pct': 100. * ms / max(total_ms, 1e-9),
+                         'act_mb': stats['act'] / 2 ** 20, 'peak_mb': stats['peak'] / 2 ** 20, 'used': used})
+        rows.append({'name': 'total', 'calls': 1, 'params_m': sum(p.numel() for p in self.model.parameters()) / 1e6,
+                     'gflops': total_flops / 1e9, 'ms': total_ms, 'ms_pct': 100.,
+                     'act_mb': sum(t.numel() * t.element_size() for t in tensors(output)) / 2 ** 20,
+                     'peak_mb': (torch.cuda.max_memory_allocated() - base) / 2 ** 20 if self.cuda else 0.,
+                     'used': '-'})
+        return rows
+
+
+def format_table(rows, sort='ms', descending=True):
+    """Text table of ModuleProfiler.profile rows sorted by one column (`order` keeps execution order)."""
+    body = [row for row in rows if row['name'] != 'total']
+    if sort != 'order':
+        body = sorted(body, key=lambda row: row[sort], reverse=descending)
+    align = {'name': '<'}
+    lines = [' '.join('{:{}{}}'.format(header, align.get(key, '>'), width) for key, header, width, _ in COLUMNS)]
+    for row in body + [row for row in rows if row['name'] == 'total']:
+        lines.append(' '.join('{:{}{}{}}'.format(row[key], align.get(key, '>'), width, fmt)
+                              for key, _, width, fmt in COLUMNS))
+    return '\n'.join(lines)
@@ -0,0 +1,53 @@
+import time
+from contextlib import contextmanager
+
+
+class StartupProfiler():
+    """
+    Wall time of the start-up phases of train.py/test.py (imports, dataset construction, model build,
+    weight load, first batch). Stages may nest, e.g. the CLIP weight load inside the model build; a
+    nested stage is reported indented below its parent and its time is not counted twice in the total.
+    """
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.last = self.start
+        self.stages = []
+        self.depth = 0
+
+    def mark(self, name):
+        # close a top-level stage that started at the previous mark (used around module imports)
+        now = time.perf_counter()
+        self.stages.append((self.depth, name, now - self.last))
+        self.last = now
+
+    @contextmanager
+    def stage(self, name, synchronize=False):
+        index = len(self.stages)
+        self.stages.append((self.depth, name, 0.))
+        self.depth += 1
+        begin = time.perf_counter()
+        try:
+            yield
+        finally:
+            if synchronize:
+                import torch
+                if torch.cuda.is_available() and torch.cuda.is_initialized():
+                    torch.cuda.synchronize()
+            self.depth -= 1
+            self.last = time.perf_counter()
+            self.stages[index] = (self.depth, name, self.last - begin)
+
+    def report(self, logger):
+        total = time.perf_counter() - self.start
+        logger.info('Start-up profile ({:.2f}s since the first import):'.format(total))
+        accounted = 0.
+        for depth, name, seconds in self.stages:
+            if depth == 0:
+                accounted += seconds
+            logger.info('{:<32} {:>8.2f}s {:>6.1%}'.format('  ' * depth + name, seconds, seconds / total))
+        logger.info('{:<32} {:>8.2f}s {:>6.1%}'.format('other', total - accounted, (total - accounted) / total))
+
+
+# process-wide instance, created by the first `import utils.startup` (train.py/test.py import it first)
+profiler = StartupProfiler()
@@ -0,0 +1,113 @@
+import os
+import json
+import time
+import torch
+from utils.meter import StepTimer
+
+# training step stages in execution order, data is the host-side DataLoader wait
+STAGES = ('data', 'h2d', 'forward', 'loss', 'backward', 'optimizer')
+
+
+class Telemetry(object):
+    """
+    Per-stage instrumentation of the training step (SOLVER.TELEMETRY). One step out of every TELEMETRY_PERIOD is
+    timed: DataLoader wait on the host, h2d / forward / loss / backward / optimizer with CUDA events, and every
+    modality tower of the CLIP backbone (time, samples/s and peak memory). Eval time of each compute_log pattern
+    is recorded too. Records go to OUTPUT_DIR/telemetry.jsonl (one JSON object per line) and to the SummaryWriter.
+    Steps that are not sampled only pay a counter increment.
+    """
+
+    def __init__(self, cfg, writer=None, model=None):
+        # one writer under DDP
+        self.enabled = cfg.SOLVER.TELEMETRY and not (torch.distributed.is_available() and
+                                                     torch.distributed.is_initialized() and
+                                                     torch.distributed.get_rank() != 0)
+        self.period = max(1, cfg.SOLVER.TELEMETRY_PERIOD)
+        self.path = os.path.join(cfg.OUTPUT_DIR, 'telemetry.jsonl')
+        self.writer = writer
+        self.timer = StepTimer(enabled=False)
+        self.global_step = 0
+        self.record = None
+        self.tower_memory = {}
+        if self.enabled and model is not None:
+            model = getattr(model, 'module', model)
+            backbone = getattr(model, 'BACKBONE', None)
+            if getattr(backbone, 'clip', 0):
+                # CLIP.run_tower reports every tower call to start/stop below
+                backbone.base.tower_timer = self
+
+    def begin_step(self, epoch, n_iter, data_wait):
+        """Open the record of a step, data_wait is the host time in seconds spent waiting for the batch."""
+        self.global_step += 1
+        self.record = None
+        self.timer.enabled = False
+        if not self.enabled or self.global_step % self.period:
+            return
+        self.record = {'type': 'step', 'epoch': epoch, 'iter': n_iter, 'step': self.global_step,
+                       'data_ms': data_wait * 1e3, 'start': time.perf_counter()}
+        self.tower_memory = {}
+        self.timer.enabled = True
+        if self.timer.cuda:
+            torch.cuda.reset_peak_memory_stats()
+
+    def start(self, name):
+        if self.record is None:
+            return
+        if name.startswith('tower_') and self.timer.cuda:
+            # keep the step peak, measure the tower from here
+            self.record['peak_mb'] = max(self.record.get('peak_mb', 0.), torch.cuda.max_memory_allocated() / 2 ** 20)
+            torch.cuda.reset_peak_memory_stats()
+        self.timer.start(name)
+
+    def stop(self, name):
+        if self.record is None:
+            return
+        self.timer.stop(name)
+        if name.startswith('tower_') and self.timer.cuda:
+            peak = torch.cuda.max_memory_allocated() / 2 ** 20
+            self.tower_memory[name] = max(self.tower_memory.get(name, 0.), peak)
+            self.record['peak_mb'] = max(self.record.get('peak_mb', 0.), peak)
+
+    def end_step(self, batch_size):
+        """Read the timings back (one host sync) and write the record of a sampled step."""
+        if self.record is None:
+            return
+        record, self.record = self.record, None
+        self.timer.enabled = False
+        times = {name: sum(values) for name, values in self.timer.read().items()}
+        wall = time.perf_counter() - record.pop('start') + record['data_ms'] / 1e3
+        times['data'] = record.pop('data_ms')
+        record['stages'] = {stage: times[stage] for stage in STAGES if stage in times}
+        record['towers'] = {name[len('tower_'):]: {'ms': value, 'samples_per_s': batch_size / max(value / 1e3, 1e-9)}
+                            for name, value in times.items() if name.startswith('tower_')}
+        for name, peak in self.tower_memory.items():
+            record['towers'][name[len('tower_'):]]['peak_mb'] = peak
+        if self.timer.cuda:
+            record['peak_mb'] = max(record.get('peak_mb', 0.), torch.cuda.max_memory_allocated() / 2 ** 20)
+        record['step_ms'] = wall * 1e3
+        record['samples_per_s'] = batch_size / max(wall, 1e-9)
+        self.write(record)
+        if self.writer is not None:
+            step = record['step']
+            for stage, value in record['stages'].items():
+                self.writer.add_scalar('telemetry/{}_ms'.format(stage), value, step)
+            for tower, values in record['towers'].items():
+                for key, value in values.items():
+                    self.writer.add_scalar('telemetry/tower_{}/{}'.format(tower, key), value, step)
+            self.writer.add_scalar('telemetry/step_ms', record['step_ms'], step)
+            self.writer.add_scalar('telemetry/samples_per_s', record['samples_per_s'], step)
+            if 'peak_mb' in record:
+                self.writer.add_scalar('telemetry/peak_mb', record['peak_mb'], step)
+
+    def log_eval(self, query, gallery, seconds, epoch=0):
+        """Eval time of one compute_log search pattern."""
+        if not self.enabled:
+            return
+        self.write({'type': 'eval', 'epoch': epoch, 'step': self.global_step, 'query': list(query),
+                    'gallery': list(gallery), 'seconds': seconds})
+        if self.writer is not None:
+            self.writer.add_scalar('telemetry/eval/{}=>{}_s'.format('+'.join(query), '+'.join(gallery)), seconds, epoch)
+
+    def write(self, record):
+        with open(self.path, 'a') as f:
+            f.write(json.dumps(record) + '\n')